@@ -1,10 +1,10 @@
 import cv2
 import numpy as np
-from PySide2.QtGui import QPixmap, QImage
 from os import listdir, remove
 from os.path import isfile, join, getmtime, dirname, basename, isdir, splitext
 from natsort import natsorted
 from components.status_code_enum import *
+from components.customwidget import ImagePyramidItem
 
 YUV_FORMAT_MAP = {
     'NV21': cv2.COLOR_YUV2BGR_NV21,
@@ -99,22 +99,12 @@ class ImageBasic:
         """
         scene.clear()
         if self.img is not None:
-            # numpy转qimage的标准流程
-            if len(self.img.shape) == 2:
-                bytes_per_line = self.img.shape[1]
-                qimg = QImage(
-                    self.img, self.img.shape[1], self.img.shape[0], bytes_per_line, QImage.Format_Grayscale8)
-            elif self.img.shape[2] == 3:
-                bytes_per_line = 3 * self.img.shape[1]
-                qimg = QImage(
-                    self.img, self.img.shape[1], self.img.shape[0], bytes_per_line, QImage.Format_BGR888)
-            elif self.img.shape[2] == 4:
-                bytes_per_line = 4 * self.img.shape[1]
-                qimg = QImage(
-                    self.img, self.img.shape[1], self.img.shape[0], bytes_per_line, QImage.Format_RGBA8888)
-            else:
+            if (len(self.img.shape) == 3 and self.img.shape[2] not in [3, 4]):
                 raise ImageFormatNotSupportErr
-            scene.addPixmap(QPixmap.fromImage(qimg))
+            # 分块的金字塔显示，缩放和移动的时候只转换视窗里的块
+            item = ImagePyramidItem(self.img)
+            scene.addItem(item)
+            scene.setSceneRect(item.boundingRect())
             return
         raise ImageNoneErr
 
@@ -1,10 +1,14 @@
-from PySide2.QtCore import Signal, QPointF, Qt, QSize
+from collections import OrderedDict
+import cv2
+import numpy as np
+from PySide2.QtCore import Signal, QPointF, QRectF, Qt, QSize
 from PySide2.QtWidgets import QWidget, QTableWidget, QTableWidgetItem, QHeaderView, QGraphicsView, QAbstractScrollArea, QLabel, QProgressBar
+from PySide2.QtWidgets import QGraphicsItem, QStyleOptionGraphicsItem
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
 import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 from PySide2.QtWidgets import QMessageBox, QGraphicsScene
-from PySide2.QtGui import QPixmap, QImage
+from PySide2.QtGui import QPixmap, QImage, QPainter
 
 
 class MplCanvas(FigureCanvasQTAgg):
@@ -143,6 +147,8 @@ class ImageView(QGraphicsView):
     sigMouseMovePoint = Signal(QPointF)
     sigWheelEvent = Signal(float)
     sigDragEvent = Signal(str)
+    # 视窗显示的区域发生变化(移动、缩放、改变窗口大小)
+    sigViewportChanged = Signal()
     sceneMousePos = None
     scale_ratio = 1.0
 
@@ -178,8 +184,23 @@ class ImageView(QGraphicsView):
             self.scale(0.8, 0.8)
             self.scale_ratio *= 0.8
         self.sigWheelEvent.emit(self.scale_ratio)
+        self.sigViewportChanged.emit()
         return super().wheelEvent(event)
 
+    def scrollContentsBy(self, dx, dy):
+        super().scrollContentsBy(dx, dy)
+        self.sigViewportChanged.emit()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.sigViewportChanged.emit()
+
+    def get_visible_rect(self):
+        """
+        func: 当前视窗显示的场景区域
+        """
+        return self.mapToScene(self.viewport().rect()).boundingRect()
+
     def dragEnterEvent(self, event):
         event.accept()
 
@@ -217,28 +238,132 @@ class VideoView(QLabel):
                 print(e)
 
 
+# 金字塔的层数(不包括原图)和每个块的大小
+PYRAMID_LEVELS = 3
+PYRAMID_TILE_SIZE = 256
+# 缓存的块(QPixmap)的最大数量，256x256的RGBA块每个256KB
+PYRAMID_CACHE_TILES = 512
+
+
+def array_to_qimage(img):
+    """
+    func: numpy转qimage的标准流程，支持灰度图、BGR和RGBA，img需要是连续的uint8数组
+    ret: QImage，不支持的格式返回None
+    brief: QImage不会拷贝数据，需要在img释放之前转换成QPixmap
+    """
+    if len(img.shape) == 2:
+        return QImage(img, img.shape[1], img.shape[0], img.strides[0], QImage.Format_Grayscale8)
+    elif img.shape[2] == 3:
+        return QImage(img, img.shape[1], img.shape[0], img.strides[0], QImage.Format_BGR888)
+    elif img.shape[2] == 4:
+        return QImage(img, img.shape[1], img.shape[0], img.strides[0], QImage.Format_RGBA8888)
+    return None
+
+
+def build_pyramid(img, levels=PYRAMID_LEVELS):
+    """
+    func: 生成图像金字塔，第i层是原图的1/2^i，用INTER_AREA逐层缩小
+    ret: [原图, 1/2, 1/4, ...]，图像太小不能再缩小时提前结束
+    """
+    pyramid = [img]
+    for _ in range(levels):
+        height, width = pyramid[-1].shape[:2]
+        if (height < 2 or width < 2):
+            break
+        pyramid.append(cv2.resize(pyramid[-1], (width // 2, height // 2), interpolation=cv2.INTER_AREA))
+    return pyramid
+
+
+def select_pyramid_level(scale, levels):
+    """
+    func: 根据显示的缩放比例选择金字塔的层，选择分辨率不低于显示分辨率的最小的一层
+    """
+    level = 0
+    while (level < levels - 1 and scale * (1 << (level + 1)) <= 1):
+        level += 1
+    return level
+
+
+def get_tile_range(rect, level_shape, level, tile_size=PYRAMID_TILE_SIZE):
+    """
+    func: rect(原图坐标的left, top, right, bottom)在第level层上覆盖的块
+    ret: (ty0, ty1, tx0, tx1)，左闭右开
+    """
+    left, top, right, bottom = [v / (1 << level) for v in rect]
+    height, width = level_shape[:2]
+    tx0 = max(0, int(left) // tile_size)
+    ty0 = max(0, int(top) // tile_size)
+    tx1 = min((width + tile_size - 1) // tile_size, int(np.ceil(right)) // tile_size + 1)
+    ty1 = min((height + tile_size - 1) // tile_size, int(np.ceil(bottom)) // tile_size + 1)
+    return ty0, max(ty0, ty1), tx0, max(tx0, tx1)
+
+
+class ImagePyramidItem(QGraphicsItem):
+    """
+    分块的图像金字塔显示，场景坐标和原图的像素坐标一致
+    缩小显示的时候使用预先缩小的1/2、1/4、1/8的图像，只有和视窗相交的块才会转换成QPixmap，
+    转换过的块缓存起来，移动和缩放的时候不需要每次都把整幅图重新缩放一遍
+    """
+
+    def __init__(self, img, levels=PYRAMID_LEVELS, tile_size=PYRAMID_TILE_SIZE, parent=None):
+        super().__init__(parent)
+        self.pyramid = build_pyramid(img, levels)
+        self.tile_size = tile_size
+        self.tiles = OrderedDict()
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.pyramid[0].shape[1], self.pyramid[0].shape[0])
+
+    def get_tile(self, level, ty, tx):
+        """
+        func: 获取一个块的QPixmap，超过PYRAMID_CACHE_TILES时删除最久没有使用的块
+        """
+        key = (level, ty, tx)
+        if (key in self.tiles):
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+        data = self.pyramid[level][ty * self.tile_size:(ty + 1) * self.tile_size,
+                                   tx * self.tile_size:(tx + 1) * self.tile_size]
+        data = np.ascontiguousarray(data)
+        pixmap = QPixmap.fromImage(array_to_qimage(data))
+        self.tiles[key] = pixmap
+        if (len(self.tiles) > PYRAMID_CACHE_TILES):
+            self.tiles.popitem(last=False)
+        return pixmap
+
+    def paint(self, painter: QPainter, option: QStyleOptionGraphicsItem, widget=None):
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = select_pyramid_level(scale, len(self.pyramid))
+        exposed = option.exposedRect
+        if (painter.hasClipping()):
+            exposed = exposed.intersected(painter.clipBoundingRect())
+        ty0, ty1, tx0, tx1 = get_tile_range(
+            (exposed.left(), exposed.top(), exposed.right(), exposed.bottom()),
+            self.pyramid[level].shape, level, self.tile_size)
+        if (scale < 1):
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        factor = 1 << level
+        for ty in range(ty0, ty1):
+            for tx in range(tx0, tx1):
+                pixmap = self.get_tile(level, ty, tx)
+                target = QRectF(tx * self.tile_size * factor, ty * self.tile_size * factor,
+                                pixmap.width() * factor, pixmap.height() * factor)
+                painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+
+
 def sceneDisplayImage(scene: QGraphicsScene, img):
     """
-    img: opencv的图像数据
+    img: opencv的图像数据，按ImagePyramidItem分块显示
     """
     scene.clear()
     if img is not None:
-        # numpy转qimage的标准流程
-        if len(img.shape) == 2:
-            bytes_per_line = img.shape[1]
-            qimg = QImage(img, img, img.shape[1],
-                          img.shape[0], QImage.Format_Grayscale8)
-        elif img.shape[2] == 3:
-            bytes_per_line = 3 * img.shape[1]
-            qimg = QImage(img, img.shape[1],
-                          img.shape[0], bytes_per_line, QImage.Format_BGR888)
-        elif img.shape[2] == 4:
-            bytes_per_line = 4 * img.shape[1]
-            qimg = QImage(img, img.shape[1],
-                          img.shape[0], bytes_per_line, QImage.Format_RGBA8888)
-        else:
+        if (len(img.shape) == 3 and img.shape[2] not in [3, 4]):
             critical_win("图片格式不能解析")
-        scene.addPixmap(QPixmap.fromImage(qimg))
+            return False
+        item = ImagePyramidItem(img)
+        scene.addItem(item)
+        scene.setSceneRect(item.boundingRect())
         return True
     return False
 
@@ -0,0 +1,35 @@
+import numpy as np
+from components.customwidget import build_pyramid, select_pyramid_level, get_tile_range
+
+
+def test_build_pyramid():
+    img = np.full((1000, 1500, 3), 128, dtype=np.uint8)
+    pyramid = build_pyramid(img, 3)
+    assert [level.shape for level in pyramid] == [(1000, 1500, 3), (500, 750, 3), (250, 375, 3), (125, 187, 3)]
+    assert pyramid[0] is img
+    assert np.all(pyramid[3] == 128)
+    # 太小的图像提前结束
+    assert len(build_pyramid(np.zeros((3, 3), dtype=np.uint8), 3)) == 2
+
+
+def test_select_pyramid_level():
+    assert select_pyramid_level(2.0, 4) == 0
+    assert select_pyramid_level(1.0, 4) == 0
+    assert select_pyramid_level(0.8, 4) == 0
+    assert select_pyramid_level(0.5, 4) == 1
+    assert select_pyramid_level(0.3, 4) == 1
+    assert select_pyramid_level(0.2, 4) == 2
+    assert select_pyramid_level(0.01, 4) == 3
+    assert select_pyramid_level(0.01, 2) == 1
+
+
+def test_get_tile_range():
+    # 原图4096x2048，第0层16x8个块
+    assert get_tile_range((0, 0, 4096, 2048), (2048, 4096), 0, 256) == (0, 8, 0, 16)
+    assert get_tile_range((300, 10, 700, 200), (2048, 4096), 0, 256) == (0, 1, 1, 3)
+    # 第1层的坐标是原图的一半
+    assert get_tile_range((1100, 600, 1500, 700), (1024, 2048), 1, 256) == (1, 2, 2, 3)
+    # 超出图像的区域
+    assert get_tile_range((-500, -500, 10000, 10000), (2048, 4096), 0, 256) == (0, 8, 0, 16)
+    ty0, ty1, tx0, tx1 = get_tile_range((5000, 3000, 6000, 4000), (2048, 4096), 0, 256)
+    assert ty1 == ty0 or tx1 == tx0
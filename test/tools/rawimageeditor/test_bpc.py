@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.isp as isp
+
+
+def reference_bpc(data, neighborhood_size, points=None):
+    """
+    原来逐点处理的算法，按光栅顺序原地处理每个通道，points不为None时只处理其中的(x, y)
+    """
+    pad = neighborhood_size // 2
+    out = data.copy()
+    for y0, x0 in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+        plane = data[y0::2, x0::2]
+        img = np.pad(plane, (pad, pad), 'reflect')
+        for i in range(plane.shape[0]):
+            for j in range(plane.shape[1]):
+                if (points is not None and (j * 2 + x0, i * 2 + y0) not in points):
+                    continue
+                neighborhood = img[i: i + 2 * pad + 1, j: j + 2 * pad + 1].copy()
+                neighborhood[pad, pad] = neighborhood[pad, pad - 1]
+                img[i + pad, j + pad] = np.clip(img[i + pad, j + pad], neighborhood.min(), neighborhood.max())
+        out[y0::2, x0::2] = img[pad:-pad, pad:-pad]
+    return out
+
+
+def create_raw(height=38, width=54):
+    rng = np.random.default_rng(1)
+    img = RawImageInfo()
+    img.data = rng.normal(2000, 50, (height, width)).astype(np.float32)
+    # 加入坏点，其中有相邻的坏点
+    img.data[rng.random((height, width)) < 0.05] = 4095
+    img.data[rng.random((height, width)) < 0.05] = 0
+    img.set_color_space("raw")
+    img.max_data = 4095
+    return img
+
+
+class TestBadPixelCorrection:
+    @pytest.mark.parametrize("size", [0, 1])
+    def test_dynamic(self, size):
+        params = RawImageParams()
+        params.bpc.set_size_for_bad_pixel_correction(size)
+        img = create_raw()
+        ret_img = isp.bad_pixel_correction(img, params)
+        expect = reference_bpc(img.data, params.bpc.get_size_for_bad_pixel_correction())
+        assert np.array_equal(ret_img.data, expect)
+
+    def test_static(self, tmp_path):
+        img = create_raw()
+        filename = str(tmp_path / 'defect.txt')
+        with open(filename, 'w') as fp:
+            fp.write("# x y\n5 3\n6 3\n\n7,3\n53 37\n0 0\n")
+        params = RawImageParams()
+        params.bpc.load_defect_table(filename)
+        assert params.bpc.get_mode() == 'static'
+        ret_img = isp.bad_pixel_correction(img, params)
+        points = set(params.bpc.get_defect_table())
+        expect = reference_bpc(img.data, 3, points)
+        assert np.array_equal(ret_img.data, expect)
+        mask = np.ones(img.data.shape, dtype=bool)
+        for x, y in points:
+            mask[y, x] = False
+        assert np.array_equal(ret_img.data[mask], img.data[mask])
+
+    def test_static_error(self):
+        params = RawImageParams()
+        params.bpc.set_mode('static')
+        assert isp.bad_pixel_correction(create_raw(), params) is None
+        params.bpc.set_defect_table([(54, 0)])
+        assert isp.bad_pixel_correction(create_raw(), params) is None
+        assert params.get_error_str() == "defect table is out of image size"
@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+import pywt
+from concurrent.futures import ThreadPoolExecutor
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.isp as isp
+import tools.rawimageeditor.ispfilter as ispfilter
+
+
+def create_yuv(height, width, seed=0):
+    img = RawImageInfo()
+    img.data = (np.random.default_rng(seed).random((height, width, 3)) * 200).astype(np.float32)
+    img.set_color_space("YCrCb")
+    return img
+
+
+def reference_denoise(raw, params):
+    """
+    func: 逐个频带顺序处理的小波降噪
+    """
+    denoise = params.denoise
+    data = raw.get_raw_data()
+
+    def denoise_one_level(src, strength, noise_threshold, noise_weight):
+        noise = src - cv2.bilateralFilter(src, 5, strength, strength)
+        return src - np.clip(noise * noise_weight, -noise_threshold, noise_threshold)
+
+    coeffs = pywt.wavedec2(data=data[:, :, 0], wavelet='sym4', level=2)
+    rec_coeffs = [denoise_one_level(coeffs[0], denoise.denoise_strength[0], denoise.noise_threshold[0],
+                                    denoise.noise_weight[0]/100)]
+    for r in range(2):
+        rec_coeffs.append(tuple(denoise_one_level(band, denoise.denoise_strength[r+1], denoise.noise_threshold[r+1],
+                                                  denoise.noise_weight[0]/100) for band in coeffs[r+1]))
+    ret = np.empty_like(data)
+    ret[:, :, 0] = pywt.waverec2(rec_coeffs, 'sym4')[:data.shape[0], :data.shape[1]]
+    for c in [1, 2]:
+        ret[:, :, c] = ispfilter.bilateral_grid(data[:, :, c], sigma_spatial=isp.CHROMA_DENOISE_SIGMA_SPATIAL,
+                                                sigma_range=denoise.color_denoise_strength,
+                                                value_range=(0, raw.max_data))
+    return ret
+
+
+class TestWaveletDenoise:
+    def test_reference(self):
+        params = RawImageParams()
+        img = create_yuv(96, 128)
+        assert np.array_equal(isp.wavelet_denoise(img, params).data, reference_denoise(img, params))
+        # 奇数的宽高
+        img = create_yuv(97, 129)
+        assert np.array_equal(isp.wavelet_denoise(img, params).data, reference_denoise(img, params))
+
+    def test_reuse_coeffs(self):
+        params = RawImageParams()
+        img = create_yuv(80, 112, seed=1)
+        img.cache_key = 'yuv'
+        isp.wavelet_denoise(img, params)
+        plan = isp.acquire_wavelet_plan(img.data[:, :, 0], 'sym4', 2, 'yuv')
+        bands, buffers = plan.bands, plan.buffers
+        isp.plan_pool.release(plan)
+        assert bands is not None and plan.content_key == 'yuv'
+
+        # 只修改降噪参数，输入的cache_key没有变化，使用缓存的正变换系数
+        params.denoise.set_noise_threshold([20, 30, 40])
+        params.denoise.set_denoise_strength([10, 80, 30])
+        ret = isp.wavelet_denoise(img, params).data
+        assert np.array_equal(ret, reference_denoise(img, params))
+        plan = isp.acquire_wavelet_plan(img.data[:, :, 0], 'sym4', 2, 'yuv')
+        assert plan.bands is bands and plan.buffers is buffers
+        isp.plan_pool.release(plan)
+
+        # 输入变化(cache_key不同或者没有cache_key)时重新变换，同样大小的缓冲区继续使用
+        img.data[10, 10, 0] += 50
+        img.cache_key = None
+        assert np.array_equal(isp.wavelet_denoise(img, params).data, reference_denoise(img, params))
+        plan = isp.acquire_wavelet_plan(img.data[:, :, 0], 'sym4', 2)
+        assert plan.bands is not bands and plan.buffers is buffers and plan.content_key is None
+        isp.plan_pool.release(plan)
+
+    def test_concurrent(self):
+        params = RawImageParams()
+        images = [create_yuv(64, 96, seed) for seed in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda img: isp.wavelet_denoise(img, params).data, images * 2))
+        for img, ret in zip(images * 2, results):
+            assert np.array_equal(ret, reference_denoise(img, params))
+        assert all(plan.busy is False for plan in isp.plan_pool.plans)
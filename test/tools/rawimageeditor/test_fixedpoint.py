@@ -0,0 +1,76 @@
+import numpy as np
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispfunction as ispfunc
+import tools.rawimageeditor.isp as isp
+
+HEIGHT = 32
+WIDTH = 48
+PIPELINE = ['original raw', 'black level', 'digital gain', 'demosaic', 'awb', 'ccm', 'gamma', 'csc', 'yuv sharpen']
+
+
+def create_params(tmp_path, fixed_point):
+    data = np.random.default_rng(0).integers(0, 1024, (HEIGHT, WIDTH), dtype=np.uint16)
+    filename = str(tmp_path / 'test.raw')
+    data.tofile(filename)
+    params = RawImageParams()
+    params.rawformat.filename = filename
+    params.rawformat.width = WIDTH
+    params.rawformat.height = HEIGHT
+    params.rawformat.bit_depth = 10
+    params.rawformat.set_fixed_point(fixed_point)
+    return params
+
+
+def run_pipeline(params, pipeline=PIPELINE):
+    img = RawImageInfo()
+    for node in pipeline:
+        img = ispfunc.pipeline_dict[node](img, params)
+        assert img is not None, params.get_error_str()
+    return img
+
+
+class TestFixedPoint:
+    def test_load(self, tmp_path):
+        img = run_pipeline(create_params(tmp_path, True), ['original raw'])
+        assert img.data.dtype == np.uint16
+        assert img.max_data == 16383
+        assert img.data.max() <= 1023 << 4
+
+    def test_black_level(self, tmp_path):
+        params = create_params(tmp_path, True)
+        img = run_pipeline(params, ['original raw'])
+        ret_img = isp.black_level_correction(img, params)
+        black_level = np.left_shift(params.blc.get_black_level(), 4)
+        expect = np.maximum(img.data[::2, ::2].astype(np.int32) - black_level[0], 0)
+        assert ret_img.data.dtype == np.uint16
+        assert np.array_equal(ret_img.data[::2, ::2], expect)
+
+    def test_color_correction(self, tmp_path):
+        params = create_params(tmp_path, True)
+        params.ccm.set_color_matrix([[1.5, -0.3, -0.2], [-0.2, 1.4, -0.2], [0., -0.5, 1.5]])
+        img = run_pipeline(params, ['original raw', 'demosaic'])
+        ret_img = isp.color_correction(img, params)
+        ccm = np.int32(np.rint(np.array(params.ccm.get_color_matrix()) * 1024))
+        rgb = img.data[:, :, ::-1].astype(np.int32)
+        expect = np.clip((rgb @ ccm.T + 512) >> 10, 0, 16383)[:, :, ::-1]
+        assert ret_img.data.dtype == np.uint16
+        assert np.array_equal(ret_img.data, expect)
+
+    def test_gamma(self, tmp_path):
+        params = create_params(tmp_path, True)
+        img = run_pipeline(params, ['original raw', 'demosaic'])
+        ret_img = isp.gamma_correction(img, params)
+        expect = np.rint(16383 * np.power(img.data / 16383, 1 / params.gamma.get_gamma_ratio()))
+        assert ret_img.data.dtype == np.uint16
+        assert np.array_equal(ret_img.data, expect)
+
+    def test_pipeline(self, tmp_path):
+        fixed = run_pipeline(create_params(tmp_path, True))
+        assert fixed.data.dtype == np.int32
+        assert fixed.get_color_space() == "YCrCb"
+        assert fixed.get_showimage().dtype == np.uint8
+        # 与float模式的结果只有量化误差
+        ref = run_pipeline(create_params(tmp_path, False))
+        diff = np.abs(fixed.data[:, :, 0] - ref.data[:, :, 0] * 16)
+        assert np.median(diff) <= 16
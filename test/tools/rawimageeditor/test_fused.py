@@ -0,0 +1,74 @@
+import numpy as np
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispfunction as ispfunc
+import tools.rawimageeditor.isptile as isptile
+from tools.rawimageeditor.isppipeline import IspPipeline
+
+HEIGHT = 32
+WIDTH = 48
+NODES = ['black level', 'digital gain', 'rolloff', 'awb']
+
+
+def create_params(tmp_path):
+    rng = np.random.default_rng(0)
+    filename = str(tmp_path / 'test.raw')
+    rng.integers(0, 4096, (HEIGHT, WIDTH), dtype=np.uint16).tofile(filename)
+    params = RawImageParams()
+    params.rawformat.filename = filename
+    params.rawformat.width = WIDTH
+    params.rawformat.height = HEIGHT
+    params.rawformat.bit_depth = 12
+    params.blc.black_level = [64, 65, 66.5, 67]
+    params.gain.digital_gain = 1.37
+    params.awb.awb_gain = [1.9, 1.0, 1.63]
+    params.rolloff.flatphoto = rng.uniform(1, 1.6, (HEIGHT, WIDTH)).astype(np.float32)
+    return params
+
+
+def run_sequential(nodes, raw, params):
+    for node in nodes:
+        raw = ispfunc.pipeline_dict[node](raw, params)
+    return raw
+
+
+class TestFusedRawStage:
+    def test_group_pipeline(self):
+        groups = ispfunc.group_pipeline(['original raw', 'black level', 'awb', 'demosaic', 'awb', 'ccm'])
+        assert groups == [['original raw'], ['black level', 'awb'], ['demosaic'], ['awb'], ['ccm']]
+
+    def test_fused(self, tmp_path):
+        params = create_params(tmp_path)
+        raw = ispfunc.pipeline_dict['original raw'](RawImageInfo(), params)
+        assert ispfunc.isp.can_fuse_raw_stage(raw, params, NODES)
+        # 每一步的钳位都和单独运行一致，结果完全相同
+        assert np.array_equal(ispfunc.run_nodes(NODES, raw, params).data, run_sequential(NODES, raw, params).data)
+        params.rolloff.flatphoto = 1.2
+        assert np.array_equal(ispfunc.run_nodes(NODES, raw, params).data, run_sequential(NODES, raw, params).data)
+
+    def test_not_fused(self, tmp_path):
+        params = create_params(tmp_path)
+        raw = ispfunc.pipeline_dict['original raw'](RawImageInfo(), params)
+        params.rolloff.flatphoto = params.rolloff.flatphoto.astype(np.float64)
+        assert not ispfunc.isp.can_fuse_raw_stage(raw, params, NODES)
+        assert np.array_equal(ispfunc.run_nodes(NODES, raw, params).data, run_sequential(NODES, raw, params).data)
+
+    def test_tiled(self, tmp_path):
+        params = create_params(tmp_path)
+        pipeline = ['original raw'] + NODES + ['demosaic']
+        ret_img = isptile.run_tiled(pipeline, RawImageInfo(), params, 16)
+        assert np.array_equal(ret_img.data, run_sequential(pipeline, RawImageInfo(), params).data)
+
+    def test_materialize(self, tmp_path):
+        params = create_params(tmp_path)
+        isp_pipeline = IspPipeline(params)
+        for node in ['original raw'] + NODES + ['demosaic']:
+            isp_pipeline.add_pipeline_node(node)
+        isp_pipeline.ispProcthread.process(isp_pipeline.pipeline)
+        # 合并处理的中间图像用None占位
+        assert isp_pipeline.img_list[2:5] == [None, None, None]
+        raw = isp_pipeline.get_image(1)
+        for i, node in enumerate(NODES):
+            raw = ispfunc.pipeline_dict[node](raw, params)
+            assert np.array_equal(isp_pipeline.get_image(i + 2).data, raw.data)
+        assert isp_pipeline.img_list[3] is not None
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.isp as isp
+
+
+def create_image(color_space="RGB"):
+    img = RawImageInfo()
+    shape = (16, 24, 3) if color_space == "RGB" else (16, 24)
+    img.data = np.random.default_rng(0).uniform(1, 1023, shape).astype(np.float32)
+    img.set_color_space(color_space)
+    img.max_data = 1023
+    return img
+
+
+class TestGamma:
+    @pytest.mark.parametrize("color_space", ["raw", "RGB"])
+    def test_gamma_ratio(self, color_space):
+        params = RawImageParams()
+        img = create_image(color_space)
+        ret_img = isp.gamma_correction(img, params)
+        expect = img.max_data * np.power(img.data / img.max_data, 1 / params.gamma.get_gamma_ratio())
+        assert ret_img.data.dtype == np.float32
+        assert np.allclose(ret_img.data, expect, atol=0.01)
+
+    def test_table_cache(self):
+        table = isp.get_gamma_table(2.2, 1023, False)
+        assert isp.get_gamma_table(2.2, 1023, False) is table
+        assert len(table) == isp.GAMMA_LUT_SIZE + 1
+        assert table[0] == 0 and table[-1] == 1023
+
+    def test_gamma_curve(self, tmp_path):
+        # 12bit的线性曲线
+        filename = str(tmp_path / 'gamma.txt')
+        np.savetxt(filename, np.linspace(0, 4095, 1025), fmt='%d', delimiter=',')
+        params = RawImageParams()
+        params.gamma.load_gamma_curve(filename)
+        assert params.gamma.need_flush is True
+        img = create_image()
+        ret_img = isp.gamma_correction(img, params)
+        assert np.allclose(ret_img.data, img.data, atol=0.5)
+
+        np.savetxt(filename, np.linspace(0, 4095, 1024))
+        with pytest.raises(ValueError):
+            params.gamma.load_gamma_curve(filename)
+        params.gamma.set_gamma_curve(None)
+        assert params.gamma.get_gamma_curve() is None
@@ -0,0 +1,71 @@
+import csv
+import json
+import os
+import pickle
+import numpy as np
+import pytest
+from tools.rawimageeditor.RawImageParams import RawImageParams
+import tools.rawimageeditor.ispbatch as ispbatch
+
+
+def create_raw_files(tmp_path, num=2, height=64, width=96):
+    for i in range(num):
+        data = np.random.default_rng(i).integers(0, 4096, (height, width), dtype=np.uint16)
+        data.tofile(str(tmp_path / '{}.raw'.format(i)))
+    params = RawImageParams()
+    params.rawformat.width = width
+    params.rawformat.height = height
+    params.rawformat.bit_depth = 12
+    params_file = str(tmp_path / 'params.tmp')
+    with open(params_file, 'wb') as fp:
+        pickle.dump(params, fp)
+    return params_file
+
+
+class TestIspBatch:
+    def test_parse_pipeline(self):
+        assert ispbatch.parse_pipeline('Black Level, demosaic') == [
+            'original raw', 'black level', 'demosaic']
+        with pytest.raises(ValueError):
+            ispbatch.parse_pipeline('black level,unknown')
+
+    def test_find_raw_files(self, tmp_path):
+        create_raw_files(tmp_path)
+        files = ispbatch.find_raw_files([str(tmp_path)])
+        assert [os.path.basename(f) for f in files] == ['0.raw', '1.raw']
+        assert ispbatch.find_raw_files([str(tmp_path / '1.*')]) == [str(tmp_path / '1.raw')]
+
+    def test_run_batch(self, tmp_path):
+        params_file = create_raw_files(tmp_path)
+        output = str(tmp_path / 'out')
+        ret = ispbatch.main([str(tmp_path), '--params', params_file, '--workers', '2',
+                             '--pipeline', 'black level,demosaic,gamma', '--output', output])
+        assert ret == 0
+        assert sorted(os.listdir(output)) == ['0.jpg', '1.jpg']
+
+    def test_process_file_error(self, tmp_path):
+        params_file = create_raw_files(tmp_path)
+        params = ispbatch.load_params(params_file)
+        result = ispbatch.process_file(str(tmp_path / '0.raw'), params, ['original raw', 'csc'])
+        assert result['error'] == "color correction need RGB data"
+        assert [record['node'] for record in result['nodes']] == ['original raw', 'csc']
+
+    def test_profile(self, tmp_path):
+        params_file = create_raw_files(tmp_path)
+        for name in ['profile.json', 'profile.csv']:
+            profile = str(tmp_path / name)
+            ret = ispbatch.main([str(tmp_path / '*.raw'), '--params', params_file, '--workers', '1',
+                                 '--pipeline', 'black level,demosaic', '--profile', profile])
+            assert ret == 0
+            if (name.endswith('.json')):
+                with open(profile) as fp:
+                    records = json.load(fp)
+                assert records[-1]['node'] == 'demosaic' and records[-1]['filename'].endswith('1.raw')
+                assert records[-1]['input_shape'] == [64, 96] and records[-1]['input_dtype'] == 'float32'
+                assert records[-1]['output_shape'] == [64, 96, 3]
+                assert records[-1]['peak_bytes'] >= 64 * 96 * 3 * 4
+            else:
+                with open(profile, newline='') as fp:
+                    rows = list(csv.DictReader(fp))
+                assert len(rows) == len(records) and rows[0]['filename'].endswith('0.raw')
+                assert rows[-1]['output_shape'] == '64x96x3'
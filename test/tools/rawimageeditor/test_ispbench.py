@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import pytest
+import tools.rawimageeditor.ispbench as ispbench
+
+# 发布前的性能测试: ISP_BENCHMARK=2mp python -m pytest test/tools/rawimageeditor/test_ispbench.py
+# 和ISP_BENCHMARK_BASELINE(默认是仓库里的./config/isp_benchmark.json，2mp的结果)对比，
+# 基准文件不存在或者没有测试的分辨率时测试失败，在新的机器或者其他分辨率上先生成基准:
+#   python -m tools.rawimageeditor.ispbench --sizes 2mp --output ./config/isp_benchmark.json
+BENCHMARK_SIZES = os.environ.get('ISP_BENCHMARK', '')
+BENCHMARK_BASELINE = os.environ.get('ISP_BENCHMARK_BASELINE', './config/isp_benchmark.json')
+
+
+class TestIspBench:
+    def test_synthetic_raw(self):
+        raw = ispbench.create_synthetic_raw(96, 64, 'grbg')
+        assert raw.dtype == np.uint16 and raw.shape == (64, 96)
+        assert raw.max() < (1 << ispbench.BIT_DEPTH)
+        assert np.array_equal(raw, ispbench.create_synthetic_raw(96, 64, 'grbg'))
+        # 绿色通道的增益最大
+        assert raw[0::2, 0::2].mean() > raw[0::2, 1::2].mean()
+
+    def test_run_bench(self):
+        results = ispbench.run_bench({'tiny': (96, 64)}, repeat=1)
+        names = ispbench.get_bench_nodes() + ['demosaic[{}]'.format(t) for t in ispbench.DEMOSAIC_TYPES]
+        assert sorted(results) == sorted('tiny/{}/{}'.format(pattern, name)
+                                         for pattern in ispbench.BENCH_PATTERNS for name in names)
+        assert all(result['peak_bytes'] is not None for result in results.values())
+
+    def test_compare_baseline(self):
+        baseline = {'a': {'wall_time': 1.0, 'cpu_time': 1.0, 'peak_bytes': 100},
+                    'b': {'wall_time': 0.001, 'cpu_time': 0.001, 'peak_bytes': 100}}
+        results = {'a': {'wall_time': 1.2, 'cpu_time': 1.2, 'peak_bytes': 200},
+                   'b': {'wall_time': 0.003, 'cpu_time': 0.003, 'peak_bytes': 100},
+                   'c': {'wall_time': 9.0, 'cpu_time': 9.0, 'peak_bytes': 100}}
+        regressions = ispbench.compare_baseline(results, baseline)
+        assert len(regressions) == 1 and regressions[0].startswith('a: 峰值内存')
+        assert len(ispbench.compare_baseline(results, baseline, tolerance=0.1)) == 2
+
+    @pytest.mark.skipif(BENCHMARK_SIZES == '', reason="设置ISP_BENCHMARK后运行性能测试")
+    def test_benchmark(self):
+        if (not os.path.exists(BENCHMARK_BASELINE)):
+            pytest.fail("基准结果{}不存在".format(BENCHMARK_BASELINE))
+        baseline = ispbench.load_results(BENCHMARK_BASELINE)
+        results = ispbench.run_bench(ispbench.parse_sizes(BENCHMARK_SIZES))
+        # 基准中没有的测试项不会被比较，不能当作通过
+        assert sorted(key for key in results if key not in baseline) == []
+        regressions = ispbench.compare_baseline(results, baseline)
+        assert regressions == []
@@ -0,0 +1,178 @@
+import json
+import os
+import numpy as np
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispcache as ispcache
+from tools.rawimageeditor.isppipeline import IspPipeline
+
+PIPELINE = ['original raw', 'black level', 'demosaic', 'awb', 'gamma', 'csc', 'yuv sharpen']
+
+
+def create_image(value, shape=(8, 8)):
+    img = RawImageInfo()
+    img.data = np.full(shape, value, dtype=np.float32)
+    return img
+
+
+class TestIspCache:
+    def test_params_hash(self):
+        params = RawImageParams()
+        origin = ispcache.params_hash(params.gamma)
+        params.gamma.set_gamma(1.8)
+        changed = ispcache.params_hash(params.gamma)
+        assert changed != origin
+        params.gamma.set_gamma(2.2)
+        assert ispcache.params_hash(params.gamma) == origin
+        # need_flush只是状态标志，不影响hash
+        assert params.gamma.need_flush is True
+
+        params.rolloff.flatphoto = np.ones((4, 4), dtype=np.float32)
+        origin = ispcache.params_hash(params.rolloff)
+        params.rolloff.flatphoto = np.full((4, 4), 2, dtype=np.float32)
+        assert ispcache.params_hash(params.rolloff) != origin
+
+    def test_node_key(self):
+        params = RawImageParams()
+        assert ispcache.node_key(None, 'gamma', params) is None
+        key = ispcache.node_key('input', 'gamma', params)
+        assert key == ispcache.node_key('input', 'gamma', params)
+        assert key != ispcache.node_key('other input', 'gamma', params)
+        assert key != ispcache.node_key('input', 'ccm', params)
+        # 其他节点的参数不影响该节点的key
+        params.ccm.set_color_matrix([[2., 0., 0.], [0., 1., 0.], [0., 0., 1.]])
+        assert key == ispcache.node_key('input', 'gamma', params)
+        params.gamma.set_gamma(1.0)
+        assert key != ispcache.node_key('input', 'gamma', params)
+
+    def test_image_hash(self):
+        assert ispcache.image_hash(create_image(1)) == ispcache.image_hash(create_image(1))
+        assert ispcache.image_hash(create_image(1)) != ispcache.image_hash(create_image(2))
+
+    def test_toggle_fixed_point(self, tmp_path):
+        filename = str(tmp_path / 'test.raw')
+        np.random.default_rng(0).integers(0, 16384, (64, 96), dtype=np.uint16).tofile(filename)
+        params = RawImageParams()
+        params.rawformat.filename = filename
+        params.rawformat.width = 96
+        params.rawformat.height = 64
+        params.rawformat.bit_depth = 14
+        isp_pipeline = IspPipeline(params)
+        isp_pipeline.set_preview(False)
+        for node in ['original raw', 'black level', 'demosaic', 'awb', 'gamma']:
+            isp_pipeline.add_pipeline_node(node)
+        isp_pipeline.ispProcthread.process(isp_pipeline.pipeline)
+        assert isp_pipeline.get_image(-1).data.dtype == np.float32
+
+        # 内存映射加载的原始数据相同，切换定点模式后不能命中float的缓存
+        params.rawformat.set_fixed_point(True)
+        del isp_pipeline.img_list[1:]
+        isp_pipeline.ispProcthread.process(isp_pipeline.pipeline)
+        assert isp_pipeline.get_image(1).data.dtype == np.uint16
+        assert isp_pipeline.get_image(-1).data.dtype == np.uint16
+        params.rawformat.set_fixed_point(False)
+        del isp_pipeline.img_list[1:]
+        isp_pipeline.ispProcthread.process(isp_pipeline.pipeline)
+        assert isp_pipeline.get_image(-1).data.dtype == np.float32
+
+    def test_lru(self):
+        nbytes = create_image(0).get_raw_data().nbytes
+        cache = ispcache.NodeCache(max_bytes=nbytes * 2)
+        cache.put('a', create_image(1))
+        cache.put('b', create_image(2))
+        assert cache.get('a') is not None
+        cache.put('c', create_image(3))
+        # b是最久没有使用的，会被删除
+        assert cache.get('b') is None
+        assert cache.get('a').data[0, 0] == 1
+        assert cache.get('c').data[0, 0] == 3
+        assert cache.used_bytes == nbytes * 2
+        assert cache.get(None) is None
+
+        cache.set_max_bytes(0)
+        assert cache.get('a') is None and cache.used_bytes == 0
+        cache.put('d', create_image(4))
+        assert cache.get('d') is None
+
+    def test_disk_cache(self, tmp_path):
+        cache_dir = str(tmp_path / 'cache')
+        cache = ispcache.DiskCache(cache_dir)
+        img = create_image(1, (8, 8, 3))
+        img.set_color_space("YCrCb")
+        cache.put('a', img)
+        # 新的会话(新的DiskCache对象)也能读取
+        ret_img = ispcache.DiskCache(cache_dir).get('a')
+        assert np.array_equal(ret_img.data, img.data) and ret_img.data.dtype == img.data.dtype
+        assert ret_img.get_color_space() == "YCrCb" and ret_img.cache_key == 'a'
+        assert ret_img.get_bit_depth() == img.get_bit_depth() and ret_img.max_data == img.max_data
+        assert ret_img.get_raw_bit_depth() == img.get_raw_bit_depth() and ret_img.dtype == img.dtype
+        # 数据是只读的内存映射，属性是json
+        assert isinstance(ret_img.data, np.memmap) and not ret_img.data.flags.writeable
+        with open(cache.get_path('a') + '.json') as fp:
+            assert json.load(fp)['color_space'] == "YCrCb"
+        assert cache.get('b') is None and cache.get(None) is None
+        # 属性和数据不一致时当作损坏的文件删除
+        with open(cache.get_path('a') + '.json', 'w') as fp:
+            json.dump({'shape': [1]}, fp)
+        assert cache.get('a') is None and not cache.contains('a')
+        cache.put('a', img)
+        # 算法修改后不再命中
+        cache.version = 'other'
+        assert cache.get('a') is None
+
+    def test_algorithm_version(self):
+        # 节点间接用到的模块修改后也要让磁盘缓存失效
+        names = [module.__name__.split('.')[-1] for module in ispcache.get_algorithm_modules()]
+        for name in ['ispfunction', 'isp', 'debayer', 'ispfilter', 'utility', 'rawunpack', 'RawImageInfo']:
+            assert name in names
+        assert ispcache.algorithm_version() == ispcache.algorithm_version()
+
+    def test_disk_cache_lru(self, tmp_path):
+        cache = ispcache.DiskCache(str(tmp_path))
+        for i, key in enumerate(['a', 'b', 'c']):
+            cache.put(key, create_image(i))
+            os.utime(cache.get_path(key) + '.npy', (i, i))
+        nbytes = os.path.getsize(cache.get_path('a') + '.npy')
+        os.utime(cache.get_path('a') + '.npy', (10, 10))
+        cache.set_max_bytes(nbytes * 2)
+        # b是最久没有使用的，会被删除
+        assert cache.contains('a') and not cache.contains('b') and cache.contains('c')
+        assert not os.path.exists(cache.get_path('b') + '.json')
+        assert cache.used_bytes() == nbytes * 2
+
+    def test_disk_cache_session(self, tmp_path):
+        filename = str(tmp_path / 'test.raw')
+        np.random.default_rng(0).integers(0, 4096, (64, 96), dtype=np.uint16).tofile(filename)
+
+        def create_pipeline():
+            params = RawImageParams()
+            params.rawformat.filename = filename
+            params.rawformat.width = 96
+            params.rawformat.height = 64
+            params.rawformat.bit_depth = 12
+            isp_pipeline = IspPipeline(params)
+            isp_pipeline.set_preview(False)
+            isp_pipeline.set_disk_cache(str(tmp_path / 'cache'))
+            for node in PIPELINE:
+                isp_pipeline.add_pipeline_node(node)
+            return isp_pipeline
+
+        first = create_pipeline()
+        first.ispProcthread.process(first.pipeline)
+        # 最终结果和demosaic的结果
+        assert len(os.listdir(str(tmp_path / 'cache'))) == 4
+
+        # 再次打开时只读取raw图，然后直接读取最终结果
+        second = create_pipeline()
+        second.ispProcthread.process(second.pipeline)
+        assert [record['node'] for record in second.get_profile()] == ['original raw', 'disk cache']
+        assert len(second.img_list) == len(PIPELINE) + 1 and second.img_list[2] is None
+        assert np.array_equal(second.get_image(-1).data, first.get_image(-1).data)
+        assert np.array_equal(second.get_image(3).data, first.get_image(3).data)
+
+        # 只修改后面的节点时，从demosaic的结果开始运行
+        third = create_pipeline()
+        third.params.gamma.set_gamma(1.8)
+        third.ispProcthread.process(third.pipeline)
+        assert [record['node'] for record in third.get_profile()] == \
+            ['original raw', 'disk cache', 'awb', 'gamma', 'csc', 'yuv sharpen']
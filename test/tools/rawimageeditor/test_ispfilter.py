@@ -0,0 +1,132 @@
+import cv2
+import numpy as np
+import pytest
+from scipy import signal
+import tools.rawimageeditor.ispfilter as ispfilter
+import tools.rawimageeditor.utility as utility
+
+
+def create_image(dtype=np.float32, shape=(48, 64)):
+    return (np.random.default_rng(0).random(shape) * 1000).astype(dtype)
+
+
+class TestIspFilter:
+    def test_decompose(self):
+        gaussian = utility.create_filter().gaussian([7, 5], 1.5)
+        terms = ispfilter.decompose_kernel(gaussian)
+        assert len(terms) == 1
+        assert np.allclose(np.outer(*terms[0]), gaussian)
+        kernel = np.random.default_rng(0).random((5, 5))
+        terms = ispfilter.decompose_kernel(kernel)
+        assert len(terms) == 5
+        assert np.allclose(sum(np.outer(col, row) for col, row in terms), kernel)
+        assert ispfilter.decompose_kernel(np.zeros((3, 3))) == []
+
+    def test_plan(self):
+        gaussian = utility.create_filter().gaussian([7, 7], 1.5)
+        plan = ispfilter.get_filter_plan(gaussian)
+        assert plan[0] == 'separable' and len(plan[1]) == 1
+        # 分解的结果会缓存
+        assert ispfilter.get_filter_plan(gaussian.copy()) is plan
+        assert ispfilter.get_filter_plan(np.random.default_rng(0).random((7, 7)))[0] == 'dense'
+        # 3x3的可分离滤波器直接二维滤波更快
+        assert ispfilter.get_filter_plan(np.outer([1, 2, 1], [1, 2, 1]))[0] == 'dense'
+
+    @pytest.mark.parametrize("dtype", [np.float32, np.float64, np.uint16])
+    @pytest.mark.parametrize("border", [cv2.BORDER_REFLECT_101, cv2.BORDER_REFLECT, cv2.BORDER_REPLICATE])
+    def test_filter2d(self, dtype, border):
+        src = create_image(dtype)
+        for kernel in [utility.create_filter().gaussian([9, 7], 2.), np.random.default_rng(1).random((5, 5))]:
+            expect = cv2.filter2D(src, -1, kernel, borderType=border)
+            ret = ispfilter.filter2d(src, kernel, border)
+            assert ret.dtype == src.dtype
+            assert np.allclose(ret.astype(np.float64), expect.astype(np.float64), rtol=1e-5, atol=1)
+        dst = np.empty_like(src)
+        assert ispfilter.filter2d(src, kernel, border, dst=dst) is dst
+
+    def test_convolve2d(self):
+        src = create_image(np.float64)
+        for kernel in [utility.create_filter().gaussian([5, 5], 1.), utility.create_filter().sobel(5)[0],
+                       np.random.default_rng(2).random((3, 5))]:
+            expect = signal.convolve2d(src, kernel, mode="same", boundary="symm")
+            assert np.allclose(ispfilter.convolve2d(src, kernel, cv2.BORDER_REFLECT), expect)
+
+
+def brute_force_bilateral(data, edge, sigma_spatial, sigma_range):
+    """
+    func: 逐像素计算的高斯双边滤波
+    """
+    height, width = data.shape
+    radius = int(3 * sigma_spatial)
+    ret = np.empty_like(data)
+    for i in range(height):
+        for j in range(width):
+            i0, i1 = max(0, i - radius), min(height, i + radius + 1)
+            j0, j1 = max(0, j - radius), min(width, j + radius + 1)
+            yy, xx = np.mgrid[i0:i1, j0:j1]
+            weight = np.exp(-((yy - i)**2 + (xx - j)**2) / (2 * sigma_spatial**2) -
+                            (edge[i0:i1, j0:j1] - edge[i, j])**2 / (2 * sigma_range**2))
+            ret[i, j] = np.sum(weight * data[i0:i1, j0:j1]) / np.sum(weight)
+    return ret
+
+
+def create_step_image(seed=0):
+    step = np.where(np.arange(64)[None, :] < 32, 50., 150.) * np.ones((48, 1))
+    return step, (step + np.random.default_rng(seed).normal(0, 5, step.shape)).astype(np.float32)
+
+
+class TestBilateralGrid:
+    def test_brute_force(self):
+        step, noisy = create_step_image()
+        ret = ispfilter.bilateral_grid(noisy, sigma_spatial=4, sigma_range=20)
+        assert ret.dtype == np.float32
+        assert np.mean(np.abs(ret - brute_force_bilateral(noisy, noisy, 4, 20))) < 0.5
+        # 边缘保留，噪声去除
+        assert np.mean(np.abs(ret - step)) < 0.2 * np.mean(np.abs(noisy - step))
+
+    def test_joint(self):
+        step, noisy = create_step_image(1)
+        # 用平坦的图像作为边缘图时退化成高斯模糊，边缘被模糊
+        ret = ispfilter.bilateral_grid(noisy, np.zeros_like(noisy), sigma_spatial=4, sigma_range=20)
+        assert ret[24, 31] - ret[24, 0] < 80
+        # 用干净的阶跃图作为边缘图，边缘完全保留
+        ret = ispfilter.bilateral_grid(noisy, step, sigma_spatial=4, sigma_range=20)
+        assert np.mean(np.abs(ret - brute_force_bilateral(noisy, step, 4, 20))) < 0.5
+        assert np.abs(ret[:, 31] - 50).max() < 5 and np.abs(ret[:, 32] - 150).max() < 5
+
+    def test_special_cases(self):
+        flat = np.full((20, 30), 7., dtype=np.float32)
+        assert np.allclose(ispfilter.bilateral_grid(flat), 7)
+        _, noisy = create_step_image()
+        assert np.array_equal(ispfilter.bilateral_grid(noisy, sigma_spatial=4, sigma_range=0), noisy)
+        # NaN的像素不参与滤波
+        noisy[10, 10] = np.nan
+        ret = ispfilter.bilateral_grid(noisy, sigma_spatial=4, sigma_range=20)
+        assert np.isnan(ret[10, 10]) and np.sum(np.isnan(ret)) == 1
+        # 值域的层数有上限
+        ret = ispfilter.bilateral_grid(noisy * 1000, sigma_spatial=4, sigma_range=0.001)
+        assert np.sum(np.isnan(ret)) == 1
+        # utility中的接口
+        assert np.array_equal(utility.special_function(noisy).bilateral_filter(None, 4, 20),
+                              ispfilter.bilateral_grid(noisy, sigma_spatial=4, sigma_range=20), equal_nan=True)
+
+    def test_tiled(self):
+        data = np.random.default_rng(2).uniform(0, 255, (96, 120)).astype(np.float32)
+        full = ispfilter.bilateral_grid(data, sigma_spatial=4, sigma_range=20, value_range=(0, 255))
+        # 固定值域并且按整帧坐标对齐时，离分块边界2.5*sigma以外的结果和整帧一致
+        y0, y1, x0, x1 = 21, 77, 37, 110
+        tile = ispfilter.bilateral_grid(data[y0:y1, x0:x1], sigma_spatial=4, sigma_range=20, value_range=(0, 255),
+                                        origin=(y0, x0))
+        assert np.array_equal(tile[10:-10, 10:-10], full[y0 + 10:y1 - 10, x0 + 10:x1 - 10])
+        # 超出值域的边缘值按边界处理
+        ret = ispfilter.bilateral_grid(data, sigma_spatial=4, sigma_range=20, value_range=(64, 192))
+        assert np.all(np.isfinite(ret))
+
+    def test_small_sigma_range(self):
+        # sigma_range远小于值域/61时，值域按sigma_range采样，空的格子不会把结果拉向0
+        rng = np.random.default_rng(3)
+        for level, noise, sigma_range, max_data in [(512, 3, 2, 1023), (32768, 200, 50, 65535)]:
+            noisy = (level + rng.normal(0, noise, (64, 80))).astype(np.float32)
+            ret = ispfilter.bilateral_grid(noisy, sigma_spatial=4, sigma_range=sigma_range, value_range=(0, max_data))
+            assert np.std(ret) < np.std(noisy)
+            assert np.abs(ret - level).max() <= np.abs(noisy - level).max()
@@ -0,0 +1,140 @@
+import time
+import numpy as np
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispfunction as ispfunc
+import tools.rawimageeditor.isptile as isptile
+import tools.rawimageeditor.ispprofile as ispprofile
+from tools.rawimageeditor.isppipeline import IspPipeline, ISPProc
+
+HEIGHT = 64
+WIDTH = 96
+PIPELINE = ['original raw', 'black level', 'demosaic', 'awb', 'gamma', 'csc', 'yuv sharpen']
+
+
+def create_params(tmp_path):
+    filename = str(tmp_path / 'test.raw')
+    np.random.default_rng(0).integers(0, 4096, (HEIGHT, WIDTH), dtype=np.uint16).tofile(filename)
+    params = RawImageParams()
+    params.rawformat.filename = filename
+    params.rawformat.width = WIDTH
+    params.rawformat.height = HEIGHT
+    params.rawformat.bit_depth = 12
+    return params
+
+
+def create_pipeline(params):
+    isp_pipeline = IspPipeline(params)
+    for node in PIPELINE:
+        isp_pipeline.add_pipeline_node(node)
+    return isp_pipeline
+
+
+def run_sequential(pipeline, params):
+    img = RawImageInfo()
+    for node in pipeline:
+        img = ispfunc.pipeline_dict[node](img, params)
+    return img
+
+
+class TestISPProc:
+    def test_superseded_job(self, tmp_path):
+        isp_pipeline = create_pipeline(create_params(tmp_path))
+        thread = isp_pipeline.ispProcthread
+        done = []
+        thread.doneCB.connect(lambda: done.append(True))
+        generation = thread.supersede()
+        thread.supersede()
+        thread.process(isp_pipeline.pipeline, generation)
+        # 被取代的任务不保存图像，也不发送完成信号
+        assert len(isp_pipeline.img_list) == 1 and len(done) == 0
+        thread.process(isp_pipeline.pipeline)
+        assert len(isp_pipeline.img_list) == len(PIPELINE) + 1 and len(done) == 1
+
+    def test_coalesce_jobs(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(ISPProc, 'start', lambda self: None)
+        params = create_params(tmp_path)
+        isp_pipeline = create_pipeline(params)
+        thread = isp_pipeline.ispProcthread
+        # 连续修改参数，等待运行的任务只保留最后一个
+        for gain in [1.1, 1.2, 1.3]:
+            params.awb.set_awb_gain([gain, 1, 1])
+            isp_pipeline.run_pipeline()
+        generation, pipeline = thread.job
+        assert generation == thread.generation == 3
+        assert pipeline == PIPELINE
+        thread.job = None
+        thread.process(pipeline, generation)
+        assert np.array_equal(isp_pipeline.get_image(-1).data, run_sequential(PIPELINE, params).data)
+
+    def test_preview_raw_error(self, tmp_path, monkeypatch):
+        isp_pipeline = create_pipeline(create_params(tmp_path))
+        thread = isp_pipeline.ispProcthread
+        errors = []
+        done = []
+        thread.errorCB.connect(lambda text: errors.append(text))
+        thread.doneCB.connect(lambda: done.append(True))
+        def broken_raw(raw, params):
+            raise IOError('broken raw')
+        monkeypatch.setitem(ispfunc.pipeline_dict, 'original raw', broken_raw)
+        # 预览读取raw图出错时报告错误，不会让工作线程退出
+        thread.process(isp_pipeline.pipeline)
+        assert len(errors) == 1 and 'original raw' in errors[0] and 'broken raw' in errors[0]
+        assert len(isp_pipeline.img_list) == 1 and len(done) == 0
+
+    def test_cancel_mid_node(self, tmp_path):
+        params = create_params(tmp_path)
+        raw = ispfunc.pipeline_dict['original raw'](RawImageInfo(), params)
+        # 条带和分块开始之前检查取消，被取消时返回None，params中没有错误信息
+        assert isptile.run_banded(['black level'], raw, params, 0, 2, lambda: True) is None
+        assert isptile.run_tiled(PIPELINE[1:], raw, params, 16, cancelled=lambda: True) is None
+        assert params.get_error_str() == ""
+        calls = []
+        def cancelled():
+            calls.append(True)
+            return len(calls) > 3
+        assert isptile.run_tiled(PIPELINE[1:], raw, params, 16, cancelled=cancelled) is None
+        assert len(calls) == 4
+
+    def test_worker(self, tmp_path):
+        params = create_params(tmp_path)
+        isp_pipeline = create_pipeline(params)
+        isp_pipeline.run_pipeline()
+        params.awb.set_awb_gain([1.5, 1, 1])
+        isp_pipeline.run_pipeline()
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            with isp_pipeline.ispProcthread.job_cond:
+                idle = isp_pipeline.ispProcthread.job is None
+            if (idle and len(isp_pipeline.img_list) == len(PIPELINE) + 1):
+                break
+            time.sleep(0.01)
+        isp_pipeline.stop()
+        assert isp_pipeline.ispProcthread.isRunning() is False
+        assert np.array_equal(isp_pipeline.get_image(-1).data, run_sequential(PIPELINE, params).data)
+
+    def test_profile(self, tmp_path):
+        isp_pipeline = create_pipeline(create_params(tmp_path))
+        isp_pipeline.set_preview(False)
+        isp_pipeline.ispProcthread.process(isp_pipeline.pipeline)
+        profile = isp_pipeline.get_profile()
+        assert '+'.join(record['node'] for record in profile) == '+'.join(PIPELINE)
+        # 默认不统计峰值内存
+        assert all(record['peak_bytes'] is None for record in profile)
+        isp_pipeline.set_trace_memory(True)
+        del isp_pipeline.img_list[1:]
+        isp_pipeline.ispProcthread.node_cache.clear()
+        isp_pipeline.ispProcthread.process(isp_pipeline.pipeline)
+        profile = isp_pipeline.get_profile()
+        demosaic = [record for record in profile if record['node'] == 'demosaic'][0]
+        assert demosaic['input_shape'] == (HEIGHT, WIDTH) and demosaic['output_shape'] == (HEIGHT, WIDTH, 3)
+        assert demosaic['peak_bytes'] > 0 and demosaic['wall_time'] >= 0
+
+    def test_profile_mmap(self, tmp_path):
+        # 统计输入大小时不会转换内存映射的raw图
+        params = create_params(tmp_path)
+        img = RawImageInfo()
+        img.load_image(params.rawformat.filename, HEIGHT, WIDTH, 12, mmap=True)
+        assert ispprofile.get_image_info(img) == ((HEIGHT, WIDTH), 'uint16')
+        assert img.get_raw_map() is not None
+        assert ispprofile.get_image_info(None) == ((), '')
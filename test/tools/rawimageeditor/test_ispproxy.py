@@ -0,0 +1,83 @@
+import numpy as np
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispfunction as ispfunc
+import tools.rawimageeditor.ispproxy as ispproxy
+from tools.rawimageeditor.isppipeline import IspPipeline
+
+HEIGHT = 64
+WIDTH = 96
+PIPELINE = ['original raw', 'black level', 'demosaic', 'awb', 'gamma', 'csc', 'yuv sharpen']
+
+
+def create_params(tmp_path):
+    filename = str(tmp_path / 'test.raw')
+    np.random.default_rng(0).integers(0, 4096, (HEIGHT, WIDTH), dtype=np.uint16).tofile(filename)
+    params = RawImageParams()
+    params.rawformat.filename = filename
+    params.rawformat.width = WIDTH
+    params.rawformat.height = HEIGHT
+    params.rawformat.bit_depth = 12
+    return params
+
+
+def create_pipeline(params):
+    isp_pipeline = IspPipeline(params)
+    for node in PIPELINE:
+        isp_pipeline.add_pipeline_node(node)
+    return isp_pipeline
+
+
+class TestIspProxy:
+    def test_bin_bayer(self):
+        # 每个通道是一个常数，binning之后bayer pattern不变
+        data = np.zeros((8, 12), dtype=np.float32)
+        for value, (y, x) in zip([1, 2, 3, 4], [(0, 0), (0, 1), (1, 0), (1, 1)]):
+            data[y::2, x::2] = value
+        data[0, 0] = 5
+        ret = ispproxy.bin_data(data, 2, True)
+        assert ret.shape == (4, 6)
+        assert ret[0, 0] == 2 and ret[2, 0] == 1
+        assert np.all(ret[0::2, 1::2] == 2) and np.all(ret[1::2, 0::2] == 3) and np.all(ret[1::2, 1::2] == 4)
+
+    def test_bin_rgb_fixed(self):
+        data = np.arange(4 * 6 * 3, dtype=np.uint16).reshape((4, 6, 3))
+        ret = ispproxy.bin_data(data, 2, False)
+        assert ret.dtype == np.uint16 and ret.shape == (2, 3, 3)
+        assert ret[0, 0, 0] == (int(data[:2, :2, 0].sum()) + 2) // 4
+
+    def test_proxy_params(self):
+        params = RawImageParams()
+        params.rolloff.flatphoto = np.ones((16, 16), dtype=np.float32)
+        params.bpc.set_defect_table([(5, 3), (9, 8)])
+        proxy_params = ispproxy.get_proxy_params(params, 2)
+        assert proxy_params.rolloff.flatphoto.shape == (8, 8)
+        assert proxy_params.bpc.get_defect_table() == ((3, 1), (5, 4))
+        assert params.bpc.get_defect_table() == ((5, 3), (9, 8))
+
+    def test_proxy_spatial_params(self):
+        params = RawImageParams()
+        params.ltm.set_radius(64)
+        proxy_params = ispproxy.get_proxy_params(params, 4)
+        assert proxy_params.ltm.get_radius() == 16
+        assert proxy_params.pixel_scale == 4
+        assert params.ltm.get_radius() == 64 and params.pixel_scale == 1
+        assert ispproxy.get_proxy_params(params, 128).ltm.get_radius() == 1
+
+    def test_preview(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(ispproxy, 'PROXY_MAX_PIXELS', HEIGHT * WIDTH // 4)
+        params = create_params(tmp_path)
+        isp_pipeline = create_pipeline(params)
+        previews = []
+        isp_pipeline.ispProcthread.previewCB.connect(lambda: previews.append(isp_pipeline.get_preview_image()))
+        isp_pipeline.ispProcthread.process(isp_pipeline.pipeline)
+        assert len(previews) == 1
+        img, factor = previews[0]
+        assert factor == 2
+        assert img.get_size() == (HEIGHT // 2, WIDTH // 2, 3)
+        assert img.get_color_space() == "YCrCb"
+        # 全分辨率的结果不受影响
+        full = RawImageInfo()
+        for node in PIPELINE:
+            full = ispfunc.pipeline_dict[node](full, params)
+        assert np.array_equal(isp_pipeline.get_image(-1).data, full.data)
@@ -0,0 +1,90 @@
+import gc
+import os
+import numpy as np
+import pytest
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispfunction as ispfunc
+import tools.rawimageeditor.ispstore as ispstore
+from tools.rawimageeditor.isppipeline import IspPipeline, ISPProc
+
+HEIGHT = 64
+WIDTH = 96
+PIPELINE = ['original raw', 'black level', 'demosaic', 'awb', 'gamma', 'csc', 'yuv sharpen']
+
+
+def create_params(tmp_path):
+    filename = str(tmp_path / 'test.raw')
+    np.random.default_rng(0).integers(0, 4096, (HEIGHT, WIDTH), dtype=np.uint16).tofile(filename)
+    params = RawImageParams()
+    params.rawformat.filename = filename
+    params.rawformat.width = WIDTH
+    params.rawformat.height = HEIGHT
+    params.rawformat.bit_depth = 12
+    return params
+
+
+def run_sequential(pipeline, params):
+    images = [RawImageInfo()]
+    for node in pipeline:
+        images.append(ispfunc.pipeline_dict[node](images[-1], params))
+    return images
+
+
+class TestIspStore:
+    @pytest.mark.parametrize("mode", ispstore.STORE_MODES)
+    @pytest.mark.parametrize("dtype", [np.float32, np.int32, np.uint16])
+    def test_spill(self, tmp_path, mode, dtype):
+        img = RawImageInfo()
+        img.data = np.random.default_rng(0).normal(1000, 50, (HEIGHT, WIDTH, 3)).astype(dtype)
+        img.set_color_space("YCrCb")
+        img.cache_key = 'key'
+        spilled = ispstore.SpilledImage(img, mode, str(tmp_path))
+        ret_img = spilled.restore()
+        assert np.array_equal(ret_img.data, img.data) and ret_img.data.dtype == img.data.dtype
+        assert ret_img.get_color_space() == "YCrCb" and ret_img.cache_key == 'key'
+        if (mode == 'compress'):
+            assert 0 < spilled.stored_bytes() < img.data.nbytes
+        else:
+            assert spilled.stored_bytes() == 0 and len(os.listdir(str(tmp_path))) == 1
+            del spilled
+            gc.collect()
+            assert os.listdir(str(tmp_path)) == []
+
+    def test_shared_channels(self, tmp_path):
+        images = run_sequential(PIPELINE, create_params(tmp_path))
+        before = ispstore.SpilledImage(images[-2])
+        after = ispstore.SpilledImage(images[-1], prev=before)
+        # 锐化只处理Y，Cr和Cb只保存前一幅图像的引用
+        assert [block[0] for block in after.blocks] == ['zlib', 'shared', 'shared']
+        assert np.array_equal(after.restore().data, images[-1].data)
+
+    def test_budget(self, tmp_path, monkeypatch):
+        params = create_params(tmp_path)
+        isp_pipeline = IspPipeline(params)
+        for node in PIPELINE:
+            isp_pipeline.add_pipeline_node(node)
+        isp_pipeline.set_memory_budget(0)
+        isp_pipeline.set_preview(False)
+        thread = isp_pipeline.ispProcthread
+        thread.process(isp_pipeline.pipeline)
+        # 最后一幅图像以外，内存中的图像都被换出，节点缓存中也不再保存
+        assert not isinstance(isp_pipeline.img_list[-1], ispstore.SpilledImage)
+        assert all(ispstore.resident_bytes(img) == 0 for img in isp_pipeline.img_list[:-1])
+        assert thread.node_cache.used_bytes == ispstore.resident_bytes(isp_pipeline.img_list[-1])
+        images = run_sequential(PIPELINE, params)
+        for i in range(2, len(PIPELINE) + 1):
+            assert np.array_equal(isp_pipeline.get_image(i).data, images[i].data)
+
+        # 修改参数后从换出的图像继续运行
+        monkeypatch.setattr(ISPProc, 'start', lambda self: None)
+        isp_pipeline.old_pipeline = isp_pipeline.pipeline
+        params.gamma.set_gamma(2.0)
+        params.need_flush = True
+        params.need_flush_isp = ['gamma']
+        isp_pipeline.run_pipeline()
+        generation, pipeline = thread.job
+        assert pipeline == PIPELINE[4:]
+        assert not isinstance(isp_pipeline.img_list[-1], ispstore.SpilledImage)
+        thread.process(pipeline, generation)
+        assert np.array_equal(isp_pipeline.get_image(-1).data, run_sequential(PIPELINE, params)[-1].data)
@@ -0,0 +1,84 @@
+import numpy as np
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispfunction as ispfunc
+import tools.rawimageeditor.isptile as isptile
+
+PIPELINE = ['original raw', 'black level', 'digital gain', 'rolloff', 'demosaic', 'awb',
+            'ccm', 'gamma', 'ltm', 'guided ltm', 'csc', 'yuv denoise', 'yuv sharpen']
+
+
+def create_params(tmp_path, height=200, width=312):
+    data = np.random.default_rng(0).integers(0, 4096, (height, width), dtype=np.uint16)
+    filename = str(tmp_path / 'test.raw')
+    data.tofile(filename)
+    params = RawImageParams()
+    params.rawformat.width = width
+    params.rawformat.height = height
+    params.rawformat.bit_depth = 12
+    params.rawformat.filename = filename
+    params.blc.black_level = [64, 64, 64, 64]
+    params.awb.awb_gain = [1.5, 1.0, 1.8]
+    params.ccm.color_matrix = [[1.5, -0.3, -0.2], [-0.2, 1.4, -0.2], [-0.1, -0.4, 1.5]]
+    return params
+
+
+def run_full_frame(pipeline, params):
+    img = RawImageInfo()
+    for node in pipeline:
+        img = ispfunc.pipeline_dict[node](img, params)
+    return img
+
+
+class TestIspTile:
+    def test_split_pipeline(self, tmp_path):
+        params = create_params(tmp_path)
+        segments = isptile.split_pipeline(
+            ['original raw', 'black level', 'bad pixel correction', 'demosaic', 'yuv sharpen'], params)
+        assert segments == [(None, ['original raw']), (0, ['black level']),
+                            (None, ['bad pixel correction']), (12, ['demosaic', 'yuv sharpen'])]
+
+    def test_tiled_equals_full_frame(self, tmp_path):
+        params = create_params(tmp_path)
+        for demosaic_type in ['双线性插值', 'Malvar2004', 'Menon2007']:
+            params.demosaic.set_demosaic_func_type(demosaic_type)
+            full = run_full_frame(PIPELINE, params)
+            for tile_size in [16, 100]:
+                tiled = isptile.run_tiled(PIPELINE, RawImageInfo(), params, tile_size)
+                assert tiled.get_color_space() == full.get_color_space()
+                assert tiled.data.dtype == full.data.dtype
+                assert np.array_equal(tiled.data, full.data)
+
+    def test_tiled_rolloff_flatphoto(self, tmp_path):
+        params = create_params(tmp_path)
+        params.rolloff.flatphoto = np.linspace(
+            1, 2, 200 * 312, dtype=np.float32).reshape((200, 312))
+        pipeline = ['original raw', 'black level', 'rolloff']
+        full = run_full_frame(pipeline, params)
+        tiled = isptile.run_tiled(pipeline, RawImageInfo(), params, 64)
+        assert np.array_equal(tiled.data, full.data)
+
+    def test_tiled_error(self, tmp_path):
+        params = create_params(tmp_path)
+        assert isptile.run_tiled(['original raw', 'csc'], RawImageInfo(), params, 64) is None
+        assert params.get_error_str() == "color correction need RGB data"
+
+    def test_band_count(self, tmp_path):
+        params = create_params(tmp_path, height=600)
+        img = run_full_frame(['original raw'], params)
+        assert isptile.get_band_count('black level', img, params, 4) == 4
+        assert isptile.get_band_count('demosaic', img.crop_image(0, 200, 0, img.get_width()), params, 4) == 2
+        assert isptile.get_band_count('yuv denoise', img, params, 4) == 3
+        assert isptile.get_band_count('bad pixel correction', img, params, 4) == 1
+        assert isptile.get_band_count('black level', img, params, 1) == 1
+
+    def test_parallel_equals_full_frame(self, tmp_path):
+        params = create_params(tmp_path, height=600)
+        params.demosaic.set_demosaic_func_type('Menon2007')
+        img = run_full_frame(['original raw'], params)
+        for node in PIPELINE[1:]:
+            full = ispfunc.pipeline_dict[node](img, params)
+            banded = isptile.run_node_parallel(node, img, params, threads=3)
+            assert banded.get_color_space() == full.get_color_space()
+            assert np.array_equal(banded.data, full.data), node
+            img = full
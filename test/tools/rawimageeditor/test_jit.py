@@ -0,0 +1,18 @@
+import tools.rawimageeditor.isp as isp
+import tools.rawimageeditor.rawunpack as rawunpack
+import tools.rawimageeditor.debayer as debayer
+
+KERNELS = [isp.bad_pixel_correction_causal, isp.bad_pixel_correction_static,
+           isp.fused_raw_proc, isp.gamma_proc_interp, isp.gamma_proc_raw, isp.gamma_proc_rgb,
+           rawunpack.unpack_mipi, rawunpack.unpack_bitstream,
+           debayer.menon_color_diff, debayer.menon_green, debayer.menon_red_blue]
+
+
+class TestJit:
+    def test_warmup(self):
+        isp.warmup_jit()
+        debayer.warmup_jit()
+        for kernel in KERNELS:
+            # 编译结果缓存到磁盘，并且预编译后已经有可用的版本
+            assert kernel._cache.__class__.__name__ == 'FunctionCache'
+            assert len(kernel.signatures) > 0, kernel.__name__
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.isp as isp
+import tools.rawimageeditor.ispfilter as ispfilter
+
+
+def create_rgb(height=120, width=160, noise=0, seed=0):
+    """
+    func: 左半边暗、右半边亮的RGB图像
+    """
+    img = RawImageInfo()
+    level = np.where(np.arange(width)[None, :] < width // 2, 300., 3000.) * np.ones((height, 1))
+    data = level[:, :, None] * np.array([1., 0.9, 1.1])
+    data += np.random.default_rng(seed).normal(0, noise, data.shape)
+    img.data = data.astype(np.float32)
+    img.set_color_space("RGB")
+    img.max_data = 4095
+    return img
+
+
+class TestGuidedFilter:
+    def test_edge_preserving(self):
+        img = create_rgb(noise=20).data[:, :, 1] / 4095
+        ret = ispfilter.guided_filter(img, radius=8, eps=1e-3)
+        assert ret.dtype == np.float32
+        # 平坦区域去噪
+        assert np.std(ret[:, :60]) < 0.3 * np.std(img[:, :60])
+        # 正则项很大时退化成盒式滤波，边缘两侧的值混合
+        box = ispfilter.guided_filter(img, radius=8, eps=1e6)
+        expect = np.where(np.arange(160) < 80, 270, 2700) / 4095
+        for col in [76, 79, 80, 83]:
+            assert np.abs(ret[:, col] - expect[col]).max() < 0.2 * np.abs(box[:, col] - expect[col]).min()
+
+    def test_flat(self):
+        flat = np.full((40, 50), 0.25, dtype=np.float32)
+        assert np.allclose(ispfilter.guided_filter(flat, radius=30), 0.25, atol=1e-5)
+        guide = np.random.default_rng(0).random((40, 50)).astype(np.float32)
+        assert np.allclose(ispfilter.guided_filter(flat, guide, radius=4), 0.25, atol=1e-5)
+
+
+class TestGuidedLTM:
+    def test_gain_table(self):
+        table = isp.get_ltm_gain_table(1., 0.5, 1.)
+        assert table.shape == (isp.LTM_LUT_MEAN_SIZE + 1, isp.LTM_LUT_VALUE_SIZE + 1)
+        assert not table.flags.writeable
+        # 第一行局部均值为0，最后一行为1，暗区提亮，亮区压暗
+        value = 64 / isp.LTM_LUT_VALUE_SIZE
+        assert np.isclose(table[0, 64], value ** (0.75 - 1), rtol=1e-5)
+        assert np.isclose(table[-1, 64], value ** (1.125 - 1), rtol=1e-5)
+        # 局部均值越大增益越小
+        assert np.all(np.diff(table[:, 1:-1], axis=0) <= 0)
+        assert np.allclose(table[:, -1], 1)
+        assert np.all(isp.get_ltm_gain_table(1., 1., 0.) == 1)
+
+    def test_no_halo(self):
+        img = create_rgb()
+        params = RawImageParams()
+        for radius in [16, 200]:
+            params.ltm.set_radius(radius)
+            ret = isp.guided_ltm(img, params)
+            assert ret.data.dtype == np.float32 and ret.get_color_space() == "RGB"
+            dark, bright = ret.data[:, :80], ret.data[:, 80:]
+            assert np.all(dark > img.data[:, :80]) and np.all(bright < img.data[:, 80:])
+            # 边缘附近和远离边缘的增益相同
+            assert np.ptp(dark[:, :, 1]) < 0.01 * np.mean(dark[:, :, 1])
+            assert np.ptp(bright[:, :, 1]) < 0.01 * np.mean(bright[:, :, 1])
+            # RGB乘以同一个增益
+            assert np.allclose(ret.data[:, :, 0] / img.data[:, :, 0], ret.data[:, :, 1] / img.data[:, :, 1],
+                               rtol=1e-4)
+
+    def test_strength(self):
+        img = create_rgb(noise=20)
+        params = RawImageParams()
+        params.ltm.set_strength(0)
+        assert np.allclose(isp.guided_ltm(img, params).data, np.clip(img.data, 0, 4095), rtol=1e-6)
+        params.ltm.set_strength(50)
+        half = isp.guided_ltm(img, params).data
+        params.ltm.set_strength(100)
+        full = isp.guided_ltm(img, params).data
+        assert np.mean(img.data[:, :60]) < np.mean(half[:, :60]) < np.mean(full[:, :60])
+
+    def test_params(self):
+        params = RawImageParams()
+        assert params.ltm.get_radius() == 64 and params.ltm.get_strength() == 100
+        params.ltm.set_radius(64)
+        assert params.ltm.need_flush is False
+        params.ltm.set_radius(300)
+        assert params.ltm.need_flush is True and params.ltm.get_radius() == 300
+
+    def test_need_rgb(self):
+        img = create_rgb()
+        img.set_color_space("YCrCb")
+        params = RawImageParams()
+        assert isp.guided_ltm(img, params) is None
+        assert params.get_error_str() == "guided ltm need RGB data"
@@ -0,0 +1,86 @@
+import numpy as np
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+
+
+def create_raw_file(tmp_path, height=16, width=24, offset=0, stride=0):
+    data = np.random.default_rng(0).integers(0, 1024, (height, width), dtype=np.uint16)
+    if (stride == 0):
+        stride = width * 2
+    buf = np.zeros(offset + height * stride, dtype=np.uint8)
+    for i in range(height):
+        start = offset + i * stride
+        buf[start:start + width * 2] = data[i].view(np.uint8)
+    filename = str(tmp_path / 'test.raw')
+    buf.tofile(filename)
+    return filename, data
+
+
+class TestRawImageInfo:
+    def test_load_image(self, tmp_path):
+        filename, data = create_raw_file(tmp_path)
+        img = RawImageInfo()
+        img.load_image(filename, 16, 24, 10)
+        assert img.get_raw_map() is None
+        assert img.data.dtype == np.float32
+        assert np.array_equal(img.data, data)
+        assert img.max_data == 1023
+
+    def test_load_image_offset_stride(self, tmp_path):
+        filename, data = create_raw_file(tmp_path, offset=32, stride=64)
+        img = RawImageInfo()
+        img.load_image(filename, 16, 24, 10, offset=32, stride=64)
+        assert np.array_equal(img.data, data)
+
+    def test_load_image_mmap(self, tmp_path):
+        filename, data = create_raw_file(tmp_path, offset=32, stride=52)
+        img = RawImageInfo()
+        img.load_image(filename, 16, 24, 10, offset=32, stride=52, mmap=True)
+        # 获取尺寸，区域以及单点数据都不会转换整幅图像
+        assert img.get_size() == (16, 24)
+        assert np.array_equal(img.get_region(4, 8, 2, 10), data[4:8, 2:10])
+        assert img.get_region(4, 8, 2, 10).dtype == np.float32
+        tile = img.crop_image(8, 16, 8, 16)
+        assert np.array_equal(tile.data, data[8:16, 8:16])
+        assert img.get_img_point(3, 5) == data[5, 3]
+        assert img.get_raw_map() is not None
+
+        assert np.array_equal(img.data, data)
+        assert img.data.dtype == np.float32
+        assert img.get_raw_map() is None
+
+    def test_show_cache(self, tmp_path):
+        filename, data = create_raw_file(tmp_path)
+        img = RawImageInfo()
+        img.load_image(filename, 16, 24, 10)
+        show = img.get_showimage()
+        assert img.get_showimage() is show
+        # 修改数据或者显示相关的属性之后重新转换
+        img.data = img.data * 0.5
+        assert img.get_showimage() is not show
+        show = img.get_showimage()
+        img.set_bayer_pattern("bggr")
+        assert img.get_showimage() is not show
+        img.data[:] = 0
+        img.invalidate_show()
+        assert img.get_showimage().max() == 0
+
+    def test_show_region(self, tmp_path):
+        filename, data = create_raw_file(tmp_path)
+        img = RawImageInfo()
+        img.load_image(filename, 16, 24, 10, mmap=True)
+        # 按区域转换不会转换整幅图像
+        region, y0, x0 = img.get_showimage_region(3, 11, 5, 21)
+        assert img.get_raw_map() is not None and (y0, x0) == (2, 4)
+        full = img.get_showimage()
+        assert np.array_equal(region, full[2:11, 4:21])
+        region, _, _ = img.get_showimage_region(0, 16, 0, 24, 4)
+        assert region.shape == (8, 12, 3)
+        assert np.array_equal(region[0::2, 0::2], full[0::4, 0::4])
+        assert np.array_equal(region[1::2, 1::2], full[1::4, 1::4])
+
+        rgb = RawImageInfo()
+        rgb.data = np.random.default_rng(0).uniform(0, 1023, (16, 24, 3)).astype(np.float32)
+        rgb.set_color_space("YCrCb")
+        rgb.max_data = 1023
+        region, _, _ = rgb.get_showimage_region(3, 11, 5, 21, 2)
+        assert np.array_equal(region, rgb.get_showimage()[3:11:2, 5:21:2])
@@ -0,0 +1,115 @@
+import pickle
+import numpy as np
+import pytest
+from tools.rawimageeditor.RawImageParams import RawImageParams, FormatParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.rawunpack as rawunpack
+import tools.rawimageeditor.isp as isp
+
+
+def pack_mipi(img, bit_depth):
+    group_pixels, group_bytes = rawunpack.PACKED_GROUP[bit_depth]
+    height, width = img.shape
+    groups = -(-width // group_pixels)
+    pixels = np.zeros((height, groups * group_pixels), dtype=np.uint32)
+    pixels[:, :width] = img
+    pixels = pixels.reshape(height, groups, group_pixels)
+    ret = np.zeros((height, groups, group_bytes), dtype=np.uint8)
+    ret[:, :, :group_pixels] = pixels >> (bit_depth - 8)
+    lsb = np.zeros((height, groups), dtype=np.uint32)
+    for i in range(group_pixels):
+        lsb |= (pixels[:, :, i] & ((1 << (bit_depth - 8)) - 1)) << ((bit_depth - 8) * i)
+    for i in range(group_bytes - group_pixels):
+        ret[:, :, group_pixels + i] = (lsb >> (8 * i)) & 0xff
+    return ret.reshape(height, -1)
+
+
+def pack_bitstream(img, bit_depth):
+    height, width = img.shape
+    bits = ((img[:, :, None] >> np.arange(bit_depth)) & 1).astype(np.uint8)
+    bits = bits.reshape(height, width * bit_depth)
+    row_bytes = rawunpack.get_row_bytes(width, bit_depth, "PACKED")
+    padded = np.zeros((height, row_bytes * 8), dtype=np.uint8)
+    padded[:, :width * bit_depth] = bits
+    return np.packbits(padded, axis=1, bitorder='little')
+
+
+class TestRawUnpack:
+    @pytest.mark.parametrize("bit_depth", [8, 10, 12, 14])
+    @pytest.mark.parametrize("width", [16, 18, 23])
+    def test_packed(self, bit_depth, width):
+        img = np.random.default_rng(bit_depth).integers(0, 1 << bit_depth, (10, width), dtype=np.uint16)
+        for raw_format, pack in (("MIPI", pack_mipi), ("PACKED", pack_bitstream)):
+            rows = pack(img, bit_depth)
+            assert rows.shape[1] == rawunpack.get_row_bytes(width, bit_depth, raw_format)
+            # 每一行后面有填充
+            stride = rows.shape[1] + 3
+            buf = np.zeros((10, stride), dtype=np.uint8)
+            buf[:, :rows.shape[1]] = rows
+            ret = rawunpack.unpack_frame(buf.reshape(-1), 10, width, bit_depth, raw_format, stride)
+            assert np.array_equal(ret, img)
+
+    def test_unpacked(self):
+        img = np.random.default_rng(0).integers(0, 1024, (6, 8), dtype=np.uint16)
+        ret = rawunpack.unpack_frame(img.astype('>u2').view(np.uint8).reshape(-1), 6, 8, 10, "UNPACKED_BE")
+        assert np.array_equal(ret, img)
+        ret = rawunpack.unpack_frame((img << 6).view(np.uint8).reshape(-1), 6, 8, 10, "UNPACKED_MSB")
+        assert np.array_equal(ret, img)
+
+    def test_iter_frames(self, tmp_path):
+        frames = np.random.default_rng(0).integers(0, 4096, (3, 4, 8), dtype=np.uint16)
+        filename = str(tmp_path / 'frames.raw')
+        with open(filename, 'wb') as fp:
+            fp.write(b'\0' * 16)
+            for frame in frames:
+                fp.write(pack_mipi(frame, 12).tobytes())
+        assert rawunpack.get_frame_count(filename, 4, 8, 12, "MIPI", offset=16) == 3
+        ret = list(rawunpack.iter_frames(filename, 4, 8, 12, "MIPI", offset=16))
+        assert len(ret) == 3
+        for frame, expect in zip(ret, frames):
+            assert np.array_equal(frame, expect)
+
+    def test_load_mipi(self, tmp_path):
+        img = np.random.default_rng(0).integers(0, 1024, (8, 12), dtype=np.uint16)
+        filename = str(tmp_path / 'mipi.raw')
+        pack_mipi(img, 10).tofile(filename)
+        params = RawImageParams()
+        params.rawformat.filename = filename
+        params.rawformat.height = 8
+        params.rawformat.width = 12
+        params.rawformat.bit_depth = 10
+        params.rawformat.raw_format = "MIPI"
+        raw = isp.get_src_raw_data(RawImageInfo(), params)
+        assert np.array_equal(raw.data, img)
+
+        params.rawformat.bit_depth = 11
+        assert isp.get_src_raw_data(RawImageInfo(), params) is None
+        params.rawformat.bit_depth = 10
+        params.rawformat.raw_format = "UNPACKED"
+        assert isp.get_src_raw_data(RawImageInfo(), params) is None
+        assert params.get_error_str().startswith("文件大小与图片格式不符")
+
+    def test_old_mipi_params(self, tmp_path):
+        # 旧版本的MIPI表示16bit非压缩的格式，这样的文件按packed格式加载时报错
+        img = np.random.default_rng(0).integers(0, 1024, (8, 12), dtype=np.uint16)
+        filename = str(tmp_path / 'unpacked.raw')
+        img.tofile(filename)
+        params = RawImageParams()
+        params.rawformat.filename = filename
+        params.rawformat.height = 8
+        params.rawformat.width = 12
+        params.rawformat.bit_depth = 10
+        params.rawformat.raw_format = "MIPI"
+        assert isp.get_src_raw_data(RawImageInfo(), params) is None
+        assert "UNPACKED" in params.get_error_str()
+        # 8bit的两帧packed数据和一帧非压缩数据一样大，不能区分
+        assert not rawunpack.is_unpacked_size(8 * 12 * 2, 8, 12, 8, "MIPI")
+
+        # 旧版本保存的参数(没有format_version)加载时转换成UNPACKED，新版本保存的MIPI保持不变
+        assert pickle.loads(pickle.dumps(params)).rawformat.raw_format == "MIPI"
+        old_format = FormatParams.__new__(FormatParams)
+        old_format.__setstate__(dict(params.rawformat.__dict__))
+        assert old_format.raw_format == "UNPACKED"
+        params.rawformat = old_format
+        raw = isp.get_src_raw_data(RawImageInfo(), params)
+        assert np.array_equal(raw.data, img)
@@ -0,0 +1,75 @@
+import cv2
+import numpy as np
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.isp as isp
+
+
+def create_yuv(height, width, seed=0):
+    img = RawImageInfo()
+    img.data = (np.random.default_rng(seed).random((height, width, 3)) * 200).astype(np.float32)
+    img.set_color_space("YCrCb")
+    return img
+
+
+def reference_sharpen(raw, params):
+    """
+    func: 逐步计算的锐化
+    """
+    sp = params.sharpen.medianblur_strength/100
+    data = raw.get_raw_data()
+    Y = data[:, :, 0]
+    Xm = sp * cv2.medianBlur(Y, 3) + (1 - sp) * Y
+    edge = np.abs(cv2.filter2D(Xm, -1, isp.SHARPEN_EDGE_KERNEL))
+    alpha = 1/(1 + np.exp(-0.1 * (edge - params.sharpen.denoise_threshold)))
+    Xw = params.sharpen.sharpen_strength * alpha
+    Xedge = cv2.filter2D(Xm, -1, isp.SHARPEN_HPF_KERNEL)
+    Y_HPF = np.clip(Xedge * Xw, -params.sharpen.clip_range, params.sharpen.clip_range) + Xm
+    Y_LPF = cv2.filter2D(Xm, -1, isp.SHARPEN_LPF_KERNEL)
+    ret = data.copy()
+    ret[:, :, 0] = alpha * Y_HPF + (1 - alpha) * Y_LPF
+    return ret
+
+
+def get_plan(img):
+    Y = img.data[:, :, 0]
+    key = ('sharpen', Y.shape, np.dtype(Y.dtype))
+    plan = isp.plan_pool.acquire(key, lambda: isp.SharpenPlan(key))
+    isp.plan_pool.release(plan)
+    return plan
+
+
+class TestSharpen:
+    def test_reference(self):
+        params = RawImageParams()
+        img = create_yuv(96, 128)
+        assert np.allclose(isp.sharpen(img, params).data, reference_sharpen(img, params), atol=1e-3)
+        params.sharpen.set_medianblur_strength(60)
+        params.sharpen.set_clip_range(8)
+        assert np.allclose(isp.sharpen(img, params).data, reference_sharpen(img, params), atol=1e-3)
+
+    def test_reuse_intermediates(self):
+        params = RawImageParams()
+        img = create_yuv(80, 112, seed=1)
+        img.cache_key = 'yuv'
+        isp.sharpen(img, params)
+        plan = get_plan(img)
+        intermediates = plan.intermediates
+        Xm = intermediates[0].copy()
+
+        # 只修改锐化强度、降噪阈值和钳位阈值，使用缓存的滤波结果
+        params.sharpen.set_sharpen_strength(10)
+        params.sharpen.set_denoise_threshold(20)
+        params.sharpen.set_clip_range(16)
+        ret = isp.sharpen(img, params).data
+        assert np.allclose(ret, reference_sharpen(img, params), atol=1e-3)
+        assert get_plan(img) is plan and plan.content_key == ('yuv', params.sharpen.medianblur_strength/100)
+
+        # 中值滤波强度或者输入变化时重新计算，缓冲区继续使用
+        params.sharpen.set_medianblur_strength(50)
+        assert np.allclose(isp.sharpen(img, params).data, reference_sharpen(img, params), atol=1e-3)
+        assert get_plan(img).intermediates is intermediates and not np.array_equal(intermediates[0], Xm)
+        img.data[5, 5, 0] += 30
+        img.cache_key = None
+        assert np.allclose(isp.sharpen(img, params).data, reference_sharpen(img, params), atol=1e-3)
+        assert get_plan(img).intermediates is intermediates and plan.content_key is None
@@ -0,0 +1,40 @@
+from PySide2.QtWidgets import QDialog, QTableWidget, QTableWidgetItem, QVBoxLayout, QHeaderView
+import tools.rawimageeditor.ispprofile as ispprofile
+
+
+class ProfileView(QDialog):
+    """
+    func: 用表格显示每个ISP节点的耗时和内存
+    """
+    headers = ['节点', '耗时', 'CPU时间', '峰值内存', '输入', '输出']
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setWindowTitle('ISP节点耗时')
+        self.resize(720, 320)
+        self.table = QTableWidget(0, len(self.headers), self)
+        self.table.setHorizontalHeaderLabels(self.headers)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.table)
+        self.enable = True
+
+    def update_profile(self, records):
+        """
+        func: 更新表格，最后一行是总计
+        """
+        self.table.setRowCount(len(records) + 1)
+        for i, record in enumerate(records):
+            for j, text in enumerate(ispprofile.format_record(record)):
+                self.table.setItem(i, j, QTableWidgetItem(text))
+        self.table.setItem(len(records), 0, QTableWidgetItem('总计'))
+        self.table.setItem(len(records), 1, QTableWidgetItem(
+            '{:.3f}s'.format(sum(record['wall_time'] for record in records))))
+        self.table.setItem(len(records), 2, QTableWidgetItem(
+            '{:.3f}s'.format(sum(record['cpu_time'] for record in records))))
+
+    def closeEvent(self, event):
+        self.enable = False
+        return super().closeEvent(event)
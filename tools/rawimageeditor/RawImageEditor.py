@@ -1,15 +1,19 @@
-from PySide2.QtWidgets import QGraphicsView, QGraphicsScene, QMessageBox, QFileDialog
+from PySide2.QtWidgets import QGraphicsView, QGraphicsScene, QMessageBox, QFileDialog, QPushButton
 from PySide2.QtGui import QPixmap, Qt, QImage
-from components.customwidget import ImageView, critical_win
-from components.window import SubWindow
+from components.customwidget import ImageView, ImagePyramidItem, critical_win
+from components.window import SubWindow, CACHE_FILEPATH
 from tools.rawimageeditor.ui.rawimageeditor_window import Ui_ImageEditor
 from tools.rawimageeditor.RawImageParams import RawImageParams
 from tools.rawimageeditor.RawImageInfo import RawImageInfo
 from tools.rawimageeditor.isppipeline import IspPipeline
 from components.histview import HistView
+from tools.rawimageeditor.ProfileView import ProfileView
 import numpy as np
 import os
 
+# 超过这个像素数的图像只转换当前视窗里的区域进行显示，移动和缩放的时候再转换新的区域
+VIEWPORT_MIN_PIXELS = 16 << 20
+
 
 class RawImageEditor(SubWindow):
     def __init__(self, name='RawImageEditor', parent=None):
@@ -21,18 +25,25 @@ class RawImageEditor(SubWindow):
         self.img_params = self.load_params(RawImageParams())
         self.img_pipeline = IspPipeline(
             self.img_params, process_bar=self.progress_bar)
+        # ISP的结果缓存到磁盘，下次打开时参数没有变化就不需要重新处理
+        self.img_pipeline.set_disk_cache(os.path.join(CACHE_FILEPATH, 'isp_cache'))
         self.img = RawImageInfo()
         self.point_data = np.array([0])
         self.scale_ratio = 100
         self.show_img = None
+        # 大图按视窗显示时的图像项，以及已经转换的区域(y0, y1, x0, x1, step)
+        self.view_pixmap = None
+        self.view_region = None
         self.select_awb = False
         self.histView = None
+        self.profileView = None
 
         # 由于graphicsView被自定义了，需要重新定义一下UI，gridlayout还需要重新加一下widget
         self.ui.graphicsView.addWidget(self.imageview, 0, 1, 3, 1)
         self.imageview.sigDragEvent.connect(self.__init_img)
         self.imageview.sigMouseMovePoint.connect(self.show_point_rgb)
         self.imageview.sigWheelEvent.connect(self.update_wheel_ratio)
+        self.imageview.sigViewportChanged.connect(self.update_viewport)
         # 回调函数初始化
         self.ui.pipeline.doubleClicked.connect(self.update_img_index)
         self.ui.pipeline_ok.clicked.connect(self.update_pipeline)
@@ -51,6 +62,21 @@ class RawImageEditor(SubWindow):
         self.img_pipeline.ispProcthread.costTimeCB.connect(
             self.update_time_bar)
         self.img_pipeline.ispProcthread.errorCB.connect(self.error_report)
+        self.img_pipeline.ispProcthread.previewCB.connect(self.update_preview)
+        self.img_pipeline.ispProcthread.profileCB.connect(self.update_profile)
+        # 状态栏上的按钮打开每个节点的耗时统计
+        self.profile_button = QPushButton('节点耗时')
+        self.profile_button.clicked.connect(self.openProfileView)
+        self.ui.statusBar.addPermanentWidget(self.profile_button)
+        # 后台预先编译numba函数，第一次运行ISP就不会卡住
+        self.img_pipeline.warmup_jit()
+
+    def closeEvent(self, event):
+        """
+        func: 关闭窗口时先停止ISP处理线程
+        """
+        self.img_pipeline.stop()
+        super().closeEvent(event)
 
     def error_report(self, value):
         """
@@ -64,6 +90,21 @@ class RawImageEditor(SubWindow):
         """
         self.displayImage(self.img_pipeline.get_image(-1))
 
+    def update_preview(self):
+        """
+        func: 低分辨率预览的显示回调，放大到原图的大小显示，全分辨率处理完成后会被替换
+        """
+        img, factor = self.img_pipeline.get_preview_image()
+        if (img is not None):
+            self.displayImage(img, factor)
+
+    def update_profile(self):
+        """
+        func: 每个节点的耗时统计更新回调
+        """
+        if (self.profileView is not None and self.profileView.enable is True):
+            self.profileView.update_profile(self.img_pipeline.get_profile())
+
     def update_process_bar(self, value):
         """
         func: ISP 处理进度回调
@@ -90,21 +131,88 @@ class RawImageEditor(SubWindow):
             self.rect = [0, 0, self.img_params.rawformat.width,
                          self.img_params.rawformat.height]
 
-    def displayImage(self, img):
+    def displayImage(self, img, scale=1):
         """
         显示图像 输入需要是RawImageInfo
+        scale不为1时是低分辨率的预览，放大scale倍显示，像素值和直方图仍然使用之前的全分辨率图像
         """
         self.scene.clear()
-        self.img = img
-        self.show_img = img.get_showimage()
-        if(self.show_img is not None):
-            showimg = QImage(self.show_img, self.show_img.shape[1],
-                             self.show_img.shape[0], QImage.Format_BGR888)
-            self.scene.addPixmap(QPixmap(showimg))
+        self.view_pixmap = None
+        if (scale == 1 and img.get_raw_data() is not None and img.get_height() * img.get_width() > VIEWPORT_MIN_PIXELS):
+            self.display_viewport(img)
+            return
+        show_img = img.get_showimage()
+        if (scale == 1):
+            self.img = img
+            self.show_img = show_img
+        if(show_img is not None):
+            item = ImagePyramidItem(show_img)
+            item.setScale(scale)
+            self.scene.addItem(item)
+            self.scene.setSceneRect(0, 0, show_img.shape[1] * scale, show_img.shape[0] * scale)
             self.ui.photo_title.setTitle(img.get_name())
-            if(self.histView is not None and self.histView.enable is True):
+            if(scale == 1 and self.histView is not None and self.histView.enable is True):
                 self.histView.update_rect_data(self.show_img, self.rect)
 
+    def display_viewport(self, img):
+        """
+        func: 大图只转换当前视窗里的区域显示，整幅图的显示图像在需要直方图的时候才转换
+        """
+        self.img = img
+        self.show_img = None
+        self.scene.setSceneRect(0, 0, img.get_width(), img.get_height())
+        self.view_pixmap = self.scene.addPixmap(QPixmap())
+        self.view_region = None
+        self.update_viewport()
+        self.ui.photo_title.setTitle(img.get_name())
+        if(self.histView is not None and self.histView.enable is True):
+            self.histView.update_rect_data(self.get_show_img(), self.rect)
+
+    def update_viewport(self):
+        """
+        func: 视窗变化的回调，转换视窗以及周围半个视窗的区域，缩小显示的时候隔点取样
+        已经转换过的区域包含了视窗并且缩放倍数不变时，不需要重新转换
+        """
+        if (self.view_pixmap is None):
+            return
+        rect = self.imageview.get_visible_rect()
+        height, width = self.img.get_height(), self.img.get_width()
+        step = max(1, int(1 / self.imageview.scale_ratio))
+        raw = self.img.get_color_space() == "raw"
+        if (raw and step > 1):
+            step = step // 2 * 2
+        if (self.view_region is not None):
+            y0, y1, x0, x1, old_step = self.view_region
+            if (old_step == step and y0 <= max(0, rect.top()) and x0 <= max(0, rect.left())
+                    and y1 >= min(height, rect.bottom()) and x1 >= min(width, rect.right())):
+                return
+        margin_y, margin_x = int(rect.height() / 2), int(rect.width() / 2)
+        y0 = max(0, int(rect.top()) - margin_y)
+        y1 = min(height, int(rect.bottom()) + 1 + margin_y)
+        x0 = max(0, int(rect.left()) - margin_x)
+        x1 = min(width, int(rect.right()) + 1 + margin_x)
+        if (y1 <= y0 or x1 <= x0):
+            return
+        show_img, y0, x0 = self.img.get_showimage_region(y0, y1, x0, x1, step)
+        if (show_img is None):
+            return
+        self.view_region = (y0, y1, x0, x1, step)
+        show_img = np.ascontiguousarray(show_img)
+        showimg = QImage(show_img, show_img.shape[1], show_img.shape[0],
+                         show_img.shape[1] * 3, QImage.Format_BGR888)
+        self.view_pixmap.setPixmap(QPixmap(showimg))
+        self.view_pixmap.setPos(x0, y0)
+        # raw图隔点取样时每step个点保留了一个2x2的bayer单元
+        self.view_pixmap.setScale(step / 2 if raw and step > 1 else step)
+
+    def get_show_img(self):
+        """
+        func: 获取整幅图的显示图像，大图按视窗显示时，在这里才进行转换(转换结果会缓存在图像中)
+        """
+        if (self.show_img is None and self.img.get_raw_data() is not None):
+            self.show_img = self.img.get_showimage()
+        return self.show_img
+
     def select_awb_from_raw(self):
         """
         func: 进入raw图选择模式，修改鼠标类型
@@ -132,7 +240,7 @@ class RawImageEditor(SubWindow):
                     critical_win("请在raw图上进行选择")
             else:
                 if(self.histView is not None):
-                    self.histView.update_rect_data(self.show_img, self.rect)
+                    self.histView.update_rect_data(self.get_show_img(), self.rect)
         else:
             self.rect = [int(fromScenePoint.x()), int(fromScenePoint.y()), int(
                 toScenePoint.x()), int(toScenePoint.y())]
@@ -225,6 +333,17 @@ class RawImageEditor(SubWindow):
 
     def openHistView(self):
         self.histView = HistView(self.imageview)
-        rect = [0, 0, self.show_img.shape[1], self.show_img.shape[0]]
-        self.histView.update_rect_data(self.show_img, rect)
+        show_img = self.get_show_img()
+        rect = [0, 0, show_img.shape[1], show_img.shape[0]]
+        self.histView.update_rect_data(show_img, rect)
         self.histView.show()
+
+    def openProfileView(self):
+        """
+        func: 打开每个节点的耗时统计表格，表格打开期间统计每个节点的峰值内存
+        """
+        self.img_pipeline.set_trace_memory(True)
+        self.profileView = ProfileView(self)
+        self.profileView.finished.connect(lambda: self.img_pipeline.set_trace_memory(False))
+        self.profileView.update_profile(self.img_pipeline.get_profile())
+        self.profileView.show()
@@ -1,5 +1,6 @@
 import numpy as np
 import cv2
+import tools.rawimageeditor.rawunpack as rawunpack
 
 # =============================================================
 # class RawImageInfo:
@@ -16,39 +17,95 @@ class RawImageInfo():
     }
 
     def __init__(self):
-        self.data = None
+        # 以内存映射方式加载时，原始的uint16数据(packed格式为解包后的数据)，在用到的时候才转换成处理的数据类型
+        self.__raw_map = None
+        self.__data = None
         self.show_data = None  # 用来显示图像
+        # show_data对应的数据和属性，没有变化时直接使用show_data，不需要重新转换
+        self.__show_key = None
+        # pipeline节点缓存使用的key，由ISPProc设置
+        self.cache_key = None
         self.__color_space = "raw"
         self.__bayer_pattern = "rggb"
         self.__raw_bit_depth = 12
         # 默认以14位进行处理
         self.__bit_depth = 14
         self.max_data = 4095
-        # 后续的ISP算法处理基本仅支持float类型，int类型不予以支持，但是保留了接口
+        # 默认用float类型处理，定点模式下raw和RGB为uint16，YCrCb为int32，数据对齐为14bit
         self.dtype = np.float32
 
-    def load_image(self, filename, height, width, bit_depth):
+    def load_image(self, filename, height, width, bit_depth, offset=0, stride=0, mmap=False, raw_format="UNPACKED"):
         """
         function: 加载图像
-        input: 图像宽高和位深
+        input: 图像宽高和位深，offset是文件头的字节数，stride是每一行的字节数(0表示没有填充)
+        mmap为True时以内存映射的方式打开，只有在用到数据的时候才进行类型转换，
+        get_region可以只转换一部分区域
+        raw_format是raw图的存储格式，见rawunpack.RAW_FORMATS
         brief: 由于RAW图不同的bit深度，同样的ISP流程会导致出来的亮度不一样
         所以在RawImageInfor将原始raw图统一对齐为14bit
         """
         if(height > 0 and width > 0):
-            self.data = np.fromfile(
-                filename, dtype="uint16", sep="")[:height*width].reshape((height, width))
-
-        if (self.data is not None):
-            self.name = filename.split('/')[-1]
-            self.data = self.data.astype(self.dtype)
+            # 只映射需要的height行数据，不读取文件中多余的部分，packed格式会先解包成uint16
+            raw_map = rawunpack.map_frame(filename, height, width, bit_depth, raw_format, offset, stride)
             self.__raw_bit_depth = bit_depth
+            if (mmap is True):
+                self.__raw_map = raw_map
+                self.__data = None
+            else:
+                self.data = self.__convert(raw_map)
+            self.name = filename.split('/')[-1]
             if(np.issubdtype(self.dtype, np.integer)):
-                if (bit_depth < 14):
-                    self.data = np.left_shift(self.data, self.__bit_depth - bit_depth)
                 self.max_data = (1 << self.__bit_depth) - 1
             else:
                 self.max_data = (1 << self.__raw_bit_depth) - 1
 
+    def __convert(self, raw_map):
+        """
+        function: 把原始的uint16数据转换成处理的数据类型
+        """
+        data = raw_map.astype(self.dtype)
+        if(np.issubdtype(self.dtype, np.integer)):
+            if (self.__raw_bit_depth < 14):
+                data = np.left_shift(data, self.__bit_depth - self.__raw_bit_depth)
+            elif (self.__raw_bit_depth > 14):
+                data = np.right_shift(data, self.__raw_bit_depth - self.__bit_depth)
+        return data
+
+    @property
+    def data(self):
+        if (self.__data is None and self.__raw_map is not None):
+            self.__data = self.__convert(self.__raw_map)
+            self.__raw_map = None
+        return self.__data
+
+    @data.setter
+    def data(self, value):
+        self.__data = value
+        self.__raw_map = None
+        self.invalidate_show()
+
+    def invalidate_show(self):
+        """
+        function: 原地修改了数据之后，需要调用这个函数，让显示的缓存失效
+        """
+        self.show_data = None
+        self.__show_key = None
+
+    def get_raw_map(self):
+        """
+        function: 获取还没有转换的原始uint16数据，如果已经转换过了或者不是内存映射加载的，返回None
+        """
+        return self.__raw_map
+
+    def get_region(self, y0, y1, x0, x1):
+        """
+        function: 获取图像一个区域的数据
+        brief: 内存映射加载的图像，只转换这个区域，不会转换整幅图像
+        """
+        if (self.__data is None and self.__raw_map is not None):
+            return self.__convert(self.__raw_map[y0:y1, x0:x1])
+        return self.data[y0:y1, x0:x1]
+
     def create_image(self, name, raw, init_value=True, depth=1):
         """
         function: 根据原来的图像，创建一个空图像
@@ -77,30 +134,113 @@ class RawImageInfo():
     def save_image(self, filename):
         # cv2.imwrite(filename, self.nowImage)
         # 解决中文路径的问题
-        cv2.imencode('.jpg', self.show_data)[1].tofile(filename)
+        cv2.imencode('.jpg', self.get_showimage())[1].tofile(filename)
 
     def get_raw_data(self):
         return self.data
 
+    def crop_image(self, y0, y1, x0, x1):
+        """
+        function: 截取图像的一个矩形区域
+        brief: 返回的图像和原图共享内存，属性与原图相同。
+        如果是raw图，y0和x0需要是偶数，这样bayer pattern才不会变
+        """
+        ret_img = RawImageInfo()
+        ret_img.create_image(self.name, self, init_value=False)
+        ret_img.data = self.get_region(y0, y1, x0, x1)
+        ret_img.set_color_space(self.__color_space)
+        ret_img.max_data = self.max_data
+        return ret_img
+
+    def to_float(self):
+        """
+        function: 把定点图像转换为float图像
+        brief: 数据缩放回原始raw图的位深，与float模式下的数值范围一致，用于还没有定点实现的ISP算法
+        """
+        ret_img = RawImageInfo()
+        ret_img.create_image(self.name, self, init_value=False)
+        ret_img.dtype = np.float32
+        ret_img.data = self.data.astype(np.float32)
+        ret_img.data *= np.float32(2.0 ** (self.__raw_bit_depth - self.__bit_depth))
+        ret_img.set_color_space(self.__color_space)
+        ret_img.max_data = (1 << self.__raw_bit_depth) - 1
+        return ret_img
+
+    def to_fixed(self):
+        """
+        function: 把float图像四舍五入转换为定点图像，数据对齐为14bit
+        """
+        ret_img = RawImageInfo()
+        ret_img.create_image(self.name, self, init_value=False)
+        ret_img.dtype = np.int32 if self.__color_space == "YCrCb" else np.uint16
+        ret_img.set_color_space(self.__color_space)
+        ret_img.max_data = (1 << self.__bit_depth) - 1
+        ret_img.data = np.rint(self.data * (2.0 ** (self.__bit_depth - self.__raw_bit_depth))).astype(np.int32)
+        ret_img.clip_range()
+        ret_img.data = ret_img.data.astype(ret_img.dtype, copy=False)
+        return ret_img
+
     def get_showimage(self):
         """
         function: convert to QImage
         brief: 把图像转换为用于显示的正常图像
+        转换的结果会缓存下来，数据和显示相关的属性没有变化时，重复调用不会重新转换
         """
         if(self.data is not None):
-            if (self.__color_space == "raw"):
-                self.show_data = self.convert_bayer2color()
-            elif (self.__color_space == "RGB"):
-                self.show_data = self.convert_to_8bit()
-            elif (self.__color_space == "YCrCb"):
-                ratio = 256/(self.max_data + 1)
-                tmp = cv2.cvtColor(self.data, cv2.COLOR_YCrCb2BGR)
-                tmp = np.clip(tmp, 0, self.max_data)
-                self.show_data = np.uint8(ratio * tmp)
+            key = self.__get_show_key()
+            if (self.show_data is None or self.__show_key != key):
+                self.show_data = self.convert_to_show(self.data)
+                self.__show_key = key
             return self.show_data
         else:
             return None
 
+    def get_showimage_region(self, y0, y1, x0, x1, step=1):
+        """
+        function: 只转换显示图像的一个区域，每step个点取一个点
+        brief: 用于大图只显示当前视窗的内容，已经有整幅图的显示缓存时直接截取
+        raw图的区域起点会对齐到偶数，step大于1时每step个点取一个2x2的bayer单元，pattern不变
+        ret: (显示图像, 对齐之后的y0, x0)
+        """
+        if (self.__color_space == "raw"):
+            y0, x0 = y0 // 2 * 2, x0 // 2 * 2
+        if (self.show_data is not None and self.__show_key == self.__get_show_key()):
+            return self.subsample_show(self.show_data[y0:y1, x0:x1], step), y0, x0
+        region = self.subsample_show(self.get_region(y0, y1, x0, x1), step)
+        if (region.size == 0):
+            return None, y0, x0
+        return self.convert_to_show(region), y0, x0
+
+    def subsample_show(self, data, step):
+        """
+        function: 每step个点取一个点，raw图取2x2的bayer单元
+        """
+        if (step <= 1):
+            return data
+        if (self.__color_space != "raw"):
+            return data[::step, ::step]
+        rows = (np.arange(0, data.shape[0] - 1, step)[:, None] + [0, 1]).ravel()
+        cols = (np.arange(0, data.shape[1] - 1, step)[:, None] + [0, 1]).ravel()
+        return data[rows][:, cols]
+
+    def convert_to_show(self, data):
+        """
+        function: 把数据转换为8位BGR的显示图像，data可以是图像的一个区域，raw图的区域起点需要是偶数
+        """
+        if (self.__color_space == "raw"):
+            return self.convert_bayer2color(data)
+        elif (self.__color_space == "RGB"):
+            return self.convert_to_8bit(data)
+        elif (self.__color_space == "YCrCb"):
+            ratio = 256/(self.max_data + 1)
+            tmp = cv2.cvtColor(data.astype(np.float32, copy=False), cv2.COLOR_YCrCb2BGR)
+            tmp = np.clip(tmp, 0, self.max_data)
+            return np.uint8(ratio * tmp)
+        return None
+
+    def __get_show_key(self):
+        return (id(self.__data), self.__color_space, self.__bayer_pattern, self.get_bit_depth(), self.max_data)
+
     def set_name(self, name):
         self.name = name
 
@@ -108,13 +248,15 @@ class RawImageInfo():
         return self.name
 
     def get_size(self):
+        if (self.__data is None and self.__raw_map is not None):
+            return self.__raw_map.shape
         return self.data.shape
 
     def get_width(self):
-        return self.data.shape[1]
+        return self.get_size()[1]
 
     def get_height(self):
-        return self.data.shape[0]
+        return self.get_size()[0]
 
     def get_depth(self):
         if np.ndim(self.data) > 2:
@@ -150,6 +292,9 @@ class RawImageInfo():
         """
         return self.__raw_bit_depth
 
+    def set_raw_bit_depth(self, raw_bit_depth):
+        self.__raw_bit_depth = raw_bit_depth
+
     def get_img_point(self, x, y):
         """
         获取图像中一个点的亮度值，注意颜色顺序是BGR
@@ -158,11 +303,12 @@ class RawImageInfo():
         如果是YUV，获取的就是YCRCB
         """
         if(x > 0 and x < self.get_width() and y > 0 and y < self.get_height()):
+            point = self.get_region(y, y + 1, x, x + 1)[0, 0]
             if(np.issubdtype(self.dtype, np.integer)):
                 right_shift_num = self.__bit_depth - self.__raw_bit_depth
-                return np.right_shift(self.data[y, x], right_shift_num)
+                return np.right_shift(point, right_shift_num)
             else:
-                return np.int32(self.data[y, x])
+                return np.int32(point)
         else:
             return None
 
@@ -172,7 +318,11 @@ class RawImageInfo():
     def clip_range(self):
         if(self.__color_space == "YCrCb"):
             self.data[:,:,0] = np.clip(self.data[:,:,0], 0, self.max_data)
-            self.data[:,:,1:] = np.clip(self.data[:,:,1:], -self.max_data/2, self.max_data/2)
+            if(np.issubdtype(self.data.dtype, np.integer)):
+                self.data[:,:,1:] = np.clip(self.data[:,:,1:], -(self.max_data + 1)//2, self.max_data//2)
+            else:
+                self.data[:,:,1:] = np.clip(self.data[:,:,1:], -self.max_data/2, self.max_data/2)
+            self.invalidate_show()
         else:
             self.data = np.clip(self.data, 0, self.max_data)
 
@@ -240,41 +390,46 @@ class RawImageInfo():
 
         return data
 
-    def convert_bayer2color(self):
+    def convert_bayer2color(self, raw_data=None):
         """
         function: convert bayer to color
         brief: 将bayer用8位的rgb显示，不进行demosaic
+        raw_data为None时转换整幅图像
         """
+        if (raw_data is None):
+            raw_data = self.data
         data = np.zeros(
-            (self.get_height(), self.get_width(), 3), dtype="uint8")
+            (raw_data.shape[0], raw_data.shape[1], 3), dtype="uint8")
         if (self.__bayer_pattern == "rggb" or self.__bayer_pattern == "grbg" 
             or self.__bayer_pattern == "gbrg" or self.__bayer_pattern == "bggr"):
             if(np.issubdtype(self.dtype, np.integer)):
                 right_shift_num = self.get_bit_depth() - 8
                 for channel, (y, x) in zip(self.__bayer_pattern, [(0, 0), (0, 1), (1, 0), (1, 1)]):
                     data[y::2, x::2, self.rgb_pattern_dict[channel]] = np.right_shift(
-                        self.data[y::2, x::2], right_shift_num)
+                        raw_data[y::2, x::2], right_shift_num)
             else:
                 ratio = 256/(self.max_data + 1)
                 for channel, (y, x) in zip(self.__bayer_pattern, [(0, 0), (0, 1), (1, 0), (1, 1)]):
                     data[y::2, x::2, self.rgb_pattern_dict[channel]
-                            ] = np.uint8(self.data[y::2, x::2] * ratio)
+                            ] = np.uint8(raw_data[y::2, x::2] * ratio)
             return data
         else:
             print("pattern must be one of these: rggb, grbg, gbrg, bggr")
             return None
 
-    def convert_to_8bit(self):
+    def convert_to_8bit(self, rgb_data=None):
+        if (rgb_data is None):
+            rgb_data = self.data
         data = np.zeros(
-            (self.get_height(), self.get_width(), 3), dtype="uint8")
+            (rgb_data.shape[0], rgb_data.shape[1], 3), dtype="uint8")
         if(np.issubdtype(self.dtype, np.integer)):
             right_shift_num = self.get_bit_depth() - 8
-            data[:, :, 0] = np.right_shift(self.data[:, :, 0], right_shift_num)
-            data[:, :, 1] = np.right_shift(self.data[:, :, 1], right_shift_num)
-            data[:, :, 2] = np.right_shift(self.data[:, :, 2], right_shift_num)
+            data[:, :, 0] = np.right_shift(rgb_data[:, :, 0], right_shift_num)
+            data[:, :, 1] = np.right_shift(rgb_data[:, :, 1], right_shift_num)
+            data[:, :, 2] = np.right_shift(rgb_data[:, :, 2], right_shift_num)
         else:
             ratio = 256/(self.max_data + 1)
-            data = np.uint8(ratio * self.data)
+            data = np.uint8(ratio * rgb_data)
         return data
     
     def convert_to_gray(self):
@@ -1,13 +1,13 @@
 # =============================================================
 # Import the libraries
 # =============================================================
+from __future__ import annotations
+from typing import TYPE_CHECKING
 import numpy as np  # array operations
-from PySide2.QtGui import QImage
-from PySide2.QtCore import Qt
-from PySide2.QtWidgets import QFileDialog
-from tools.rawimageeditor.ui.rawimageeditor_window import Ui_ImageEditor
-from components.customwidget import critical_win
 import cv2
+# 参数类需要在没有Qt的环境下使用(比如批处理)，界面相关的模块只在用到的时候导入
+if TYPE_CHECKING:
+    from tools.rawimageeditor.ui.rawimageeditor_window import Ui_ImageEditor
 
 
 class CscParams():
@@ -18,7 +18,7 @@ class CscParams():
     contrast = 50
     hue = 50
     satu = 50
-    limitrange = Qt.Unchecked
+    limitrange = 0  # Qt.Unchecked
     colorspace = 'BT709'
     need_flush = False
     name = 'CSC'
@@ -33,7 +33,7 @@ class CscParams():
         ui.saturation.setValue(self.satu)
         index = ui.color_space.findText(self.colorspace)
         ui.color_space.setCurrentIndex(index)
-        ui.limitrange.setCheckState(self.limitrange)
+        ui.limitrange.setChecked(self.limitrange == 2)
 
     def get(self, ui: Ui_ImageEditor):
         """
@@ -44,7 +44,7 @@ class CscParams():
         self.set_satu(ui.saturation.value())
         self.set_luma(ui.luma.value())
         self.set_colorspace(ui.color_space.currentText())
-        self.set_limitrange(ui.limitrange.checkState())
+        self.set_limitrange(int(ui.limitrange.checkState()))
         return self.need_flush
 
     def set_luma(self, value):
@@ -88,11 +88,34 @@ class FormatParams():
     height = 0
     width = 0
     bit_depth = 0
-    raw_format = "MIPI"
+    # raw图的存储格式，见rawunpack.RAW_FORMATS
+    raw_format = "UNPACKED"
     pattern = "rggb"
     name = 'original raw'
     need_flush = False
     filename = ''
+    # 文件头的字节数，以及每一行的字节数(0表示行与行之间没有填充)
+    offset = 0
+    stride = 0
+    # 以内存映射的方式加载，用到的时候才进行数据转换
+    mmap = True
+    # 定点模式，raw和RGB用uint16，YCrCb用int32进行处理，与硬件ISP的定点实现对齐
+    fixed_point = False
+    # 保存的参数的版本，1: raw_format的MIPI表示16bit非压缩的格式(现在的UNPACKED)，2: MIPI表示CSI-2 packed格式
+    format_version = 2
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['format_version'] = FormatParams.format_version
+        return state
+
+    def __setstate__(self, state):
+        """
+        func: 加载保存的参数，旧版本参数中的MIPI转换成UNPACKED，避免按packed格式错误地解包
+        """
+        if (state.get('format_version', 1) < 2 and state.get('raw_format') == "MIPI"):
+            state['raw_format'] = "UNPACKED"
+        self.__dict__.update(state)
 
     def set(self, ui: Ui_ImageEditor):
         ui.width.setValue(self.width)
@@ -143,6 +166,26 @@ class FormatParams():
             self.filename = value
             self.need_flush = True
 
+    def set_offset(self, value):
+        if(self.offset != value):
+            self.offset = value
+            self.need_flush = True
+
+    def set_stride(self, value):
+        if(self.stride != value):
+            self.stride = value
+            self.need_flush = True
+
+    def set_mmap(self, value):
+        if(self.mmap != value):
+            self.mmap = value
+            self.need_flush = True
+
+    def set_fixed_point(self, value):
+        if(self.fixed_point != value):
+            self.fixed_point = value
+            self.need_flush = True
+
 
 class DemosaicParams():
     """
@@ -217,16 +260,23 @@ class LTMParams():
     """
     __dark_boost = 100
     __bright_suppress = 100
+    # guided LTM的局部均值半径(像素)和强度(%)
+    __radius = 64
+    __strength = 100
     need_flush = False
     name = 'LTM'
 
     def set(self, ui: Ui_ImageEditor):
         ui.dark_boost.setValue(self.get_dark_boost())
         ui.bright_suppress.setValue(self.get_bright_suppress())
+        ui.ltm_radius.setValue(self.get_radius())
+        ui.ltm_strength.setValue(self.get_strength())
 
     def get(self, ui: Ui_ImageEditor):
         self.set_dark_boost(ui.dark_boost.value())
         self.set_bright_suppress(ui.bright_suppress.value())
+        self.set_radius(ui.ltm_radius.value())
+        self.set_strength(ui.ltm_strength.value())
         return self.need_flush
 
     def set_dark_boost(self, value):
@@ -248,6 +298,28 @@ class LTMParams():
     def get_bright_suppress(self):
         return self.__bright_suppress
 
+    def set_radius(self, value):
+        """
+        设置guided LTM计算局部均值的半径
+        """
+        if(value != self.__radius):
+            self.need_flush = True
+            self.__radius = value
+
+    def get_radius(self):
+        return self.__radius
+
+    def set_strength(self, value):
+        """
+        设置guided LTM的强度，100时和LTM的曲线相同
+        """
+        if(value != self.__strength):
+            self.need_flush = True
+            self.__strength = value
+
+    def get_strength(self):
+        return self.__strength
+
 
 class AWBParams():
     need_flush = False
@@ -319,8 +391,11 @@ class GammaParams():
     need_flush = False
     name = 'gamma'
     __gamma_ratio = 2.2
-    # gamma 查找表的长度
-    gamma_table_size = 512
+    # 自定义gamma曲线，硬件的1025个节点，归一化到[0, 1]，None表示使用gamma值
+    __gamma_curve = None
+    gamma_curve_file = ''
+    # 硬件gamma曲线的节点数
+    gamma_curve_size = 1025
 
     def set(self, ui: Ui_ImageEditor):
         ui.gamma_ratio.setValue(self.get_gamma_ratio())
@@ -340,6 +415,33 @@ class GammaParams():
     def get_gamma_ratio(self):
         return self.__gamma_ratio
 
+    def load_gamma_curve(self, filename):
+        """
+        导入自定义gamma曲线，文件中是用空格、逗号或者换行分隔的1025个节点，
+        节点的值按照最大值所在的位深归一化，比如最大值是4095，就按照12bit进行归一化
+        """
+        with open(filename, 'r') as fp:
+            curve = np.array(fp.read().replace(',', ' ').split(), dtype=np.float64)
+        if (len(curve) != self.gamma_curve_size):
+            raise ValueError("gamma曲线需要{}个节点，文件中有{}个".format(self.gamma_curve_size, len(curve)))
+        max_value = max((1 << int(np.ceil(np.log2(curve.max() + 1)))) - 1, 1)
+        self.set_gamma_curve(curve / max_value)
+        self.gamma_curve_file = filename
+
+    def set_gamma_curve(self, curve):
+        """
+        设置自定义gamma曲线，curve为None时使用gamma值
+        """
+        if (curve is not None):
+            curve = tuple(float(value) for value in curve)
+        if(curve != self.__gamma_curve):
+            self.__gamma_curve = curve
+            self.gamma_curve_file = ''
+            self.need_flush = True
+
+    def get_gamma_curve(self):
+        return self.__gamma_curve
+
 
 class CCMParams():
     need_flush = False
@@ -383,6 +485,10 @@ class BPCParams():
     need_flush = False
     name = 'bad pixel correction'
     __neighborhood_size_for_bad_pixel_correction = 0
+    # dynamic: 检测每个像素，static: 只矫正坏点表中的像素
+    __mode = 'dynamic'
+    __defect_table = None
+    defect_table_file = ''
 
     def set_size_for_bad_pixel_correction(self, value):
         """
@@ -396,6 +502,48 @@ class BPCParams():
     def get_size_for_bad_pixel_correction(self):
         return self.__neighborhood_size_for_bad_pixel_correction * 2 + 3
 
+    def set_mode(self, mode):
+        if (mode not in ('dynamic', 'static')):
+            raise ValueError("不支持的坏点矫正模式: {}".format(mode))
+        if(mode != self.__mode):
+            self.__mode = mode
+            self.need_flush = True
+
+    def get_mode(self):
+        return self.__mode
+
+    def load_defect_table(self, filename):
+        """
+        导入sensor的坏点表，每一行是一个坏点的全分辨率坐标"x y"，可以用空格或者逗号分隔，#开头的是注释
+        导入后切换到static模式
+        """
+        table = []
+        with open(filename, 'r') as fp:
+            for line_no, line in enumerate(fp, 1):
+                line = line.split('#')[0].replace(',', ' ').split()
+                if (len(line) == 0):
+                    continue
+                if (len(line) != 2):
+                    raise ValueError("坏点表第{}行格式错误，需要x y两个坐标".format(line_no))
+                table.append((int(line[0]), int(line[1])))
+        self.set_defect_table(table)
+        self.defect_table_file = filename
+        self.set_mode('static')
+
+    def set_defect_table(self, table):
+        """
+        设置坏点表，table是(x, y)坐标的列表
+        """
+        if (table is not None):
+            table = tuple((int(x), int(y)) for x, y in table)
+        if(table != self.__defect_table):
+            self.__defect_table = table
+            self.defect_table_file = ''
+            self.need_flush = True
+
+    def get_defect_table(self):
+        return self.__defect_table
+
     def set(self, ui: Ui_ImageEditor):
         ui.badpixelcorrection.setValue(
             self.__neighborhood_size_for_bad_pixel_correction)
@@ -420,6 +568,8 @@ class RolloffParams():
         self.blc = blc
 
     def set_flatphoto(self):
+        from PySide2.QtWidgets import QFileDialog
+        from components.customwidget import critical_win
         self.flatphoto = np.zeros(
             (self.rawformat.height, self.rawformat.width), dtype=np.float32)
         imagepath = QFileDialog.getOpenFileName(
@@ -591,6 +741,11 @@ class DigitalGainParams():
 
 
 class RawImageParams():
+    # 分块处理时当前分块左上角在整帧中的坐标(行, 列)，整帧处理时是(0, 0)
+    tile_origin = (0, 0)
+    # 低分辨率预览时图像缩小的倍数，节点中以像素为单位的空间常数(比如滤波的sigma)需要除以这个倍数
+    pixel_scale = 1
+
     def __init__(self):
         """
         zh
@@ -1,8 +1,8 @@
 import numpy as np
-import cv2
-from scipy.ndimage.filters import convolve, convolve1d
+from numba import jit
 from tools.rawimageeditor.RawImageParams import RawImageParams
 from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispfilter as ispfilter
 
 
 def demosaic(raw: RawImageInfo, params: RawImageParams):
@@ -29,6 +29,17 @@ def demosaic(raw: RawImageInfo, params: RawImageParams):
     return ret_img
 
 
+def bayer_positions(raw: RawImageInfo):
+    """
+    function: 每个颜色在2x2的bayer单元中的位置
+    ret: {'r': [(y, x)], 'g': [(y, x), (y, x)], 'b': [(y, x)]}
+    """
+    positions = dict((channel, []) for channel in 'rgb')
+    for channel, (y, x) in zip(raw.get_bayer_pattern(), [(0, 0), (0, 1), (1, 0), (1, 1)]):
+        positions[channel].append((y, x))
+    return positions
+
+
 def demosaicing_CFA_Bayer_bilinear(raw: RawImageInfo, output):
     """
     Bilinear Bayer CFA Demosaicing
@@ -39,9 +50,8 @@ def demosaicing_CFA_Bayer_bilinear(raw: RawImageInfo, output):
     -   :cite:`Losson2010c` : Losson, O., Macaire, L., & Yang, Y. (2010).
         Comparison of Color Demosaicing Methods. In Advances in Imaging and
         Electron Physics (Vol. 162, pp. 173-265). doi:10.1016/S1076-5670(10)62005-8
+    每个通道只把自己位置上的值拷贝到稀疏的平面上，不需要生成全图的mask再相乘
     """
-
-    R_m, G_m, B_m = raw.masks_CFA_Bayer()
     CFA = raw.get_raw_data()
 
     H_G = np.float32(
@@ -54,11 +64,12 @@ def demosaicing_CFA_Bayer_bilinear(raw: RawImageInfo, output):
          [2, 4, 2],
          [1, 2, 1]]) * 0.25
 
-    output[:, :, 2] = cv2.filter2D(CFA * R_m, -1, H_RB)
-    output[:, :, 1] = cv2.filter2D(CFA * G_m, -1, H_G)
-    output[:, :, 0] = cv2.filter2D(CFA * B_m, -1, H_RB)
-
-    del R_m, G_m, B_m, H_RB, H_G
+    for channel, index, kernel in [('r', 2, H_RB), ('g', 1, H_G), ('b', 0, H_RB)]:
+        plane = np.zeros(CFA.shape, dtype=CFA.dtype)
+        for y, x in bayer_positions(raw)[channel]:
+            plane[y::2, x::2] = CFA[y::2, x::2]
+        output[:, :, index] = ispfilter.filter2d(plane, kernel)
+        del plane
     return
 
 
@@ -72,10 +83,13 @@ def demosaicing_CFA_Bayer_Malvar2004(raw: RawImageInfo, output):
         Bayer-Patterned Color Images. International Conference of Acoustic, Speech
         and Signal Processing, 5-8.
         http://research.microsoft.com/apps/pubs/default.aspx?id=102068
+    每个滤波器只在需要它的1/4分辨率平面上取值，用步长为2的切片直接写到输出，
+    不需要生成全图的mask，也不需要np.where，四次滤波共用一张临时图
     """
-
-    R_m, G_m, B_m = raw.masks_CFA_Bayer()
     CFA = raw.get_raw_data()
+    positions = bayer_positions(raw)
+    (r_y, r_x), = positions['r']
+    (b_y, b_x), = positions['b']
 
     GR_GB = np.float32(
          [[0, 0, -1, 0, 0],
@@ -100,46 +114,33 @@ def demosaicing_CFA_Bayer_Malvar2004(raw: RawImageInfo, output):
          [0, 2, 0, 2, 0],
          [0, 0, -1.5, 0, 0]]) * 0.125
 
-    R = CFA * R_m
-    G = CFA * G_m
-    B = CFA * B_m
-
-    del G_m
-
-    G = np.where(np.logical_or(R_m == 1, B_m == 1), cv2.filter2D(CFA, -1, GR_GB), G)
-
-    RBg_RBBR = cv2.filter2D(CFA, -1, Rg_RB_Bg_BR)
-    RBg_BRRB = cv2.filter2D(CFA, -1, Rg_BR_Bg_RB)
-    RBgr_BBRR = cv2.filter2D(CFA, -1, Rb_BB_Br_RR)
-
-    del GR_GB, Rg_RB_Bg_BR, Rg_BR_Bg_RB, Rb_BB_Br_RR
-
-    # Red rows.
-    R_r = np.transpose(np.any(R_m == 1, axis=1)[np.newaxis]) * np.ones(R.shape, dtype=np.float32)
-    # Red columns.
-    R_c = np.any(R_m == 1, axis=0)[np.newaxis] * np.ones(R.shape, dtype=np.float32)
-    # Blue rows.
-    B_r = np.transpose(np.any(B_m == 1, axis=1)[np.newaxis]) * np.ones(B.shape, dtype=np.float32)
-    # Blue columns
-    B_c = np.any(B_m == 1, axis=0)[np.newaxis] * np.ones(B.shape, dtype=np.float32)
-
-    del R_m, B_m
-
-    R = np.where(np.logical_and(R_r == 1, B_c == 1), RBg_RBBR, R)
-    R = np.where(np.logical_and(B_r == 1, R_c == 1), RBg_BRRB, R)
-
-    B = np.where(np.logical_and(B_r == 1, R_c == 1), RBg_RBBR, B)
-    B = np.where(np.logical_and(R_r == 1, B_c == 1), RBg_BRRB, B)
-
-    R = np.where(np.logical_and(B_r == 1, B_c == 1), RBgr_BBRR, R)
-    B = np.where(np.logical_and(R_r == 1, R_c == 1), RBgr_BBRR, B)
-
-    del RBg_RBBR, RBg_BRRB, RBgr_BBRR, R_r, R_c, B_r, B_c
-
-    output[:, :, 2] = R
-    output[:, :, 1] = G
-    output[:, :, 0] = B
-    del R,G,B
+    # 原始的值
+    for y, x in positions['g']:
+        output[y::2, x::2, 1] = CFA[y::2, x::2]
+    output[r_y::2, r_x::2, 2] = CFA[r_y::2, r_x::2]
+    output[b_y::2, b_x::2, 0] = CFA[b_y::2, b_x::2]
+
+    # R和B位置的G
+    filtered = ispfilter.filter2d(CFA, GR_GB)
+    output[r_y::2, r_x::2, 1] = filtered[r_y::2, r_x::2]
+    output[b_y::2, b_x::2, 1] = filtered[b_y::2, b_x::2]
+
+    # 红色行的G位置的R，蓝色行的G位置的B
+    ispfilter.filter2d(CFA, Rg_RB_Bg_BR, dst=filtered)
+    output[r_y::2, b_x::2, 2] = filtered[r_y::2, b_x::2]
+    output[b_y::2, r_x::2, 0] = filtered[b_y::2, r_x::2]
+
+    # 蓝色行的G位置的R，红色行的G位置的B
+    ispfilter.filter2d(CFA, Rg_BR_Bg_RB, dst=filtered)
+    output[b_y::2, r_x::2, 2] = filtered[b_y::2, r_x::2]
+    output[r_y::2, b_x::2, 0] = filtered[r_y::2, b_x::2]
+
+    # B位置的R，R位置的B
+    ispfilter.filter2d(CFA, Rb_BB_Br_RR, dst=filtered)
+    output[b_y::2, b_x::2, 2] = filtered[b_y::2, b_x::2]
+    output[r_y::2, r_x::2, 0] = filtered[r_y::2, r_x::2]
+
+    del filtered, GR_GB, Rg_RB_Bg_BR, Rg_BR_Bg_RB, Rb_BB_Br_RR
     return
 
 
@@ -154,119 +155,184 @@ def demosaicing_CFA_Bayer_Menon2007(raw: RawImageInfo, output):
         Demosaicing With Directional Filtering and a posteriori Decision. IEEE
         Transactions on Image Processing, 16(1), 132-141.
         doi:10.1109/TIP.2006.884928
+    用numba逐点计算，每个点的颜色由2x2的bayer单元决定，不需要生成全图的mask，
+    临时数据只有水平和垂直方向的色差以及方向的选择，边界是镜像(mirror)扩展，
+    中间结果的精度和原来用scipy卷积的实现一致(卷积在float64中累加，结果保存为float32)
     """
-    R_m, G_m, B_m = raw.masks_CFA_Bayer()
-    CFA = raw.get_raw_data()
-    h_0 = np.array([0, 0.5, 0, 0.5, 0], dtype=np.float32)
-    h_1 = np.array([-0.25, 0, 0.5, 0, -0.25], dtype=np.float32)
+    CFA = np.ascontiguousarray(raw.get_raw_data(), dtype=np.float32)
+    colors = np.array(['rgb'.index(c) for c in raw.get_bayer_pattern()]).reshape(2, 2)
+
+    # 水平和垂直方向插值出G之后的色差，只有R和B位置有值，每一行只需要保存一半(x // 2)
+    C_H = np.empty((CFA.shape[0], (CFA.shape[1] + 1) // 2), dtype=np.float32)
+    C_V = np.empty(C_H.shape, dtype=np.float32)
+    menon_color_diff(CFA, colors, C_H, C_V)
+
+    # 根据色差的梯度选择G的插值方向，1为水平方向，0为垂直方向，G直接写到输出
+    M = np.empty(CFA.shape, dtype=np.uint8)
+    menon_green(CFA, colors, C_H, C_V, output[:, :, 1], M)
+    del C_H, C_V
+
+    menon_red_blue(CFA, colors, output, M)
+    del M
+    return
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def mirror_index(i, n):
+    """
+    镜像边界 (d c b | a b c d | c b a)
+    """
+    if (i < 0):
+        return -i
+    if (i >= n):
+        return 2 * n - 2 - i
+    return i
+
 
-    R = CFA * R_m
-    G = CFA * G_m
-    B = CFA * B_m
+@jit(nopython=True, nogil=True, cache=True)
+def menon_green_h(CFA, y, x):
+    """
+    水平方向插值的G: [0, 0.5, 0, 0.5, 0]和[-0.25, 0, 0.5, 0, -0.25]两个滤波结果相加
+    """
+    w = CFA.shape[1]
+    h_0 = (np.float64(CFA[y, mirror_index(x - 1, w)]) + np.float64(CFA[y, mirror_index(x + 1, w)])) * 0.5
+    h_1 = np.float64(CFA[y, x]) * 0.5 + \
+        (np.float64(CFA[y, mirror_index(x - 2, w)]) + np.float64(CFA[y, mirror_index(x + 2, w)])) * -0.25
+    return np.float32(h_0) + np.float32(h_1)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def menon_green_v(CFA, y, x):
+    """
+    垂直方向插值的G
+    """
+    h = CFA.shape[0]
+    h_0 = (np.float64(CFA[mirror_index(y - 1, h), x]) + np.float64(CFA[mirror_index(y + 1, h), x])) * 0.5
+    h_1 = np.float64(CFA[y, x]) * 0.5 + \
+        (np.float64(CFA[mirror_index(y - 2, h), x]) + np.float64(CFA[mirror_index(y + 2, h), x])) * -0.25
+    return np.float32(h_0) + np.float32(h_1)
 
-    G_H = np.where(G_m == 0, _cnv_h(CFA, h_0) + _cnv_h(CFA, h_1), G)
-    G_V = np.where(G_m == 0, _cnv_v(CFA, h_0) + _cnv_v(CFA, h_1), G)
 
-    C_H = np.where(R_m == 1, R - G_H, 0)
-    C_H = np.where(B_m == 1, B - G_H, C_H)
+@jit(nopython=True, nogil=True, cache=True)
+def menon_color_diff(CFA, colors, C_H, C_V):
+    """
+    R和B位置上的色差，保存在C_H[y, x // 2]中
+    """
+    for y in range(CFA.shape[0]):
+        for x in range(CFA.shape[1]):
+            if (colors[y & 1, x & 1] != 1):
+                C_H[y, x >> 1] = CFA[y, x] - menon_green_h(CFA, y, x)
+                C_V[y, x >> 1] = CFA[y, x] - menon_green_v(CFA, y, x)
 
-    C_V = np.where(R_m == 1, R - G_V, 0)
-    C_V = np.where(B_m == 1, B - G_V, C_V)
 
-    D_H = np.abs(C_H - np.pad(C_H, ((0, 0),
-                                    (0, 2)), mode=str('reflect'))[:, 2:])
-    D_V = np.abs(C_V - np.pad(C_V, ((0, 2),
-                                    (0, 0)), mode=str('reflect'))[2:, :])
+@jit(nopython=True, nogil=True, cache=True)
+def menon_gradient(C, h, w, y, x, dy, dx):
+    """
+    色差在(dy, dx)方向上相隔两个像素的差值，超出图像的部分为0
+    (y, x)和(y + dy, x + dx)都是R或者B的位置，色差在C[y, x // 2]
+    """
+    if (y < 0 or y >= h or x < 0 or x >= w):
+        return 0.0
+    return np.float64(np.abs(C[y, x >> 1] - C[mirror_index(y + dy, h), mirror_index(x + dx, w) >> 1]))
 
-    del h_0, h_1, CFA, C_V, C_H
 
-    k = np.array(
+@jit(nopython=True, nogil=True, cache=True)
+def menon_green(CFA, colors, C_H, C_V, G, M):
+    """
+    在R和B位置上，比较水平和垂直方向的梯度，选择梯度小的方向插值G
+    梯度的权重是
         [[0, 0, 1, 0, 1],
          [0, 0, 0, 1, 0],
          [0, 0, 3, 0, 3],
          [0, 0, 0, 1, 0],
-         [0, 0, 1, 0, 1]], dtype=np.float32)
-
-    d_H = convolve(D_H, k, mode='constant')
-    d_V = convolve(D_V, np.transpose(k), mode='constant')
-
-    del D_H, D_V
-
-    mask = d_V >= d_H
-    G = np.where(mask, G_H, G_V)
-    M = np.where(mask, 1, 0)
-
-    del d_H, d_V, G_H, G_V
-
-    # Red rows.
-    R_r = np.transpose(np.any(R_m == 1, axis=1)[np.newaxis]) * np.ones(R.shape, dtype=np.float32)
-    # Blue rows.
-    B_r = np.transpose(np.any(B_m == 1, axis=1)[np.newaxis]) * np.ones(B.shape, dtype=np.float32)
-
-    k_b = np.array([0.5, 0, 0.5], dtype=np.float32)
-
-    R = np.where(
-        np.logical_and(G_m == 1, R_r == 1),
-        G + _cnv_h(R, k_b) - _cnv_h(G, k_b),
-        R,
-    )
-
-    R = np.where(
-        np.logical_and(G_m == 1, B_r == 1) == 1,
-        G + _cnv_v(R, k_b) - _cnv_v(G, k_b),
-        R,
-    )
-
-    B = np.where(
-        np.logical_and(G_m == 1, B_r == 1),
-        G + _cnv_h(B, k_b) - _cnv_h(G, k_b),
-        B,
-    )
-
-    B = np.where(
-        np.logical_and(G_m == 1, R_r == 1) == 1,
-        G + _cnv_v(B, k_b) - _cnv_v(G, k_b),
-        B,
-    )
-
-    R = np.where(
-        np.logical_and(B_r == 1, B_m == 1),
-        np.where(
-            M == 1,
-            B + _cnv_h(R, k_b) - _cnv_h(B, k_b),
-            B + _cnv_v(R, k_b) - _cnv_v(B, k_b),
-        ),
-        R,
-    )
-
-    B = np.where(
-        np.logical_and(R_r == 1, R_m == 1),
-        np.where(
-            M == 1,
-            R + _cnv_h(B, k_b) - _cnv_h(R, k_b),
-            R + _cnv_v(B, k_b) - _cnv_v(R, k_b),
-        ),
-        B,
-    )
-
-    del k_b, R_r, B_r
-
-    del M, R_m, G_m, B_m
-    output[:, :, 2] = R
-    output[:, :, 1] = G
-    output[:, :, 0] = B
-    del R,G,B
-    return
-
-def _cnv_h(x, y):
+         [0, 0, 1, 0, 1]]
+    和它的转置，累加的顺序与scipy的卷积一致
+    """
+    h, w = CFA.shape
+    for y in range(CFA.shape[0]):
+        for x in range(CFA.shape[1]):
+            if (colors[y & 1, x & 1] == 1):
+                G[y, x] = CFA[y, x]
+                M[y, x] = 1
+                continue
+            d_H = 0.0
+            d_H += menon_gradient(C_H, h, w, y - 2, x - 2, 0, 2)
+            d_H += menon_gradient(C_H, h, w, y - 2, x, 0, 2)
+            d_H += menon_gradient(C_H, h, w, y - 1, x - 1, 0, 2)
+            d_H += menon_gradient(C_H, h, w, y, x - 2, 0, 2) * 3
+            d_H += menon_gradient(C_H, h, w, y, x, 0, 2) * 3
+            d_H += menon_gradient(C_H, h, w, y + 1, x - 1, 0, 2)
+            d_H += menon_gradient(C_H, h, w, y + 2, x - 2, 0, 2)
+            d_H += menon_gradient(C_H, h, w, y + 2, x, 0, 2)
+            d_V = 0.0
+            d_V += menon_gradient(C_V, h, w, y - 2, x - 2, 2, 0)
+            d_V += menon_gradient(C_V, h, w, y - 2, x, 2, 0) * 3
+            d_V += menon_gradient(C_V, h, w, y - 2, x + 2, 2, 0)
+            d_V += menon_gradient(C_V, h, w, y - 1, x - 1, 2, 0)
+            d_V += menon_gradient(C_V, h, w, y - 1, x + 1, 2, 0)
+            d_V += menon_gradient(C_V, h, w, y, x - 2, 2, 0)
+            d_V += menon_gradient(C_V, h, w, y, x, 2, 0) * 3
+            d_V += menon_gradient(C_V, h, w, y, x + 2, 2, 0)
+            if (np.float32(d_V) >= np.float32(d_H)):
+                G[y, x] = menon_green_h(CFA, y, x)
+                M[y, x] = 1
+            else:
+                G[y, x] = menon_green_v(CFA, y, x)
+                M[y, x] = 0
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def menon_mean(img, y, x, c, dy, dx):
     """
-    Helper function for horizontal convolution.
+    (dy, dx)方向上相邻两个点的平均值，即[0.5, 0, 0.5]的滤波
     """
-    return convolve1d(x, y, mode='mirror')
+    h, w = img.shape[0], img.shape[1]
+    a = img[mirror_index(y - dy, h), mirror_index(x - dx, w), c]
+    b = img[mirror_index(y + dy, h), mirror_index(x + dx, w), c]
+    return np.float32((np.float64(a) + np.float64(b)) * 0.5)
 
 
-def _cnv_v(x, y):
+@jit(nopython=True, nogil=True, cache=True)
+def menon_red_blue(CFA, colors, output, M):
+    """
+    G已经在output[:, :, 1]中，先插值G位置上的R和B，再插值R位置上的B和B位置上的R
+    output通道顺序为BGR，colors中0: R 1: G 2: B，对应的通道为2 - colors
+    """
+    h, w = CFA.shape
+    red_row = 0 if (colors[0, 0] == 0 or colors[0, 1] == 0) else 1
+    for y in range(h):
+        for x in range(w):
+            c = colors[y & 1, x & 1]
+            output[y, x, 2] = CFA[y, x] if c == 0 else 0
+            output[y, x, 0] = CFA[y, x] if c == 2 else 0
+
+    # G位置的R和B，红色行的R在水平方向，B在垂直方向，蓝色行相反
+    for y in range(h):
+        dy_r, dx_r = (0, 1) if (y & 1) == red_row else (1, 0)
+        for x in range(w):
+            if (colors[y & 1, x & 1] != 1):
+                continue
+            g = output[y, x, 1]
+            output[y, x, 2] = g + menon_mean(output, y, x, 2, dy_r, dx_r) - menon_mean(output, y, x, 1, dy_r, dx_r)
+            output[y, x, 0] = g + menon_mean(output, y, x, 0, dx_r, dy_r) - menon_mean(output, y, x, 1, dx_r, dy_r)
+
+    # R位置的B和B位置的R，方向与G的插值方向一致
+    for y in range(h):
+        for x in range(w):
+            c = colors[y & 1, x & 1]
+            if (c == 1):
+                continue
+            dy, dx = (0, 1) if M[y, x] == 1 else (1, 0)
+            src, dst = 2 - c, c
+            output[y, x, dst] = output[y, x, src] + menon_mean(output, y, x, dst, dy, dx) - \
+                menon_mean(output, y, x, src, dy, dx)
+
+
+def warmup_jit():
     """
-    Helper function for vertical convolution.
+    function: 预先编译demosaic的numba函数
     """
-    return convolve1d(x, y, mode='mirror', axis=0)
+    raw = RawImageInfo()
+    raw.data = np.zeros((8, 8), dtype=np.float32)
+    raw.set_bayer_pattern('rggb')
+    demosaicing_CFA_Bayer_Menon2007(raw, np.empty((8, 8, 3), dtype=np.float32))
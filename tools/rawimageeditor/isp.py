@@ -1,13 +1,81 @@
 import numpy as np  # array operations
 import math         # basing math operations
 import tools.rawimageeditor.utility as utility
+import tools.rawimageeditor.rawunpack as rawunpack
+import tools.rawimageeditor.ispfilter as ispfilter
 from tools.rawimageeditor.RawImageParams import RawImageParams
 from tools.rawimageeditor.RawImageInfo import RawImageInfo
 import sys          # float precision
-from scipy import signal        # convolutions
+import os
 from numba import jit
 import cv2
 import pywt
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+# 定点模式下增益和矩阵系数的小数位数(Q10)
+FIXED_POINT_BITS = 10
+
+
+def is_fixed_point(raw: RawImageInfo):
+    return np.issubdtype(raw.dtype, np.integer)
+
+
+def to_fixed_point(value):
+    """
+    function: 把增益或者矩阵系数转换为Q10定点数
+    """
+    return np.int32(np.rint(np.asarray(value, dtype=np.float64) * (1 << FIXED_POINT_BITS)))
+
+
+def fixed_point_mul(data, coef):
+    """
+    function: 整数数据乘以定点系数，结果四舍五入，用int32计算
+    """
+    return (data.astype(np.int32) * coef + (1 << (FIXED_POINT_BITS - 1))) >> FIXED_POINT_BITS
+
+
+def float_compatible(func):
+    """
+    function: 定点模式下，还没有定点实现的ISP算法先把数据转换成float处理，再四舍五入转换回定点
+    """
+    @functools.wraps(func)
+    def wrapper(raw: RawImageInfo, params: RawImageParams):
+        if (raw is None or raw.get_raw_data() is None or not is_fixed_point(raw)):
+            return func(raw, params)
+        ret_img = func(raw.to_float(), params)
+        if (ret_img is None):
+            return None
+        return ret_img.to_fixed()
+    return wrapper
+
+
+def warmup_jit():
+    """
+    function: 预先编译isp中的numba函数
+    brief: numba函数都设置了cache=True，编译结果会缓存在__pycache__中，之后启动程序直接从磁盘加载，
+    这里用和ISP处理时相同类型的小数组把每个函数调用一遍，界面打开的时候在后台线程运行，
+    第一次运行ISP时就不需要再等待编译
+    """
+    raw = np.zeros((8, 8), dtype=np.float32)
+    rgb = np.zeros((8, 8, 3), dtype=np.float32)
+    index = np.zeros(1, dtype=np.int64)
+    bad_pixel_correction_dynamic(np.pad(raw, (1, 1), 'reflect'), 1)
+    bad_pixel_correction_static(np.pad(raw, (1, 1), 'reflect'), 1, index, index)
+    fused_raw_proc(raw, np.empty_like(raw), np.zeros(1, dtype=np.int32), np.ones((1, 4), dtype=np.float32),
+                   np.ones((1, 1), dtype=np.float32), np.float32(1023))
+    gamma_table = get_gamma_table(2.2, 1023, False)
+    gamma_proc_interp(raw, np.empty_like(raw), gamma_table, GAMMA_LUT_SIZE / 1023)
+    gamma_proc_interp(rgb, np.empty_like(rgb), gamma_table, GAMMA_LUT_SIZE / 1023)
+    gamma_table = get_gamma_table(2.2, 16383, True)
+    gamma_proc_raw(raw.astype(np.uint16), np.empty(raw.shape, dtype=np.uint16), gamma_table)
+    gamma_proc_rgb(rgb.astype(np.uint16), np.empty(rgb.shape, dtype=np.uint16), gamma_table)
+    sharpen_blend(raw, raw, raw, raw, np.float32(5), np.float32(50), np.float32(64), rgb[:, :, 0])
+    ltm_apply_gain(rgb, raw, raw, get_ltm_gain_table(1., 1., 1.), np.float32(1023), np.float32(LTM_LOG_OFFSET),
+                   np.empty_like(rgb))
+    ispfilter.warmup_jit()
+    rawunpack.warmup_jit()
 
 
 def get_src_raw_data(raw: RawImageInfo, params: RawImageParams):
@@ -15,9 +83,25 @@ def get_src_raw_data(raw: RawImageInfo, params: RawImageParams):
     height = params.rawformat.height
     bit_depth = params.rawformat.bit_depth
     filename = params.rawformat.filename
+    raw_format = params.rawformat.raw_format
     ret_img = RawImageInfo()
+    if (params.rawformat.fixed_point is True):
+        ret_img.dtype = np.uint16
     if (filename != "" and width != 0 and height != 0 and bit_depth != 0):
-        ret_img.load_image(filename, height, width, bit_depth)
+        error_str = rawunpack.check_format(raw_format, bit_depth)
+        if (error_str is not None):
+            params.set_error_str(error_str)
+            return None
+        frame_bytes = rawunpack.get_frame_bytes(height, width, bit_depth, raw_format, params.rawformat.stride)
+        if (os.path.getsize(filename) < params.rawformat.offset + frame_bytes):
+            params.set_error_str("文件大小与图片格式不符，需要{}字节".format(params.rawformat.offset + frame_bytes))
+            return None
+        if (rawunpack.is_unpacked_size(os.path.getsize(filename) - params.rawformat.offset, height, width, bit_depth,
+                                       raw_format, params.rawformat.stride)):
+            params.set_error_str("文件大小是16bit非压缩的raw图，与{}格式不符，请选择UNPACKED格式".format(raw_format))
+            return None
+        ret_img.load_image(filename, height, width, bit_depth, params.rawformat.offset,
+                           params.rawformat.stride, params.rawformat.mmap, raw_format)
         ret_img.set_bayer_pattern(params.rawformat.pattern)
         return ret_img
     else:
@@ -49,7 +133,11 @@ def black_level_correction(raw: RawImageInfo, params: RawImageParams):
         # list[::2 ] 就是取奇数位，list[1::2]就是取偶数位
         # 防止减黑电平减多了，超出阈值变成一个特别大的数
         for blc, (y, x) in zip(black_level, [(0, 0), (0, 1), (1, 0), (1, 1)]):
-            ret_img.data[y::2, x::2] = raw_data[y::2, x::2] - blc
+            if(is_fixed_point(raw)):
+                # 定点模式用int32相减，避免uint16下溢
+                ret_img.data[y::2, x::2] = np.clip(raw_data[y::2, x::2].astype(np.int32) - blc, 0, ret_img.max_data)
+            else:
+                ret_img.data[y::2, x::2] = raw_data[y::2, x::2] - blc
         ret_img.clip_range()
         return ret_img
 
@@ -72,7 +160,10 @@ def apply_digital_gain(raw: RawImageInfo, params: RawImageParams):
     ret_img.create_image('after digital gain', raw, init_value=False)
     # ensure input color space and process
     if(raw.get_color_space() == "raw" or raw.get_color_space() == "RGB"):
-        ret_img.data = raw_data * gain
+        if(is_fixed_point(raw)):
+            ret_img.data = np.clip(fixed_point_mul(raw_data, to_fixed_point(gain)), 0, ret_img.max_data).astype(raw.dtype)
+        else:
+            ret_img.data = raw_data * gain
         ret_img.clip_range()
         return ret_img
     else:
@@ -95,6 +186,8 @@ def channel_gain_white_balance(raw: RawImageInfo, params: RawImageParams):
     ret_img = RawImageInfo()
     ret_img.create_image('after awb', raw)
     # ensure input color space and process
+    if(is_fixed_point(raw)):
+        return channel_gain_white_balance_fixed(raw, ret_img, params)
     if(raw.get_color_space() == "raw"):
         channel_gain = resort_with_bayer_pattern(channel_gain, bayer_pattern)
         ret_img.data[::2, ::2] = raw_data[::2, ::2] * channel_gain[0]
@@ -114,6 +207,26 @@ def channel_gain_white_balance(raw: RawImageInfo, params: RawImageParams):
         return None
 
 
+def channel_gain_white_balance_fixed(raw: RawImageInfo, ret_img: RawImageInfo, params: RawImageParams):
+    """
+    function: 定点模式的白平衡，增益为Q10定点数
+    """
+    (r_gain, g_gain, b_gain) = to_fixed_point(params.awb.get_awb_gain())
+    raw_data = raw.get_raw_data()
+    if(raw.get_color_space() == "raw"):
+        channel_gain = resort_with_bayer_pattern((r_gain, g_gain, g_gain, b_gain), raw.get_bayer_pattern())
+        for gain, (y, x) in zip(channel_gain, [(0, 0), (0, 1), (1, 0), (1, 1)]):
+            ret_img.data[y::2, x::2] = np.clip(fixed_point_mul(raw_data[y::2, x::2], gain), 0, ret_img.max_data)
+        return ret_img
+    elif (raw.get_color_space() == "RGB"):
+        for gain, channel in zip((r_gain, g_gain, b_gain), (2, 1, 0)):
+            ret_img.data[:, :, channel] = np.clip(fixed_point_mul(raw_data[:, :, channel], gain), 0, ret_img.max_data)
+        return ret_img
+    else:
+        params.set_error_str("white balance correction need RAW data")
+        return None
+
+
 def bad_pixel_correction(raw: RawImageInfo, params: RawImageParams):
     """
     function: bad_pixel_correction
@@ -121,6 +234,7 @@ def bad_pixel_correction(raw: RawImageInfo, params: RawImageParams):
     input: raw:RawImageInfo() params:RawImageParams()
     卷积核neighborhood_size * neighborhood_size，当这个值大于卷积核内最大的值或者小于最小的值，会将这个值替代掉
     这个算法应该会损失不少分辨率
+    动态模式对每个像素都进行检测，静态模式只矫正坏点表中的像素
     """
     neighborhood_size = params.bpc.get_size_for_bad_pixel_correction()
     if ((neighborhood_size % 2) == 0):
@@ -128,67 +242,135 @@ def bad_pixel_correction(raw: RawImageInfo, params: RawImageParams):
             "neighborhood_size shoud be odd number, recommended value 3")
         return None
 
+    if (raw.get_color_space() != "raw"):
+        params.set_error_str("bad pixel correction need RAW data")
+        return None
+
     raw_data = raw.get_raw_data()
-    raw_channel_data = list()
+    defect_table = None
+    if (params.bpc.get_mode() == 'static'):
+        defect_table = params.bpc.get_defect_table()
+        if (defect_table is None):
+            params.set_error_str("bad pixel correction need defect table in static mode")
+            return None
+        defect_table = np.array(defect_table, dtype=np.int64).reshape(-1, 2)
+        if (np.any(defect_table < 0) or np.any(defect_table[:, 0] >= raw_data.shape[1])
+                or np.any(defect_table[:, 1] >= raw_data.shape[0])):
+            params.set_error_str("defect table is out of image size")
+            return None
 
-    if (raw.get_color_space() == "raw"):
-        ret_img = RawImageInfo()
-        ret_img.create_image('after bad pixel correction', raw)
-        # Separate out the quarter resolution images
-        D = split_raw_data(raw_data)
-
-        # number of pixels to be padded at the borders
-        no_of_pixel_pad = neighborhood_size // 2
-
-        for img in D:  # perform same operation for each quarter
-            width, height = img.shape[1], img.shape[0]
-            # pad pixels at the borders, 扩充边缘
-            img = np.pad(img,
-                         (no_of_pixel_pad, no_of_pixel_pad),
-                         'reflect')  # reflect would not repeat the border value
-
-            raw_channel_data.append(bad_pixel_correction_subfunc(
-                img, no_of_pixel_pad, width, height))
-
-        # Regrouping the data
-        ret_img.data[::2, ::2] = raw_channel_data[0]
-        ret_img.data[::2, 1::2] = raw_channel_data[1]
-        ret_img.data[1::2, ::2] = raw_channel_data[2]
-        ret_img.data[1::2, 1::2] = raw_channel_data[3]
-        return ret_img
+    ret_img = RawImageInfo()
+    ret_img.create_image('after bad pixel correction', raw)
+    # number of pixels to be padded at the borders
+    no_of_pixel_pad = neighborhood_size // 2
+
+    def correct_channel(dst, y, x):
+        # pad pixels at the borders, 扩充边缘，reflect would not repeat the border value
+        img = np.pad(raw_data[y::2, x::2], (no_of_pixel_pad, no_of_pixel_pad), 'reflect')
+        if (defect_table is None):
+            bad_pixel_correction_dynamic(img, no_of_pixel_pad)
+        else:
+            # 坏点表是全分辨率的(x, y)坐标，转换成当前通道的坐标，按照光栅顺序处理
+            points = defect_table[(defect_table[:, 0] % 2 == x) & (defect_table[:, 1] % 2 == y)]
+            index = np.unique(points[:, 1] // 2 * dst.shape[1] + points[:, 0] // 2)
+            bad_pixel_correction_static(img, no_of_pixel_pad, index // dst.shape[1], index % dst.shape[1])
+        dst[...] = img[no_of_pixel_pad: no_of_pixel_pad + dst.shape[0], no_of_pixel_pad: no_of_pixel_pad + dst.shape[1]]
+
+    # Separate out the quarter resolution images, 结果直接写回ret_img对应的通道
+    # 按光栅顺序的依赖只在同一个通道内，四个通道可以用多个线程同时处理
+    channels = list(zip(split_raw_data(ret_img.data), [0, 0, 1, 1], [0, 1, 0, 1]))
+    threads = min(len(channels), os.cpu_count() or 1)
+    if (threads > 1):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(lambda channel: correct_channel(*channel), channels))
     else:
-        params.set_error_str("bad pixel correction need RAW data")
-        return None
+        for channel in channels:
+            correct_channel(*channel)
+    return ret_img
 
 
-@jit(nopython=True)
-def bad_pixel_correction_subfunc(img, no_of_pixel_pad, width, height):
-    for i in range(no_of_pixel_pad, height + no_of_pixel_pad):
-        for j in range(no_of_pixel_pad, width + no_of_pixel_pad):
-            # save the middle pixel value
-            mid_pixel_val = img[i, j]
-            # extract the neighborhood
-            neighborhood = img[i - no_of_pixel_pad: i + no_of_pixel_pad+1,
-                               j - no_of_pixel_pad: j + no_of_pixel_pad+1]
-
-            # set the center pixels value same as the left pixel
-            # Does not matter replace with right or left pixel
-            # is used to replace the center pixels value
-            neighborhood[no_of_pixel_pad,
-                         no_of_pixel_pad] = neighborhood[no_of_pixel_pad, no_of_pixel_pad-1]
-
-            min_neighborhood = np.min(neighborhood)
-            max_neighborhood = np.max(neighborhood)
-
-            if (mid_pixel_val < min_neighborhood):
-                img[i, j] = min_neighborhood
-            elif (mid_pixel_val > max_neighborhood):
-                img[i, j] = max_neighborhood
+def bad_pixel_correction_dynamic(img, no_of_pixel_pad):
+    """
+    func: 对扩充过边缘的单个通道进行坏点矫正，结果直接写回img
+    brief: 先用去掉中心点的核做腐蚀和膨胀，得到每个点邻域(不含中心)的最小值和最大值，一次钳位所有的点，
+    但是原来的算法是按光栅顺序原地处理的，前面矫正过的点会参与后面的点的计算，
+    所以再按光栅顺序检查一遍，只有邻域中已经处理过的点被修改过的时候才重新计算，其他点直接用向量化的结果，
+    这样和逐点处理的结果完全一致，而大部分点都不需要重新计算
+    """
+    height = img.shape[0] - 2 * no_of_pixel_pad
+    width = img.shape[1] - 2 * no_of_pixel_pad
+    kernel = np.ones((2 * no_of_pixel_pad + 1, 2 * no_of_pixel_pad + 1), dtype=np.uint8)
+    kernel[no_of_pixel_pad, no_of_pixel_pad] = 0
+    valid = (slice(no_of_pixel_pad, no_of_pixel_pad + height), slice(no_of_pixel_pad, no_of_pixel_pad + width))
+    min_neighborhood = cv2.erode(img, kernel)[valid]
+    max_neighborhood = cv2.dilate(img, kernel)[valid]
+    result = np.minimum(np.maximum(img[valid], min_neighborhood), max_neighborhood)
+    bad_pixel_correction_causal(img, result, no_of_pixel_pad)
+    return img
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def bad_pixel_correction_causal(img, result, no_of_pixel_pad):
+    """
+    func: 按光栅顺序修正向量化的结果
+    input: img是扩充过边缘的原图，result是不考虑处理顺序的钳位结果
+    """
+    height, width = result.shape
+    changed = np.zeros((height, width), dtype=np.bool_)
+    for i in range(height):
+        for j in range(width):
+            # 邻域中已经处理过的点: 上面几行的整行和当前行左边的点
+            dirty = False
+            for y in range(max(i - no_of_pixel_pad, 0), i + 1):
+                x_end = min(j + no_of_pixel_pad + 1, width) if y < i else j
+                for x in range(max(j - no_of_pixel_pad, 0), x_end):
+                    if (changed[y, x]):
+                        dirty = True
+                        break
+                if (dirty):
+                    break
+            mid_pixel_val = img[i + no_of_pixel_pad, j + no_of_pixel_pad]
+            if (dirty):
+                value = bad_pixel_clamp(img, i + no_of_pixel_pad, j + no_of_pixel_pad, no_of_pixel_pad)
             else:
-                img[i, j] = mid_pixel_val
+                value = result[i, j]
+            changed[i, j] = value != mid_pixel_val
+            img[i + no_of_pixel_pad, j + no_of_pixel_pad] = value
+
 
-    # Put the corrected image to the dictionary
-    return img[no_of_pixel_pad: height + no_of_pixel_pad, no_of_pixel_pad: width + no_of_pixel_pad]
+@jit(nopython=True, nogil=True, cache=True)
+def bad_pixel_correction_static(img, no_of_pixel_pad, ys, xs):
+    """
+    func: 只矫正坏点表中的点，ys, xs是光栅顺序排列的通道坐标
+    """
+    for n in range(len(ys)):
+        i = ys[n] + no_of_pixel_pad
+        j = xs[n] + no_of_pixel_pad
+        img[i, j] = bad_pixel_clamp(img, i, j, no_of_pixel_pad)
+    return img
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def bad_pixel_clamp(img, i, j, no_of_pixel_pad):
+    """
+    func: 把(i, j)钳位到邻域(不含中心点)的最小值和最大值之间
+    """
+    min_neighborhood = img[i, j - 1]
+    max_neighborhood = img[i, j - 1]
+    for y in range(i - no_of_pixel_pad, i + no_of_pixel_pad + 1):
+        for x in range(j - no_of_pixel_pad, j + no_of_pixel_pad + 1):
+            if (y == i and x == j):
+                continue
+            if (img[y, x] < min_neighborhood):
+                min_neighborhood = img[y, x]
+            elif (img[y, x] > max_neighborhood):
+                max_neighborhood = img[y, x]
+    mid_pixel_val = img[i, j]
+    if (mid_pixel_val < min_neighborhood):
+        return min_neighborhood
+    elif (mid_pixel_val > max_neighborhood):
+        return max_neighborhood
+    return mid_pixel_val
 
 
 def rolloff_correction(raw: RawImageInfo, params: RawImageParams):
@@ -214,41 +396,174 @@ def rolloff_correction(raw: RawImageInfo, params: RawImageParams):
         return None
 
 
+# 可以合并成一次遍历的逐点raw域处理，值为该节点在fused_raw_proc中的操作
+# 0: 减去每个通道的值 1: 乘以每个通道的值 2: 乘以平场图
+FUSED_RAW_NODES = {
+    "black level": 0,
+    "blc": 0,
+    "digital gain": 1,
+    "rolloff": 2,
+    "awb": 1,
+}
+
+
+def can_fuse_raw_stage(raw: RawImageInfo, params: RawImageParams, nodes):
+    """
+    function: 判断这几个节点能不能合并处理
+    brief: 只支持float32的raw图，平场图需要是float32并且与raw图大小一致，
+    其他情况(比如float64的平场图会让后面的计算都变成float64)逐个节点运行，保证结果不变
+    """
+    if (raw is None or raw.get_raw_data() is None or raw.get_color_space() != "raw"):
+        return False
+    if (raw.get_raw_data().dtype != np.float32 or is_fixed_point(raw)):
+        return False
+    for node in nodes:
+        if (node not in FUSED_RAW_NODES):
+            return False
+        flatphoto = params.rolloff.flatphoto
+        if (node == "rolloff" and isinstance(flatphoto, np.ndarray)):
+            if (flatphoto.dtype != np.float32 or flatphoto.shape != raw.get_size()):
+                return False
+    return True
+
+
+def fused_raw_stage(raw: RawImageInfo, params: RawImageParams, nodes):
+    """
+    function: 把连续的黑电平、数字增益、暗影矫正和白平衡合并成一次遍历
+    input: nodes是节点名称的列表，需要先用can_fuse_raw_stage检查
+    brief: 每一步之后都按照原来的节点进行钳位，计算也都是float32，与逐个节点运行的结果完全相同
+    """
+    bayer_pattern = raw.get_bayer_pattern()
+    ops = np.empty(len(nodes), dtype=np.int32)
+    coefs = np.ones((len(nodes), 4), dtype=np.float32)
+    flatphoto = np.ones((1, 1), dtype=np.float32)
+    for i, node in enumerate(nodes):
+        ops[i] = FUSED_RAW_NODES[node]
+        if (node == "black level" or node == "blc"):
+            coefs[i] = resort_with_bayer_pattern(params.blc.get_black_level(), bayer_pattern)
+        elif (node == "digital gain"):
+            coefs[i] = params.gain.digital_gain
+        elif (node == "awb"):
+            (r_gain, g_gain, b_gain) = params.awb.get_awb_gain()
+            coefs[i] = resort_with_bayer_pattern((r_gain, g_gain, g_gain, b_gain), bayer_pattern)
+        elif (isinstance(params.rolloff.flatphoto, np.ndarray)):
+            flatphoto = params.rolloff.flatphoto
+        else:
+            # 平场图没有设置的时候是一个常数
+            ops[i] = 1
+            coefs[i] = params.rolloff.flatphoto
+
+    ret_img = RawImageInfo()
+    ret_img.create_image('after ' + nodes[-1], raw, init_value=False)
+    ret_img.data = np.empty(raw.get_size(), dtype=np.float32)
+    fused_raw_proc(raw.get_raw_data(), ret_img.data, ops, coefs, flatphoto, np.float32(ret_img.max_data))
+    return ret_img
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def fused_raw_proc(src, dst, ops, coefs, flatphoto, max_data):
+    """
+    逐点处理raw图，coefs按照raw图上2x2的顺序排列
+    """
+    zero = np.float32(0)
+    for i in range(src.shape[0]):
+        for j in range(src.shape[1]):
+            channel = (i & 1) * 2 + (j & 1)
+            value = src[i, j]
+            for k in range(ops.shape[0]):
+                if (ops[k] == 0):
+                    value = value - coefs[k, channel]
+                elif (ops[k] == 1):
+                    value = value * coefs[k, channel]
+                else:
+                    value = value * flatphoto[i, j]
+                value = min(max(value, zero), max_data)
+            dst[i, j] = value
+
+
 def gamma_correction(raw: RawImageInfo, params: RawImageParams):
     """
     function: gamma correction 
     input: raw:RawImageInfo() params:RawImageParams() 输入支持bayer以及RGB域
 
-    如何支持自定义gamma表：
-    - 自定义gamma-float类型
-        linear_table = np.linspace(0, max_input+1, int((max_input+1)/4))  # 建立映射表
-        gamma_table = (np.power(linear_table/max_input, 1/gamma_ratio) * max_input)
-        ret_img.data = np.interp(raw_data, linear_table, gamma_table)
-    - 自定义gamma-int类型
+    gamma都是通过查表实现的，查找表按照(gamma值或者自定义曲线, 最大值, 数据类型)缓存，只需要计算一次：
+    - float类型：表的长度为GAMMA_LUT_SIZE + 1，在相邻两个节点之间线性插值
+        gamma_proc_interp(raw_data, ret_img.data, gamma_table, scale)
+    - int类型：表覆盖整个uint16的范围，直接查表
         gamma_proc_raw(raw_data, ret_img.data, gamma_table)
         gamma_proc_rgb(raw_data, ret_img.data, gamma_table)
+    自定义gamma曲线是硬件的1025个节点，由params.gamma.load_gamma_curve导入
     """
     gamma_ratio = params.gamma.get_gamma_ratio()
+    gamma_curve = params.gamma.get_gamma_curve()
     raw_data = raw.get_raw_data()
 
-    if (raw.get_color_space() == "raw"):
-        ret_img = RawImageInfo()
-        ret_img.create_image('after gamma correction', raw)
-        ret_img.data = raw.max_data * \
-            np.power(raw_data/raw.max_data, 1/gamma_ratio)
-        return ret_img
-    elif (raw.get_color_space() == "RGB"):
+    if (raw.get_color_space() == "raw" or raw.get_color_space() == "RGB"):
         ret_img = RawImageInfo()
-        ret_img.create_image('after gamma correction', raw)
-        ret_img.data = raw.max_data * \
-            np.power(raw_data/raw.max_data, 1/gamma_ratio)
+        ret_img.create_image('after gamma correction', raw, init_value=False)
+        ret_img.data = np.empty(raw_data.shape, dtype=raw_data.dtype)
+        gamma_table = get_gamma_table(gamma_ratio, raw.max_data, is_fixed_point(raw), gamma_curve)
+        if (not is_fixed_point(raw)):
+            gamma_proc_interp(np.ascontiguousarray(raw_data), ret_img.data, gamma_table, GAMMA_LUT_SIZE / raw.max_data)
+        elif (raw.get_color_space() == "raw"):
+            gamma_proc_raw(raw_data, ret_img.data, gamma_table)
+        else:
+            gamma_proc_rgb(raw_data, ret_img.data, gamma_table)
         return ret_img
     else:
         params.set_error_str("gamma correction need RAW or RGB data")
         return None
 
 
-@jit(nopython=True)
+# float类型gamma查找表的节点数
+GAMMA_LUT_SIZE = 1 << 16
+
+
+@functools.lru_cache(maxsize=16)
+def get_gamma_table(gamma_ratio, max_data, fixed_point, gamma_curve=None):
+    """
+    function: 生成gamma查找表
+    input: gamma_curve为None时使用gamma_ratio计算，否则为均匀分布的自定义曲线节点(归一化到[0, 1])
+    brief: 定点模式的表覆盖整个uint16范围，超过max_data的输入按照max_data处理，防止查表越界
+    """
+    if (fixed_point is True):
+        linear_table = np.minimum(np.arange(1 << 16), max_data) / max_data
+    else:
+        linear_table = np.arange(GAMMA_LUT_SIZE + 1) / GAMMA_LUT_SIZE
+    if (gamma_curve is None):
+        gamma_table = max_data * np.power(linear_table, 1/gamma_ratio)
+    else:
+        curve = np.asarray(gamma_curve, dtype=np.float64)
+        gamma_table = max_data * np.interp(linear_table, np.linspace(0, 1, len(curve)), curve)
+    if (fixed_point is True):
+        gamma_table = np.rint(gamma_table).astype(np.uint16)
+    else:
+        gamma_table = gamma_table.astype(np.float32)
+    gamma_table.flags.writeable = False
+    return gamma_table
+
+
+@jit(nopython=True, nogil=True, fastmath=True, cache=True)
+def gamma_proc_interp(src, dst, gamma_table, scale):
+    """
+    根据gamma table处理float图像，相邻节点之间线性插值，支持raw和rgb
+    """
+    src = src.reshape(-1)
+    dst = dst.reshape(-1)
+    scale = np.float32(scale)
+    limit = np.float32(gamma_table.shape[0] - 1.001)
+    for i in range(src.shape[0]):
+        pos = src[i] * scale
+        if (pos < 0):
+            pos = np.float32(0)
+        if (pos > limit):
+            pos = limit
+        index = np.int32(pos)
+        frac = pos - np.float32(index)
+        dst[i] = gamma_table[index] + (gamma_table[index + 1] - gamma_table[index]) * frac
+
+
+@jit(nopython=True, nogil=True, cache=True)
 def gamma_proc_raw(src, dst, gamma_table):
     """
     根据gamma table 处理raw图
@@ -258,7 +573,7 @@ def gamma_proc_raw(src, dst, gamma_table):
             dst[i, j] = gamma_table[src[i, j]]
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True, cache=True)
 def gamma_proc_rgb(src, dst, gamma_table):
     """
     根据gamma table处理rgb图
@@ -269,14 +584,22 @@ def gamma_proc_rgb(src, dst, gamma_table):
                 dst[i, j, k] = gamma_table[src[i, j, k]]
 
 
+# LTM的mask的值域sigma和最大值的比值
+LTM_MASK_SIGMA_RANGE = 0.1
+# LTM的mask的空间sigma，固定的像素数，分块处理和整帧处理的mask一致
+LTM_MASK_SIGMA_SPATIAL = 32
+
+
 def ltm_correction(raw: RawImageInfo, params: RawImageParams):
     """
     function: ltm correction 局部对比度增强
     input: raw:RawImageInfo() params:RawImageParams() 输入支持bayer以及RGB域
 
     原理: 
-    1. 先获取mask, 对原图进行灰度处理，然后进行一定半径的高斯模糊，然后归一化
+    1. 先获取mask, 对原图进行灰度处理，然后用双边网格进行大半径的保边模糊，然后归一化
     如果mask的值小于0.5说明周围都是暗像素，修改gamma值，亮度上进行乘方
+    brief: 双边网格的值域固定为[0, max_data]并且按整帧坐标对齐，
+    分块处理需要LTM_MASK_SIGMA_SPATIAL的3倍的halo
     """
     dark_boost = params.ltm.get_dark_boost()/100
     bright_suppress = params.ltm.get_bright_suppress()/100
@@ -288,7 +611,9 @@ def ltm_correction(raw: RawImageInfo, params: RawImageParams):
         gray_image = raw.convert_to_gray()
 
         # 双边滤波的保边特性，这样可以减少处理后的halo瑕疵
-        mask = cv2.GaussianBlur(gray_image, (5, 5), 1.5)
+        mask = ispfilter.bilateral_grid(gray_image, sigma_spatial=LTM_MASK_SIGMA_SPATIAL / params.pixel_scale,
+                                        sigma_range=LTM_MASK_SIGMA_RANGE * raw.max_data,
+                                        value_range=(0, raw.max_data), origin=params.tile_origin)
 
         # 归一化
         mask = mask/raw.max_data
@@ -309,6 +634,116 @@ def ltm_correction(raw: RawImageInfo, params: RawImageParams):
         return None
 
 
+# guided LTM下采样后的引导滤波半径，半径越大下采样越多，小图上的半径保持不变
+LTM_GUIDED_RADIUS = 8
+# 引导滤波在log2亮度上计算，亮度归一化到[0, 1]，加上偏移防止log(0)
+LTM_LOG_OFFSET = 1 / 1024
+# 引导滤波的正则项，局部标准差远大于0.15档(log2)的边缘会保留
+LTM_GUIDED_EPS = 0.02
+# 增益查找表的节点数，(局部均值, 像素亮度)，局部均值按log2均匀分布
+LTM_LUT_MEAN_SIZE = 64
+LTM_LUT_VALUE_SIZE = 256
+
+
+def guided_ltm(raw: RawImageInfo, params: RawImageParams):
+    """
+    function: guided ltm 保边的局部对比度增强
+    input: raw:RawImageInfo() params:RawImageParams() 输入支持RGB域
+
+    原理:
+    1. 按半径把图像下采样，下采样后的引导滤波半径是LTM_GUIDED_RADIUS，在小图的log2亮度上计算引导滤波的线性系数a、b，
+    对数域上亮区和暗区的边缘一样明显
+    2. a、b双线性上采样到原图大小，局部均值 = 2^(a * log2亮度 + b)，边缘两侧各自取自己一侧的均值，不会产生halo
+    3. 增益 = 二维查找表[局部均值, 亮度]，表的内容是 亮度^alpha(局部均值) / 亮度，
+    alpha和ltm_correction的暗区提升、亮区抑制曲线相同，强度按比例缩放alpha与1的差
+    4. RGB乘以同一个增益，色调不变
+    brief: 原图上只有下采样、系数上采样和查表三次遍历，小图的大小和半径的平方成反比，
+    半径增大到几百个像素耗时基本不变；下采样依赖整帧的大小，不能分块处理
+    """
+    dark_boost = params.ltm.get_dark_boost()/100
+    bright_suppress = params.ltm.get_bright_suppress()/100
+    radius = params.ltm.get_radius()
+    strength = params.ltm.get_strength()/100
+
+    if (raw.get_color_space() == "RGB"):
+        ret_img = RawImageInfo()
+        ret_img.create_image('after guided tone mapping', raw, init_value=False)
+        raw_data = np.ascontiguousarray(raw.get_raw_data(), dtype=np.float32)
+        height, width = raw_data.shape[:2]
+
+        # 亮度是RGB的线性组合，先下采样RGB再计算亮度，和下采样亮度的结果相同
+        scale = max(1., radius / LTM_GUIDED_RADIUS)
+        small_size = (max(1, int(round(width / scale))), max(1, int(round(height / scale))))
+        small = cv2.resize(raw_data, small_size, interpolation=cv2.INTER_AREA)
+        small = (0.299 * small[:, :, 0] + 0.587 * small[:, :, 1] + 0.114 * small[:, :, 2]) / raw.max_data
+        small = np.log2(np.maximum(small, 0) + LTM_LOG_OFFSET)
+        small_radius = max(1, int(round(radius / scale)))
+        mean_a, mean_b = ispfilter.guided_filter_coefficients(small, small, small_radius, LTM_GUIDED_EPS)
+        mean_a = cv2.resize(mean_a, (width, height), interpolation=cv2.INTER_LINEAR)
+        mean_b = cv2.resize(mean_b, (width, height), interpolation=cv2.INTER_LINEAR)
+
+        gain_table = get_ltm_gain_table(dark_boost, bright_suppress, strength)
+        ret_img.data = np.empty_like(raw_data)
+        ltm_apply_gain(raw_data, mean_a, mean_b, gain_table, np.float32(raw.max_data), np.float32(LTM_LOG_OFFSET),
+                       ret_img.data)
+        return ret_img
+    else:
+        params.set_error_str("guided ltm need RGB data")
+        return None
+
+
+@functools.lru_cache(maxsize=16)
+def get_ltm_gain_table(dark_boost, bright_suppress, strength):
+    """
+    function: 生成guided ltm的增益查找表
+    ret: (LTM_LUT_MEAN_SIZE + 1) x (LTM_LUT_VALUE_SIZE + 1)的float32表，行是局部均值，列是像素亮度，都归一化到[0, 1]，
+    行按log2(局部均值 + LTM_LOG_OFFSET)均匀分布，暗区的精度更高
+    brief: 亮度为0时增益没有定义，使用第一个节点的增益
+    """
+    log_range = np.log2([LTM_LOG_OFFSET, 1 + LTM_LOG_OFFSET])
+    mean = np.exp2(np.linspace(log_range[0], log_range[1], LTM_LUT_MEAN_SIZE + 1)) - LTM_LOG_OFFSET
+    mean = np.clip(mean, 0, 1)[:, None]
+    value = np.linspace(0, 1, LTM_LUT_VALUE_SIZE + 1)[None, :]
+    alpha = np.where(mean < 0.5, 1 - dark_boost * (mean - 0.5) * (mean - 0.5),
+                     1 + bright_suppress * (mean - 0.5) * (mean - 0.5))
+    alpha = 1 + strength * (alpha - 1)
+    value = np.maximum(value, 1 / LTM_LUT_VALUE_SIZE)
+    gain_table = np.power(value, alpha - 1).astype(np.float32)
+    gain_table.flags.writeable = False
+    return gain_table
+
+
+@jit(nopython=True, nogil=True, fastmath=True, cache=True)
+def ltm_apply_gain(src, mean_a, mean_b, gain_table, max_data, log_offset, dst):
+    """
+    计算每个像素的亮度和局部均值，在增益查找表中双线性插值，RGB乘以同一个增益
+    """
+    rows = gain_table.shape[0] - 1
+    cols = gain_table.shape[1] - 1
+    inv_max = np.float32(1) / max_data
+    log_min = np.log2(log_offset)
+    log_scale = np.float32(rows) / (np.log2(np.float32(1) + log_offset) - log_min)
+    for i in range(src.shape[0]):
+        src_row, dst_row, a_row, b_row = src[i], dst[i], mean_a[i], mean_b[i]
+        for j in range(src.shape[1]):
+            lum = (np.float32(0.299) * src_row[j, 0] + np.float32(0.587) * src_row[j, 1] +
+                   np.float32(0.114) * src_row[j, 2]) * inv_max
+            lum = min(max(lum, np.float32(0)), np.float32(1))
+            # 局部均值的log2，归一化到查找表的行
+            pm = (a_row[j] * np.log2(lum + log_offset) + b_row[j] - log_min) * log_scale
+            pm = min(max(pm, np.float32(0)), np.float32(rows - 0.001))
+            im = np.int32(pm)
+            fm = pm - np.float32(im)
+            pv = min(lum * np.float32(cols), np.float32(cols - 0.001))
+            iv = np.int32(pv)
+            fv = pv - np.float32(iv)
+            top = gain_table[im, iv] + (gain_table[im, iv + 1] - gain_table[im, iv]) * fv
+            bottom = gain_table[im + 1, iv] + (gain_table[im + 1, iv + 1] - gain_table[im + 1, iv]) * fv
+            gain = top + (bottom - top) * fm
+            for k in range(3):
+                dst_row[j, k] = min(max(src_row[j, k] * gain, np.float32(0)), max_data)
+
+
 def color_correction(raw: RawImageInfo, params: RawImageParams):
     """
     function: CCM颜色校正
@@ -327,6 +762,15 @@ def color_correction(raw: RawImageInfo, params: RawImageParams):
         R = raw_data[:, :, 2]
         G = raw_data[:, :, 1]
         B = raw_data[:, :, 0]
+        if(is_fixed_point(raw)):
+            # 定点模式，矩阵系数为Q10，用int32累加后四舍五入
+            ccm = to_fixed_point(ccm)
+            R, G, B = R.astype(np.int32), G.astype(np.int32), B.astype(np.int32)
+            half = 1 << (FIXED_POINT_BITS - 1)
+            for channel, row in zip((2, 1, 0), ccm):
+                value = (R * row[0] + G * row[1] + B * row[2] + half) >> FIXED_POINT_BITS
+                ret_img.data[:, :, channel] = np.clip(value, 0, ret_img.max_data)
+            return ret_img
         # 注意RGB图的颜色排列是BGR
         ret_img.data[:, :, 2] = R * ccm[0][0] + G * ccm[0][1] + B * ccm[0][2]
         ret_img.data[:, :, 1] = R * ccm[1][0] + G * ccm[1][1] + B * ccm[1][2]
@@ -415,11 +859,13 @@ def color_space_conversion(raw: RawImageInfo, params: RawImageParams):
              math.cos(hue * math.pi)]
         ])
 
+        matrix = np.dot(adjust_matrix, csc * csc_ratio * contrast)
+        if(is_fixed_point(raw)):
+            return color_space_conversion_fixed(raw, ret_img, matrix, blackin, blackout)
+
         ret_img.data = raw_data + blackin
         B, G, R = cv2.split(ret_img.data)
 
-        matrix = np.dot(adjust_matrix, csc * csc_ratio * contrast)
-
         # 由于加减RGB=128时，CrCb的值都为0，可以进行化简
         Y = matrix[0][0] * R + matrix[0][1] * G + matrix[0][2] * B + blackout
         Cr = matrix[1][0] * R + matrix[1][1] * G + matrix[1][2] * B
@@ -433,6 +879,168 @@ def color_space_conversion(raw: RawImageInfo, params: RawImageParams):
         return None
 
 
+def color_space_conversion_fixed(raw: RawImageInfo, ret_img: RawImageInfo, matrix, blackin, blackout):
+    """
+    function: 定点模式的CSC，矩阵系数为Q10，输出int32的YCrCb
+    """
+    data = raw.get_raw_data().astype(np.int32) + int(round(blackin))
+    B, G, R = data[:, :, 0], data[:, :, 1], data[:, :, 2]
+    matrix = to_fixed_point(matrix)
+    half = 1 << (FIXED_POINT_BITS - 1)
+    Y = ((matrix[0][0] * R + matrix[0][1] * G + matrix[0][2] * B + half) >> FIXED_POINT_BITS) + int(round(blackout))
+    Cr = (matrix[1][0] * R + matrix[1][1] * G + matrix[1][2] * B + half) >> FIXED_POINT_BITS
+    Cb = (matrix[2][0] * R + matrix[2][1] * G + matrix[2][2] * B + half) >> FIXED_POINT_BITS
+    ret_img.dtype = np.int32
+    ret_img.data = cv2.merge([Y, Cr, Cb])
+    ret_img.set_color_space("YCrCb")
+    ret_img.clip_range()
+    return ret_img
+
+
+class CachedPlan():
+    """
+    按输入平面的大小和类型复用缓冲区的计划，同样大小的输入(整帧或者一个条带)重复使用
+    brief: 输入是否相同只看输入图像的cache_key(节点缓存的key，包含了raw图内容和之前所有节点的参数)，
+    不保存输入的副本，也不比较数据；没有cache_key的输入(比如分块)每次都重新计算，只复用缓冲区。
+    一个计划同时只能被一个线程使用，条带多线程处理时每个条带使用各自的计划
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.busy = False
+        # 缓存的中间结果对应的输入的cache_key，None表示没有可以复用的结果
+        self.content_key = None
+
+    def is_cached(self, content_key):
+        return content_key is not None and content_key == self.content_key
+
+    def cached_bytes(self):
+        """
+        func: 缓冲区和缓存的中间结果占用的字节数，由子类实现
+        """
+        return 0
+
+    def nbytes(self):
+        return self.cached_bytes()
+
+
+class PlanPool():
+    """
+    CachedPlan的缓存池，最近使用的在最后，按占用的字节数限制缓存的数量
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.plans = []
+        self.lock = Lock()
+
+    def acquire(self, key, create, content_key=None):
+        """
+        func: 获取一个key相同的空闲计划，优先使用上一次处理的是content_key这个输入的计划，
+        其次是最近使用过的计划，都没有的时候调用create()创建，用完之后需要调用release
+        """
+        with self.lock:
+            free = [plan for plan in self.plans if plan.busy is False and plan.key == key]
+            plan = next((plan for plan in free if plan.is_cached(content_key)), free[-1] if len(free) > 0 else None)
+            if (plan is None):
+                plan = create()
+            else:
+                self.plans.remove(plan)
+            plan.busy = True
+            self.plans.append(plan)
+        return plan
+
+    def release(self, plan):
+        """
+        func: 释放计划，超过max_bytes时删除最久没有使用的空闲计划
+        """
+        with self.lock:
+            plan.busy = False
+            used = sum(plan.nbytes() for plan in self.plans)
+            for old_plan in list(self.plans):
+                if (used <= self.max_bytes):
+                    break
+                if (old_plan.busy is False):
+                    used -= old_plan.nbytes()
+                    self.plans.remove(old_plan)
+
+
+# 小波降噪和锐化共用的计划池
+plan_pool = PlanPool(512 << 20)
+
+
+class WaveletPlan(CachedPlan):
+    """
+    小波降噪的变换计划，缓存上一次输入的正变换系数，降噪后的系数写到预先分配的缓冲区中，
+    同样大小的Y平面重复使用缓冲区
+    """
+
+    def __init__(self, key, wavelet, level):
+        super().__init__(key)
+        self.wavelet = wavelet
+        self.level = level
+        self.bands = None
+        self.buffers = None
+
+    def cached_bytes(self):
+        return sum(band.nbytes for band in (self.bands or []) + (self.buffers or []))
+
+    @staticmethod
+    def get_bands(coeffs):
+        """
+        func: 把wavedec2的系数展开成[低频, 第1层的3个高频, 第2层的3个高频...]
+        """
+        return [coeffs[0]] + [band for level in coeffs[1:] for band in level]
+
+    def forward(self, Y, content_key=None):
+        """
+        func: 小波正变换，content_key和上一次相同时直接返回缓存的系数，第一次变换时分配降噪后系数的缓冲区
+        input: content_key是Y所在图像的cache_key
+        ret: (展开的系数, 降噪后系数的缓冲区)
+        """
+        if (not self.is_cached(content_key)):
+            self.content_key = None
+            self.bands = None
+            self.bands = self.get_bands(pywt.wavedec2(data=Y, wavelet=self.wavelet, level=self.level))
+            self.content_key = content_key
+        if (self.buffers is None):
+            self.buffers = [np.empty_like(band) for band in self.bands]
+        return self.bands, self.buffers
+
+    def inverse(self, bands):
+        """
+        func: 小波逆变换，bands是展开的系数
+        """
+        coeffs = [bands[0]] + [tuple(bands[1 + 3 * i: 4 + 3 * i]) for i in range(self.level)]
+        return pywt.waverec2(coeffs, self.wavelet)
+
+
+def acquire_wavelet_plan(Y, wavelet, level, content_key=None):
+    """
+    func: 获取Y平面的小波变换计划，按Y的大小和类型复用，用完之后需要调用plan_pool.release
+    """
+    key = ('wavelet', Y.shape, np.dtype(Y.dtype), wavelet, level)
+    return plan_pool.acquire(key, lambda: WaveletPlan(key, wavelet, level), content_key)
+
+
+def run_concurrently(tasks):
+    """
+    func: 用线程池同时运行一组没有返回值的函数，单核时直接顺序运行
+    brief: 双边滤波等opencv函数运行时会释放GIL，可以多个线程同时计算
+    """
+    threads = min(len(tasks), os.cpu_count() or 1)
+    if (threads > 1):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(lambda task: task(), tasks))
+    else:
+        for task in tasks:
+            task()
+
+
+# 色度降噪的双边网格的空间sigma，和原来7x7窗口的双边滤波的空间范围一致(7x7均匀窗口的标准差是2)
+CHROMA_DENOISE_SIGMA_SPATIAL = 2
+
+
 def wavelet_denoise(raw: RawImageInfo, params: RawImageParams):
     """
     func: 小波降噪
@@ -447,7 +1055,10 @@ def wavelet_denoise(raw: RawImageInfo, params: RawImageParams):
     @denoise_strength：降噪强度，值越大，双边滤波的强度越强
     @noise_threshold：降噪阈值，值越大，噪声范围越大
     @noise_weight：降噪权重，值越大，降噪越强，值为0的时候，就不进行降噪
-    @color_denoise_strength: 色度降噪强度，值越大，色度降噪越强
+    @color_denoise_strength: 色度降噪强度，是色度双边网格的值域sigma，值越大，色度降噪越强
+    brief: 正变换的系数按输入的cache_key缓存在WaveletPlan中，只调节降噪参数时不需要重新变换，
+    每个频带的降噪和两个色度的双边滤波互相独立，用线程池同时处理，
+    色度的双边滤波用双边网格计算，值域固定为[0, max_data]并且按整帧坐标对齐，可以分块处理
     """
     w = 'sym4'  # 定义小波基的类型
     l = 2  # 简化变换层次为2
@@ -461,43 +1072,37 @@ def wavelet_denoise(raw: RawImageInfo, params: RawImageParams):
         ret_img.set_color_space("YCrCb")
         raw_data = raw.get_raw_data()
         Y = raw_data[:, :, 0]
-        # 亮度降噪
-        # 对图像进行小波分解
-        coeffs = pywt.wavedec2(data=Y, wavelet=w, level=l)
-
-        # 将中高频图像保存到list中
-        list_coeffs = [[0] * 3 for i in range(l)]
-        # 将中高频的图像进行降噪
-        for r1 in range(len(list_coeffs)):
-            for r2 in range(len(list_coeffs[r1])):
-                list_coeffs[r1][r2] = denoise_one_level(
-                    coeffs[r1+1][r2], denoise_strength[r1+1], noise_threshold[r1+1], noise_weight[0]/100)
-
-        rec_coeffs = []
-        # 对低频图像进行降噪
-        rec_coeffs.append(denoise_one_level(
-            coeffs[0], denoise_strength[0], noise_threshold[0], noise_weight[0]/100))
-
-        # 转换成tuple
-        for j in range(len(list_coeffs)):
-            rec_coeffs_ = tuple(list_coeffs[j])
-            rec_coeffs.append(rec_coeffs_)
-
-        # 小波逆变换
-        ret_img.data[:, :, 0] = pywt.waverec2(rec_coeffs, w)
-
-        # 色度降噪
-        ret_img.data[:, :, 1] = cv2.bilateralFilter(
-            raw_data[:, :, 1], 7, color_denoise_strength, color_denoise_strength)
-        ret_img.data[:, :, 2] = cv2.bilateralFilter(
-            raw_data[:, :, 2], 7, color_denoise_strength, color_denoise_strength)
+        plan = acquire_wavelet_plan(Y, w, l, raw.cache_key)
+        try:
+            # 亮度降噪
+            # 对图像进行小波分解，bands是[低频, 中频的3个方向, 高频的3个方向]
+            bands, buffers = plan.forward(Y, raw.cache_key)
+            # 低频用第0组参数，第r层的高频用第r组参数
+            levels = [0] + [r + 1 for r in range(l) for _ in range(3)]
+            tasks = [functools.partial(denoise_one_level, band, denoise_strength[level], noise_threshold[level],
+                                       noise_weight[0]/100, buffer)
+                     for band, level, buffer in zip(bands, levels, buffers)]
+
+            # 色度降噪
+            def color_denoise(c):
+                ret_img.data[:, :, c] = ispfilter.bilateral_grid(
+                    raw_data[:, :, c], sigma_spatial=CHROMA_DENOISE_SIGMA_SPATIAL / params.pixel_scale,
+                    sigma_range=color_denoise_strength,
+                    value_range=(0, raw.max_data), origin=params.tile_origin)
+            tasks += [functools.partial(color_denoise, 1), functools.partial(color_denoise, 2)]
+            run_concurrently(tasks)
+
+            # 小波逆变换，奇数的宽高逆变换后会多出一行(列)
+            ret_img.data[:, :, 0] = plan.inverse(buffers)[:Y.shape[0], :Y.shape[1]]
+        finally:
+            plan_pool.release(plan)
         return ret_img
     else:
         params.set_error_str("YUV denoise need YCrCb data")
         return None
 
 
-def denoise_one_level(src, strength, noise_threshold, noise_weight):
+def denoise_one_level(src, strength, noise_threshold, noise_weight, dst=None):
     """
     func: 对每层小波变换的图像进行双边滤波降噪和软阈值处理
     原理图：
@@ -507,11 +1112,114 @@ def denoise_one_level(src, strength, noise_threshold, noise_weight):
     1. 每层小波变换后的图像先经过一个双边低通滤波滤波器，得到Xb, 与原图X相减，得到噪声信息X-Xb
     3. 对噪声信息进行软阈值处理Xn: 先对Xn乘以一个降噪权重[0,1], 值越大降噪越强，然后限制阈值
     4. 原图X与噪声信号Xn相减，得到每层的输出
+    dst: 输出的缓冲区，None时新申请
     """
-    Xb = cv2.bilateralFilter(src, 5, strength, strength)
-    noise = src - Xb
-    Xn = np.clip(noise * noise_weight, -noise_threshold, noise_threshold)
-    return (src - Xn)
+    if (dst is None):
+        dst = np.empty_like(src)
+    # Xb, 噪声Xn和输出依次写到dst中
+    cv2.bilateralFilter(src, 5, strength, strength, dst=dst)
+    np.subtract(src, dst, out=dst)
+    dst *= noise_weight
+    np.clip(dst, -noise_threshold, noise_threshold, out=dst)
+    np.subtract(src, dst, out=dst)
+    return dst
+
+
+# 锐化的7x7滤波器，边缘检测、高通和低通
+SHARPEN_EDGE_KERNEL = np.array([
+    [0, 0, 0, 0, 0, 0, 0],
+    [-0.0208, -0.0208, 0.0208, 0.0417, 0.0208, -0.0208, -0.0208],
+    [-0.0833, -0.0833, 0.0833, 0.1667, 0.0833, -0.0833, -0.0833],
+    [-0.1250, -0.1250, 0.1250, 0.2500, 0.1250, -0.1250, -0.1250],
+    [-0.0833, -0.0833, 0.0833, 0.1667, 0.0833, -0.0833, -0.0833],
+    [-0.0208, -0.0208, 0.0208, 0.0417, 0.0208, -0.0208, -0.0208],
+    [0, 0, 0, 0, 0, 0, 0]
+], dtype=np.float32)
+
+SHARPEN_HPF_KERNEL = np.array([
+    [-0.0012, -0.0044, 0.0262, -0.0357, 0.0262, -0.0044, -0.0012],
+    [0.0170, -0.0625, 0.0291,  0.0541, 0.0291, -0.0625, -0.0170],
+    [-0.0287, -0.1027, 0.0016,  0.2298, 0.0016, -0.1027, -0.0287],
+    [-0.0003, -0.1456, 0.0331,  0.2317, 0.0331, -0.1456, -0.0003],
+    [-0.0287, -0.1027, 0.0016,  0.2298, 0.0016, -0.1027, -0.0287],
+    [0.0170, -0.0625, 0.0291,  0.0541, 0.0291, -0.0625, -0.0170],
+    [-0.0012, -0.0044, 0.0262, -0.0357, 0.0262, -0.0044, -0.0012],
+], dtype=np.float32)
+
+SHARPEN_LPF_KERNEL = np.array([
+    [0.00000067, 0.00002292, 0.00019117, 0.00038771,
+        0.00019117, 0.00002292, 0.00000067],
+    [0.00002292, 0.00078633, 0.00655965, 0.01330373,
+        0.00655965, 0.00078633, 0.00002292],
+    [0.00019117, 0.00655965, 0.05472157, 0.11098164,
+        0.05472157, 0.00655965, 0.00019117],
+    [0.00038771, 0.01330373, 0.11098164, 0.22508352,
+        0.11098164, 0.01330373, 0.00038771],
+    [0.00019117, 0.00655965, 0.05472157, 0.11098164,
+        0.05472157, 0.00655965, 0.00019117],
+    [0.00002292, 0.00078633, 0.00655965, 0.01330373,
+        0.00655965, 0.00078633, 0.00002292],
+    [0.00000067, 0.00002292, 0.00019117, 0.00038771,
+        0.00019117, 0.00002292, 0.00000067],
+], dtype=np.float32)
+
+
+class SharpenPlan(CachedPlan):
+    """
+    锐化的中间结果Xm、edge、Xedge和Y_LPF，按上一次输入的cache_key和中值滤波强度缓存，
+    同样大小的Y平面重复使用缓冲区
+    """
+
+    def __init__(self, key):
+        super().__init__(key)
+        self.intermediates = None
+
+    def cached_bytes(self):
+        if (self.intermediates is None):
+            return 0
+        return sum(data.nbytes for data in self.intermediates)
+
+    def prepare(self, Y, sp, content_key=None):
+        """
+        func: 计算只和Y以及中值滤波强度sp有关的中间结果，写到计划的缓冲区中，
+        content_key和上一次相同时直接返回缓存的结果
+        input: content_key是(Y所在图像的cache_key, sp)
+        ret: (Xm, edge, Xedge, Y_LPF)
+        """
+        if (self.is_cached(content_key)):
+            return self.intermediates
+        self.content_key = None
+        if (self.intermediates is None):
+            self.intermediates = tuple(np.empty(Y.shape, dtype=Y.dtype) for _ in range(4))
+        Xm, edge, Xedge, Y_LPF = self.intermediates
+        # 步骤1 进行一定权重的3x3的中值滤波
+        cv2.medianBlur(Y, 3, dst=Xm)
+        np.multiply(Xm, sp, out=Xm)
+        Xm += (1 - sp) * Y
+        # 步骤2.1 由于高通水平垂直边缘检测器以及水平垂直方向上的高通滤波器都是一样的，我这里就简化成一个
+        np.abs(ispfilter.filter2d(Xm, SHARPEN_EDGE_KERNEL, dst=edge), out=edge)
+        # 步骤3 对图Xm进行7x7的高通滤波
+        ispfilter.filter2d(Xm, SHARPEN_HPF_KERNEL, dst=Xedge)
+        # 步骤4 对图Xm进行7x7的低通滤波得到图像基础层Xsmooth
+        ispfilter.filter2d(Xm, SHARPEN_LPF_KERNEL, dst=Y_LPF)
+        self.content_key = content_key
+        return self.intermediates
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def sharpen_blend(Xm, edge, Xedge, Y_LPF, sharpen_strength, denoise_threshold, clip_range, dst):
+    """
+    锐化的步骤2.2、2.3、3和5，一次逐点计算，结果写到dst
+    """
+    one = np.float32(1)
+    for i in range(dst.shape[0]):
+        for j in range(dst.shape[1]):
+            # 步骤2.2 锐化权重LUT采用sigmod函数:1/(1+exp(-x))，用denoise_threshold区分锐化和降噪的区间
+            alpha = one / (one + np.exp(np.float32(-0.1) * (edge[i, j] - denoise_threshold)))
+            # 步骤2.3和3 锐化强度Xw与高通的结果相乘，然后进行反差的限制
+            Y_HPF = min(max(Xedge[i, j] * (sharpen_strength * alpha), -clip_range), clip_range) + Xm[i, j]
+            # 步骤5 Y = α ⋅ Y_HPF + (1−α) ⋅ Y_LPF
+            dst[i, j] = alpha * Y_HPF + (one - alpha) * Y_LPF[i, j]
 
 
 def sharpen(raw: RawImageInfo, params: RawImageParams):
@@ -524,80 +1232,30 @@ def sharpen(raw: RawImageInfo, params: RawImageParams):
     3. 对图Xm进行7x7的高通滤波，与锐化强度表Xw相乘，仅增强图像的边缘，得到锐化后的图像Xedge，然后对Xedge进行反差的限制
     4. 对图Xm进行7x7的低通滤波得到图像基础层Xsmooth
     5. 对Xedge乘以锐化权重α, 对Xsmooth乘以(1-α) , 两者相加得到最后的Xout. 公式为Y = α ⋅ Y_HPF + (1−α) ⋅ Y_LPF
+    brief: 步骤1、2.1、3、4的滤波只和Y以及中值滤波强度有关，结果按输入的cache_key缓存在SharpenPlan中，
+    只调节锐化强度、降噪阈值和钳位阈值时，只需要运行sharpen_blend一次逐点计算
     """
     sp = params.sharpen.medianblur_strength/100
     sharpen_strength = params.sharpen.sharpen_strength
     denoise_threshold = params.sharpen.denoise_threshold
     clip_range = params.sharpen.clip_range
 
-    edge_kernel = np.array([
-        [0, 0, 0, 0, 0, 0, 0],
-        [-0.0208, -0.0208, 0.0208, 0.0417, 0.0208, -0.0208, -0.0208],
-        [-0.0833, -0.0833, 0.0833, 0.1667, 0.0833, -0.0833, -0.0833],
-        [-0.1250, -0.1250, 0.1250, 0.2500, 0.1250, -0.1250, -0.1250],
-        [-0.0833, -0.0833, 0.0833, 0.1667, 0.0833, -0.0833, -0.0833],
-        [-0.0208, -0.0208, 0.0208, 0.0417, 0.0208, -0.0208, -0.0208],
-        [0, 0, 0, 0, 0, 0, 0]
-    ], dtype=np.float32)
-
-    hpf_kernel = np.array([
-        [-0.0012, -0.0044, 0.0262, -0.0357, 0.0262, -0.0044, -0.0012],
-        [0.0170, -0.0625, 0.0291,  0.0541, 0.0291, -0.0625, -0.0170],
-        [-0.0287, -0.1027, 0.0016,  0.2298, 0.0016, -0.1027, -0.0287],
-        [-0.0003, -0.1456, 0.0331,  0.2317, 0.0331, -0.1456, -0.0003],
-        [-0.0287, -0.1027, 0.0016,  0.2298, 0.0016, -0.1027, -0.0287],
-        [0.0170, -0.0625, 0.0291,  0.0541, 0.0291, -0.0625, -0.0170],
-        [-0.0012, -0.0044, 0.0262, -0.0357, 0.0262, -0.0044, -0.0012],
-    ], dtype=np.float32)
-
-    lpf_kernel = np.array([
-        [0.00000067, 0.00002292, 0.00019117, 0.00038771,
-            0.00019117, 0.00002292, 0.00000067],
-        [0.00002292, 0.00078633, 0.00655965, 0.01330373,
-            0.00655965, 0.00078633, 0.00002292],
-        [0.00019117, 0.00655965, 0.05472157, 0.11098164,
-            0.05472157, 0.00655965, 0.00019117],
-        [0.00038771, 0.01330373, 0.11098164, 0.22508352,
-            0.11098164, 0.01330373, 0.00038771],
-        [0.00019117, 0.00655965, 0.05472157, 0.11098164,
-            0.05472157, 0.00655965, 0.00019117],
-        [0.00002292, 0.00078633, 0.00655965, 0.01330373,
-            0.00655965, 0.00078633, 0.00002292],
-        [0.00000067, 0.00002292, 0.00019117, 0.00038771,
-            0.00019117, 0.00002292, 0.00000067],
-    ], dtype=np.float32)
-
     if (raw.get_color_space() == "YCrCb"):
         ret_img = RawImageInfo()
         ret_img.create_image('after yuv sharpen', raw)
         ret_img.set_color_space("YCrCb")
         raw_data = raw.get_raw_data()
         Y = raw_data[:, :, 0]
-        # 步骤1 进行一定权重的3x3的中值滤波
-        media = cv2.medianBlur(Y, 3)
-        Xm = sp * media + (1 - sp) * Y
-        del media
-
-        # 步骤2.1 由于高通水平垂直边缘检测器以及水平垂直方向上的高通滤波器都是一样的，我这里就简化成一个
-        edge = np.abs(cv2.filter2D(Xm, -1, edge_kernel))
-
-        # 步骤2.2 高通是自定义锐化权重LUT表，为了简化我就用一个denoise_threshold
-        # 将锐化和降噪的区间区分开来，LUT曲线采用sigmod函数:1/(1+exp(-x))
-        alpha = 1/(1 + np.exp(-0.1 * (edge-denoise_threshold)))
-
-        # 步骤2.3 高通是自定义锐化强度LUT表，为了简化我利用alpha权重表进行一个比例的缩放，得到锐化强度Xw
-        Xw = sharpen_strength * alpha
-
-        # 步骤3 对图Xm进行7x7的高通滤波，与锐化强度表Xw相乘，尽量仅增强图像的边缘，得到锐化后的图像Xedge，然后对Xedge进行反差的限制
-        Xedge = cv2.filter2D(Xm, -1, hpf_kernel)
-        after_clip = np.clip(Xedge * Xw, -clip_range, clip_range)
-        Y_HPF = (after_clip + Xm)
-
-        # 步骤4 对图Xm进行7x7的低通滤波得到图像基础层Xsmooth
-        Y_LPF = cv2.filter2D(Xm, -1, lpf_kernel)
-
-        # 步骤5 对Xedge乘以锐化权重α, 对Xsmooth乘以(1-α) , 两者相加得到最后的Xout. 公式为Y = α ⋅ Y_HPF + (1−α) ⋅ Y_LPF
-        ret_img.data[:, :, 0] = alpha * Y_HPF + (1 - alpha) * Y_LPF
+        key = ('sharpen', Y.shape, np.dtype(Y.dtype))
+        content_key = None if raw.cache_key is None else (raw.cache_key, sp)
+        plan = plan_pool.acquire(key, lambda: SharpenPlan(key), content_key)
+        try:
+            Xm, edge, Xedge, Y_LPF = plan.prepare(Y, sp, content_key)
+            dtype = Xm.dtype.type
+            sharpen_blend(Xm, edge, Xedge, Y_LPF, dtype(sharpen_strength), dtype(denoise_threshold),
+                          dtype(clip_range), ret_img.data[:, :, 0])
+        finally:
+            plan_pool.release(plan)
         ret_img.data[:, :, 1:] = raw_data[:, :, 1:]
         return ret_img
     else:
@@ -924,8 +1582,8 @@ class tone_mapping:
         # the mask image:   (1) blur
         #                   (2) bring within range 0 to 1
         #                   (3) multiply with strength_multiplier
-        mask = signal.convolve2d(
-            gray_image, gaussian_kernel, mode="same", boundary="symm")
+        mask = ispfilter.convolve2d(
+            gray_image, gaussian_kernel, border=cv2.BORDER_REFLECT)
         mask = strength_multiplier * mask / clip_range[1]
 
         # calculate the alpha image
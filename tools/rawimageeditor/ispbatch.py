@@ -0,0 +1,198 @@
+import argparse
+import glob
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispfunction as ispfunc
+import tools.rawimageeditor.isptile as isptile
+import tools.rawimageeditor.ispprofile as ispprofile
+
+# =============================================================
+# ISP批处理
+
+#   不依赖Qt界面，用命令行批量处理raw图，每个文件分配到一个进程上运行
+#   python -m tools.rawimageeditor.ispbatch ./raw/ --params ./config/RawImageEditor.tmp
+#       --pipeline "original raw,black level,demosaic,awb,ccm,gamma,csc" --output ./out
+#   --profile ./profile.csv 保存每个文件每个节点的耗时、CPU时间、峰值内存以及输入输出的大小
+# =============================================================
+
+DEFAULT_PARAMS_FILE = './config/RawImageEditor.tmp'
+
+
+def find_raw_files(inputs):
+    """
+    func: 输入可以是目录、文件或者通配符，返回所有的raw图路径
+    """
+    files = []
+    for path in inputs:
+        if (os.path.isdir(path)):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.raw'))))
+        elif (os.path.isfile(path)):
+            files.append(path)
+        else:
+            files.extend(sorted(glob.glob(path, recursive=True)))
+    return files
+
+
+def load_params(filename):
+    """
+    func: 加载RawImageEditor保存的参数
+    """
+    with open(filename, "rb") as fp:
+        params = pickle.load(fp)
+    if (not isinstance(params, RawImageParams)):
+        raise TypeError("{}不是RawImageEditor的参数文件".format(filename))
+    return params
+
+
+def parse_pipeline(pipeline):
+    """
+    func: 解析逗号分隔的pipeline，检查节点是否存在
+    """
+    nodes = [node.strip().lower() for node in pipeline.split(',') if node.strip() != '']
+    for node in nodes:
+        if (node not in ispfunc.pipeline_dict or ispfunc.pipeline_dict[node] is None):
+            raise ValueError("不支持的ISP节点: {}".format(node))
+    if (len(nodes) == 0 or nodes[0] != 'original raw'):
+        nodes.insert(0, 'original raw')
+    return nodes
+
+
+def process_file(filename, params: RawImageParams, pipeline, output_dir=None, tile_size=0, trace_memory=False):
+    """
+    func: 处理一张raw图
+    input: trace_memory为True时统计每个节点的峰值内存
+    ret: dict, 包括文件名，每个节点的性能记录(格式见ispprofile.PROFILE_FIELDS)，总耗时以及错误信息
+    """
+    params.rawformat.filename = filename
+    result = {'filename': filename, 'nodes': [], 'total': 0., 'error': None}
+    start_time = time.time()
+    img = RawImageInfo()
+    if (tile_size > 0):
+        img, record = ispprofile.profile_call(
+            'tiled', lambda raw: isptile.run_tiled(pipeline, raw, params, tile_size), img, trace_memory)
+        result['nodes'].append(record)
+    else:
+        for nodes in ispfunc.group_pipeline(pipeline):
+            img, record = ispprofile.profile_call(
+                '+'.join(nodes), lambda raw: ispfunc.run_nodes(nodes, raw, params), img, trace_memory)
+            result['nodes'].append(record)
+            if (img is None):
+                break
+    if (img is None):
+        result['error'] = params.get_error_str()
+    elif (output_dir is not None):
+        name = os.path.splitext(os.path.basename(filename))[0] + '.jpg'
+        img.get_showimage()
+        img.save_image(os.path.join(output_dir, name))
+    result['total'] = time.time() - start_time
+    return result
+
+
+def init_worker():
+    # 每个进程处理一个文件，opencv内部就不需要再开多线程了，防止线程数超过CPU核数
+    cv2.setNumThreads(1)
+
+
+def run_batch(files, params: RawImageParams, pipeline, workers=None, output_dir=None, tile_size=0, callback=None,
+              trace_memory=False):
+    """
+    func: 用进程池批量处理raw图，callback(result)在每个文件处理完成后调用
+    ret: 按照输入顺序排列的结果列表
+    """
+    if (output_dir is not None and not os.path.exists(output_dir)):
+        os.makedirs(output_dir)
+    results = [None] * len(files)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = {executor.submit(process_file, filename, params, pipeline, output_dir, tile_size, trace_memory): i
+                   for i, filename in enumerate(files)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'filename': files[i], 'nodes': [], 'total': 0., 'error': str(e)}
+            results[i] = result
+            if (callback is not None):
+                callback(result)
+    return results
+
+
+def print_result(result):
+    if (result['error'] is not None):
+        print("{}: 错误 {}".format(result['filename'], result['error']))
+        return
+    print("{}: 总耗时 {:.3f}s".format(result['filename'], result['total']))
+    for record in result['nodes']:
+        print("    {:<24}{:.3f}s".format(record['node'], record['wall_time']))
+
+
+def print_summary(results, cost_time):
+    """
+    func: 打印每个节点的平均耗时
+    """
+    node_costs = dict()
+    for result in results:
+        if (result['error'] is None):
+            for record in result['nodes']:
+                node_costs.setdefault(record['node'], []).append(record['wall_time'])
+    failed = sum(1 for result in results if result['error'] is not None)
+    print("共处理{}个文件，失败{}个，总耗时 {:.3f}s".format(len(results), failed, cost_time))
+    for node, costs in node_costs.items():
+        print("    {:<24}平均 {:.3f}s  总计 {:.3f}s".format(node, sum(costs) / len(costs), sum(costs)))
+
+
+def write_profile(results, filename):
+    """
+    func: 把所有文件的性能记录保存到一个文件中，每条记录加上文件名
+    """
+    records = []
+    for result in results:
+        for record in result['nodes']:
+            records.append(dict(filename=result['filename'], **record))
+    ispprofile.write_profile(records, filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ISP批处理工具')
+    parser.add_argument('inputs', nargs='+', help='raw图文件、目录或者通配符')
+    parser.add_argument('--params', default=DEFAULT_PARAMS_FILE, help='RawImageEditor保存的参数文件')
+    parser.add_argument('--pipeline', required=True, help='逗号分隔的ISP流程，如"black level,demosaic,gamma"')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='进程数，默认为CPU核数')
+    parser.add_argument('--output', default=None, help='输出jpg图像的目录，不设置则不保存')
+    parser.add_argument('--tile-size', type=int, default=0, help='分块处理的大小，0表示整帧处理')
+    parser.add_argument('--fixed-point', action='store_true', help='使用定点模式处理')
+    parser.add_argument('--gamma-curve', default=None, help='自定义gamma曲线文件，1025个节点')
+    parser.add_argument('--defect-table', default=None, help='sensor坏点表文件，每行一个坏点的x y坐标')
+    parser.add_argument('--profile', default=None, help='保存每个节点的性能记录，后缀为.csv时保存成csv，否则保存成json')
+    args = parser.parse_args(argv)
+
+    files = find_raw_files(args.inputs)
+    if (len(files) == 0):
+        print("没有找到raw图")
+        return 1
+    params = load_params(args.params)
+    if (args.fixed_point is True):
+        params.rawformat.set_fixed_point(True)
+    if (args.gamma_curve is not None):
+        params.gamma.load_gamma_curve(args.gamma_curve)
+    if (args.defect_table is not None):
+        params.bpc.load_defect_table(args.defect_table)
+    pipeline = parse_pipeline(args.pipeline)
+
+    start_time = time.time()
+    results = run_batch(files, params, pipeline, args.workers, args.output, args.tile_size, print_result,
+                        trace_memory=args.profile is not None)
+    print_summary(results, time.time() - start_time)
+    if (args.profile is not None):
+        write_profile(results, args.profile)
+    return 0 if all(result['error'] is None for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import numpy as np
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+from tools.rawimageeditor.utility import synthetic_image_generate
+import tools.rawimageeditor.ispfunction as ispfunc
+import tools.rawimageeditor.ispprofile as ispprofile
+
+# =============================================================
+# ISP节点的性能测试
+
+#   用synthetic_image_generate生成固定种子的合成raw图，覆盖不同的分辨率和四种bayer pattern，
+#   按pipeline_dict的顺序运行每个节点，再单独运行每一种demosaic算法，记录耗时和峰值内存，
+#   和保存的基准结果对比，耗时或者内存超过容差时报告性能回退
+#   python -m tools.rawimageeditor.ispbench --sizes 2mp,12mp --baseline ./config/isp_benchmark.json
+#   耗时是repeat次运行中最短的一次，峰值内存单独运行一次统计，tracemalloc不影响计时
+# =============================================================
+
+# 测试的分辨率 (宽, 高)
+BENCH_SIZES = {
+    '2mp': (1920, 1080),
+    '8mp': (3840, 2160),
+    '12mp': (4000, 3000),
+    '48mp': (8000, 6000),
+}
+BENCH_PATTERNS = ['rggb', 'grbg', 'gbrg', 'bggr']
+DEMOSAIC_TYPES = ['双线性插值', 'Malvar2004', 'Menon2007']
+BIT_DEPTH = 12
+# 耗时超过基准的(1 + tolerance)倍时认为性能回退，耗时很短的节点误差太大，不参与比较
+DEFAULT_TOLERANCE = 0.25
+MIN_COMPARE_TIME = 0.005
+
+
+def create_synthetic_raw(width, height, pattern, seed=0):
+    """
+    func: 生成固定种子的合成raw图，uint16，BIT_DEPTH位
+    brief: 亮度是从左上到右下的渐变，每个bayer通道乘以不同的增益，模拟有颜色的场景，再加上高斯噪声
+    """
+    max_value = (1 << BIT_DEPTH) - 1
+    ramp_y = np.linspace(0.1, 0.6, height, dtype=np.float32)[:, None]
+    ramp_x = np.linspace(0., 0.3, width, dtype=np.float32)[None, :]
+    base = (ramp_y + ramp_x) * max_value
+    channel_gain = {'r': 0.6, 'g': 1.0, 'b': 0.8}
+    for (y, x), color in zip([(0, 0), (0, 1), (1, 0), (1, 1)], pattern):
+        base[y::2, x::2] *= channel_gain[color]
+    noisy = synthetic_image_generate(width, height).create_noisy_image(
+        base, standard_deviation=max_value / 200, seed=seed, clip_range=[0, max_value])
+    return noisy.astype(np.uint16)
+
+
+def create_bench_params(filename, width, height, pattern):
+    """
+    func: 性能测试使用的参数，除了raw图格式以外都是默认值
+    """
+    params = RawImageParams()
+    params.rawformat.filename = filename
+    params.rawformat.width = width
+    params.rawformat.height = height
+    params.rawformat.bit_depth = BIT_DEPTH
+    params.rawformat.pattern = pattern
+    return params
+
+
+def get_bench_nodes():
+    """
+    func: 按pipeline_dict的顺序返回所有实现了的节点
+    """
+    return [node for node, func in ispfunc.pipeline_dict.items() if func is not None]
+
+
+def run_chain(params: RawImageParams, trace_memory):
+    """
+    func: 按顺序运行所有节点，再在demosaic的输入上运行每一种demosaic算法
+    ret: {节点名: 记录}
+    """
+    records = dict()
+    img = RawImageInfo()
+    demosaic_input = None
+    for node in get_bench_nodes():
+        if (node == 'demosaic'):
+            demosaic_input = img
+        img, records[node] = ispprofile.profile_call(node, lambda raw: ispfunc.pipeline_dict[node](raw, params),
+                                                     img, trace_memory)
+        if (img is None):
+            raise RuntimeError("ISP节点[{}]运行错误: {}".format(node, params.get_error_str()))
+    func_type = params.demosaic.get_demosaic_func_string()
+    for demosaic_type in DEMOSAIC_TYPES:
+        params.demosaic.set_demosaic_func_type(demosaic_type)
+        name = 'demosaic[{}]'.format(demosaic_type)
+        _, records[name] = ispprofile.profile_call(name, lambda raw: ispfunc.pipeline_dict['demosaic'](raw, params),
+                                                   demosaic_input, trace_memory)
+    params.demosaic.set_demosaic_func_type(func_type)
+    return records
+
+
+def run_bench(sizes=None, patterns=None, repeat=3, callback=None):
+    """
+    func: 运行性能测试
+    input: sizes是{名称: (宽, 高)}，None表示BENCH_SIZES，patterns为None表示四种bayer pattern
+    callback(key, result)在每个节点测试完成后调用
+    ret: {"尺寸/pattern/节点": {'wall_time', 'cpu_time', 'peak_bytes'}}
+    """
+    ispfunc.isp.warmup_jit()
+    ispfunc.debayer.warmup_jit()
+    if (sizes is None):
+        sizes = BENCH_SIZES
+    if (patterns is None):
+        patterns = BENCH_PATTERNS
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size_name, (width, height) in sizes.items():
+            for pattern in patterns:
+                filename = os.path.join(tmp_dir, '{}_{}.raw'.format(size_name, pattern))
+                create_synthetic_raw(width, height, pattern).tofile(filename)
+                params = create_bench_params(filename, width, height, pattern)
+                memory = run_chain(params, True)
+                timings = [run_chain(params, False) for _ in range(repeat)]
+                for node, record in memory.items():
+                    best = min((timing[node] for timing in timings), key=lambda r: r['wall_time'])
+                    key = '{}/{}/{}'.format(size_name, pattern, node)
+                    results[key] = {'wall_time': best['wall_time'], 'cpu_time': best['cpu_time'],
+                                    'peak_bytes': record['peak_bytes']}
+                    if (callback is not None):
+                        callback(key, results[key])
+                os.remove(filename)
+    return results
+
+
+def compare_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE, min_time=MIN_COMPARE_TIME):
+    """
+    func: 和基准结果对比
+    ret: 性能回退的描述列表，基准中没有的测试项不比较
+    """
+    regressions = []
+    for key, result in results.items():
+        if (key not in baseline):
+            continue
+        base = baseline[key]
+        if (max(result['wall_time'], base['wall_time']) >= min_time and
+                result['wall_time'] > base['wall_time'] * (1 + tolerance)):
+            regressions.append("{}: 耗时 {:.3f}s -> {:.3f}s".format(key, base['wall_time'], result['wall_time']))
+        if (base.get('peak_bytes') and result['peak_bytes'] > base['peak_bytes'] * (1 + tolerance)):
+            regressions.append("{}: 峰值内存 {:.1f}MB -> {:.1f}MB".format(
+                key, base['peak_bytes'] / (1 << 20), result['peak_bytes'] / (1 << 20)))
+    return regressions
+
+
+def save_results(results, filename):
+    """
+    func: 保存测试结果，同时记录测试环境
+    """
+    meta = {'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'cpu_count': os.cpu_count()}
+    dirname = os.path.dirname(filename)
+    if (dirname != '' and not os.path.exists(dirname)):
+        os.makedirs(dirname)
+    with open(filename, 'w') as fp:
+        json.dump({'meta': meta, 'results': results}, fp, indent=2)
+
+
+def load_results(filename):
+    with open(filename) as fp:
+        return json.load(fp)['results']
+
+
+def parse_sizes(sizes):
+    """
+    func: 解析逗号分隔的分辨率，可以是BENCH_SIZES中的名称，也可以是"宽x高"
+    """
+    ret = dict()
+    for size in sizes.split(','):
+        size = size.strip().lower()
+        if (size in BENCH_SIZES):
+            ret[size] = BENCH_SIZES[size]
+        elif ('x' in size):
+            width, height = size.split('x')
+            ret[size] = (int(width), int(height))
+        elif (size != ''):
+            raise ValueError("不支持的分辨率: {}".format(size))
+    return ret
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ISP节点性能测试')
+    parser.add_argument('--sizes', default=','.join(BENCH_SIZES), help='逗号分隔的分辨率，如"2mp,12mp"或者"1920x1080"')
+    parser.add_argument('--patterns', default=','.join(BENCH_PATTERNS), help='逗号分隔的bayer pattern')
+    parser.add_argument('--repeat', type=int, default=3, help='每个节点的运行次数，取最短的耗时')
+    parser.add_argument('--output', default=None, help='保存测试结果的json文件')
+    parser.add_argument('--baseline', default=None, help='基准结果的json文件，性能回退时返回1')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='允许的性能下降比例')
+    args = parser.parse_args(argv)
+
+    patterns = [pattern.strip().lower() for pattern in args.patterns.split(',') if pattern.strip() != '']
+    results = run_bench(parse_sizes(args.sizes), patterns, args.repeat,
+                        lambda key, result: print("{:<48}{:.3f}s  {:.1f}MB".format(
+                            key, result['wall_time'], result['peak_bytes'] / (1 << 20))))
+    if (args.output is not None):
+        save_results(results, args.output)
+    if (args.baseline is not None):
+        regressions = compare_baseline(results, load_results(args.baseline), args.tolerance)
+        for regression in regressions:
+            print("性能回退 " + regression)
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,370 @@
+import glob
+import hashlib
+import inspect
+import json
+import os
+import sys
+import types
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispfunction as ispfunc
+
+# =============================================================
+# ISP节点结果缓存
+
+#   每个节点的输出以(输入图像的hash, 节点名称, 节点参数的hash)为key进行缓存，
+#   输入图像的hash是沿着pipeline链式计算的，只有原始raw图需要计算数据本身的hash。
+#   这样来回切换gamma, CCM等参数时，可以直接命中缓存，不需要重新跑一遍整个pipeline
+#   同样的key也用于磁盘缓存(DiskCache)，key已经包含了raw图内容的hash以及pipeline上每个节点的参数，
+#   关闭程序后再打开同一幅raw图，参数没有变化时，直接从磁盘读取最终(以及部分中间)的结果
+# =============================================================
+
+# 参数里面的大数组(比如平场图)每次都计算hash太慢，按照数组对象缓存其hash
+_array_hash_cache = OrderedDict()
+_ARRAY_HASH_CACHE_SIZE = 8
+# 算法版本包含的模块所在的包
+ALGORITHM_PACKAGE = 'tools.rawimageeditor.'
+
+
+def array_hash(data):
+    """
+    func: 计算numpy数组内容的hash
+    """
+    data = np.ascontiguousarray(data)
+    h = hashlib.md5()
+    h.update(str(data.dtype).encode())
+    h.update(str(data.shape).encode())
+    h.update(data.data)
+    return h.hexdigest()
+
+
+def image_data(raw: RawImageInfo):
+    """
+    func: 获取图像的数据，内存映射加载还没有转换的图像直接返回原始数据，避免整幅图的转换
+    """
+    raw_map = raw.get_raw_map()
+    if (raw_map is not None):
+        return raw_map
+    return raw.get_raw_data()
+
+
+def image_hash(raw: RawImageInfo):
+    """
+    func: 计算图像内容以及属性的hash
+    brief: 内存映射加载还没有转换的图像，hash的是文件中的原始数据，float和定点模式下是相同的，
+    所以还需要加上转换后的数据类型
+    """
+    h = hashlib.md5()
+    h.update(array_hash(image_data(raw)).encode())
+    h.update(repr((raw.get_color_space(), raw.get_bayer_pattern(), raw.get_bit_depth(),
+                   raw.get_raw_bit_depth(), raw.max_data, np.dtype(raw.dtype).str)).encode())
+    return h.hexdigest()
+
+
+def params_hash(params):
+    """
+    func: 计算参数类的hash, 包括类属性和实例属性, 不包括need_flush这种状态标志
+    """
+    h = hashlib.md5()
+    _update_hash(h, params)
+    return h.hexdigest()
+
+
+def _update_hash(h, value):
+    if (isinstance(value, np.ndarray)):
+        key = id(value)
+        if (key in _array_hash_cache and _array_hash_cache[key][0] is value):
+            digest = _array_hash_cache[key][1]
+        else:
+            digest = array_hash(value)
+            _array_hash_cache[key] = (value, digest)
+            while len(_array_hash_cache) > _ARRAY_HASH_CACHE_SIZE:
+                _array_hash_cache.popitem(last=False)
+        h.update(digest.encode())
+    elif (isinstance(value, (list, tuple))):
+        h.update(b'[')
+        for item in value:
+            _update_hash(h, item)
+            h.update(b',')
+        h.update(b']')
+    elif (isinstance(value, dict)):
+        _update_hash(h, sorted(value.items()))
+    elif (hasattr(value, '__dict__') and not isinstance(value, type)):
+        h.update(type(value).__name__.encode())
+        for name in sorted(dir(value)):
+            if (name.startswith('__') or name == 'need_flush'):
+                continue
+            attr = getattr(value, name)
+            if (callable(attr)):
+                continue
+            h.update(name.encode())
+            _update_hash(h, attr)
+    else:
+        h.update(repr(value).encode())
+
+
+def node_key(input_key, node, params: RawImageParams):
+    """
+    func: 计算节点输出的key, 输入图像没有key时返回None(不进行缓存)
+    """
+    if (input_key is None):
+        return None
+    h = hashlib.md5()
+    h.update(input_key.encode())
+    h.update(node.encode())
+    params_name = ispfunc.pipeline_params_dict.get(node)
+    if (params_name is not None):
+        h.update(params_hash(getattr(params, params_name)).encode())
+    return h.hexdigest()
+
+
+class NodeCache():
+    """
+    ISP节点结果的LRU缓存，按照图像数据的字节数限制内存占用
+    """
+
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.cache = OrderedDict()
+        self.mutex = Lock()
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.mutex.acquire()
+        self.__evict()
+        self.mutex.release()
+
+    def get(self, key):
+        """
+        func: 获取缓存的图像，没有命中就返回None
+        """
+        if (key is None):
+            return None
+        self.mutex.acquire()
+        ret_img = None
+        if (key in self.cache):
+            ret_img = self.cache[key][0]
+            self.cache.move_to_end(key)
+        self.mutex.release()
+        return ret_img
+
+    def put(self, key, img: RawImageInfo):
+        """
+        func: 缓存一幅图像，超过内存限制时从最久没有使用的开始删除
+        """
+        if (key is None or img is None or image_data(img) is None):
+            return
+        # 内存映射的图像之后可能会被转换，所以这里记录下加入缓存时的大小
+        nbytes = image_data(img).nbytes
+        if (nbytes > self.max_bytes):
+            return
+        self.mutex.acquire()
+        if (key in self.cache):
+            self.used_bytes -= self.cache.pop(key)[1]
+        self.cache[key] = (img, nbytes)
+        self.used_bytes += nbytes
+        self.__evict()
+        self.mutex.release()
+
+    def discard(self, key):
+        """
+        func: 删除一个缓存的图像
+        """
+        self.mutex.acquire()
+        if (key in self.cache):
+            self.used_bytes -= self.cache.pop(key)[1]
+        self.mutex.release()
+
+    def clear(self):
+        self.mutex.acquire()
+        self.cache.clear()
+        self.used_bytes = 0
+        self.mutex.release()
+
+    def __evict(self):
+        while self.used_bytes > self.max_bytes and len(self.cache) > 0:
+            _, (_, nbytes) = self.cache.popitem(last=False)
+            self.used_bytes -= nbytes
+
+
+# 除了最终结果以外，这些节点的输出也保存到磁盘缓存，之后只修改后面节点的参数时不需要从头运行
+DISK_CACHE_NODES = ['demosaic']
+
+
+def get_algorithm_modules(module=ispfunc, modules=None):
+    """
+    func: ISP节点直接或者间接import的本工程的模块(包括from import的类和函数所在的模块)
+    ret: 按模块名排序的列表
+    """
+    if (modules is None):
+        modules = {}
+    modules[module.__name__] = module
+    for value in vars(module).values():
+        if (isinstance(value, types.ModuleType)):
+            name = value.__name__
+        else:
+            name = getattr(value, '__module__', None)
+        if (isinstance(name, str) and name.startswith(ALGORITHM_PACKAGE) and name not in modules
+                and name in sys.modules):
+            get_algorithm_modules(sys.modules[name], modules)
+    return [modules[name] for name in sorted(modules)]
+
+
+def algorithm_version():
+    """
+    func: ISP算法源码的hash，算法修改(包括热更新)后之前的磁盘缓存就不再命中
+    brief: 包含节点用到的所有模块，比如ispfilter、utility、rawunpack以及RawImageInfo
+    """
+    h = hashlib.md5()
+    for module in get_algorithm_modules():
+        h.update(module.__name__.encode())
+        with open(inspect.getsourcefile(module), 'rb') as fp:
+            h.update(fp.read())
+    return h.hexdigest()
+
+
+class DiskCache():
+    """
+    ISP节点结果的磁盘缓存，关闭程序之后仍然有效
+    每个结果保存成两个文件: key.npy是图像数据，key.json是图像的属性(颜色空间、bayer pattern、位深等)
+    属性不用pickle保存，读取缓存目录里的文件不会执行任意代码，RawImageInfo修改后也能读取
+    图像数据以只读的内存映射方式读取，用到的时候才从磁盘加载
+    读取的时候更新文件的修改时间，超过max_bytes时删除修改时间最早的结果
+    """
+
+    def __init__(self, cache_dir, max_bytes=4 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.version = algorithm_version()
+        self.mutex = Lock()
+        if (not os.path.exists(cache_dir)):
+            os.makedirs(cache_dir)
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.mutex.acquire()
+        self.__evict()
+        self.mutex.release()
+
+    def update_version(self):
+        """
+        func: 热更新算法之后调用，重新计算算法的版本
+        """
+        self.version = algorithm_version()
+
+    def get_path(self, key):
+        """
+        func: 结果保存的路径(不带后缀)，文件名里包含了算法的版本
+        """
+        h = hashlib.md5()
+        h.update(key.encode())
+        h.update(self.version.encode())
+        return os.path.join(self.cache_dir, h.hexdigest())
+
+    def contains(self, key):
+        return key is not None and os.path.exists(self.get_path(key) + '.npy')
+
+    def get(self, key):
+        """
+        func: 读取缓存的图像，没有命中或者文件损坏时返回None
+        """
+        if (not self.contains(key)):
+            return None
+        path = self.get_path(key)
+        try:
+            with open(path + '.json', 'r') as fp:
+                meta = json.load(fp)
+            data = np.load(path + '.npy', mmap_mode='r')
+            if (list(data.shape) != meta['shape'] or data.dtype.str != meta['data_dtype']):
+                raise ValueError('cache meta does not match data')
+            ret_img = RawImageInfo()
+            ret_img.data = data
+            ret_img.set_name(meta['name'])
+            ret_img.dtype = np.dtype(meta['dtype']).type
+            ret_img.set_color_space(meta['color_space'])
+            ret_img.set_bayer_pattern(meta['bayer_pattern'])
+            ret_img.set_raw_bit_depth(meta['raw_bit_depth'])
+            ret_img.set_bit_depth(meta['bit_depth'])
+            ret_img.max_data = meta['max_data']
+            os.utime(path + '.npy')
+        except Exception:
+            self.__remove(path)
+            return None
+        ret_img.cache_key = key
+        return ret_img
+
+    def put(self, key, img: RawImageInfo):
+        """
+        func: 保存一幅图像，已经保存过的只更新修改时间
+        brief: 先写到临时文件再重命名，程序中途退出也不会留下不完整的结果
+        """
+        if (key is None or img is None or img.get_raw_data() is None):
+            return
+        path = self.get_path(key)
+        if (os.path.exists(path + '.npy')):
+            os.utime(path + '.npy')
+            return
+        data = img.get_raw_data()
+        if (data.nbytes > self.max_bytes):
+            return
+        meta = {
+            'shape': list(data.shape),
+            'data_dtype': data.dtype.str,
+            'name': getattr(img, 'name', None),
+            'dtype': np.dtype(img.dtype).str,
+            'color_space': img.get_color_space(),
+            'bayer_pattern': img.get_bayer_pattern(),
+            'raw_bit_depth': int(img.get_raw_bit_depth()),
+            'bit_depth': int(img.get_bit_depth()),
+            'max_data': img.max_data.item() if isinstance(img.max_data, np.generic) else img.max_data,
+        }
+        try:
+            with open(path + '.json.tmp', 'w') as fp:
+                json.dump(meta, fp)
+            with open(path + '.npy.tmp', 'wb') as fp:
+                np.save(fp, data)
+            os.replace(path + '.json.tmp', path + '.json')
+            os.replace(path + '.npy.tmp', path + '.npy')
+        except OSError:
+            self.__remove(path)
+            return
+        self.mutex.acquire()
+        self.__evict()
+        self.mutex.release()
+
+    def used_bytes(self):
+        return sum(os.path.getsize(filename) for filename in glob.glob(os.path.join(self.cache_dir, '*.npy')))
+
+    def clear(self):
+        self.mutex.acquire()
+        for filename in glob.glob(os.path.join(self.cache_dir, '*.npy')):
+            self.__remove(filename[:-len('.npy')])
+        self.mutex.release()
+
+    def __remove(self, path):
+        # .pkl是旧版本保存的属性文件
+        for suffix in ['.npy', '.json', '.npy.tmp', '.json.tmp', '.pkl']:
+            try:
+                os.remove(path + suffix)
+            except OSError:
+                pass
+
+    def __evict(self):
+        entries = []
+        for filename in glob.glob(os.path.join(self.cache_dir, '*.npy')):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        entries.sort()
+        used_bytes = sum(entry[1] for entry in entries)
+        for _, size, filename in entries:
+            if (used_bytes <= self.max_bytes):
+                break
+            self.__remove(filename[:-len('.npy')])
+            used_bytes -= size
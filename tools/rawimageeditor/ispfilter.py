@@ -0,0 +1,345 @@
+from collections import OrderedDict
+from threading import Lock
+import cv2
+import numpy as np
+from numba import jit
+
+# =============================================================
+# 二维滤波
+
+#   ISP和utility中的滤波都通过filter2d/convolve2d进行，
+#   滤波器先用SVD分解成若干个秩为1的可分离滤波器(行向量x列向量)，
+#   可分离的计算量比二维滤波小的时候(比如高斯核)，用cv2.sepFilter2D分两次一维滤波，
+#   否则用cv2.filter2D进行二维滤波，opencv在滤波器大于等于11x11时内部会自动改用DFT计算，
+#   12MP的图像上比scipy的fftconvolve还快一倍，所以大滤波器的频域计算直接交给opencv
+#   分解的结果按滤波器的内容缓存，同一个滤波器只分解一次
+# =============================================================
+
+# 奇异值小于最大奇异值的SVD_TOLERANCE倍时忽略，float32的精度下分解前后的结果没有区别
+SVD_TOLERANCE = 1e-6
+# 可分离的计算量(每个秩kh+kw次乘加)不超过二维滤波(kh*kw)的SEPARABLE_RATIO倍时才分离，
+# 每个秩都要多遍历一次图像，分离的收益要足够大
+SEPARABLE_RATIO = 0.5
+# opencv滤波支持的数据类型，其他类型先转换成float64
+CV_FILTER_DTYPES = [np.uint8, np.uint16, np.int16, np.float32, np.float64]
+
+_decompose_cache = OrderedDict()
+_decompose_cache_lock = Lock()
+_DECOMPOSE_CACHE_SIZE = 64
+
+
+def decompose_kernel(kernel):
+    """
+    func: 用SVD把滤波器分解成秩为1的滤波器之和 kernel = sum(col_i * row_i)
+    ret: [(列向量, 行向量), ...]，按奇异值从大到小排列，全0的滤波器返回[]
+    """
+    kernel = np.asarray(kernel, dtype=np.float64)
+    u, s, vt = np.linalg.svd(kernel)
+    if (len(s) == 0 or s[0] == 0):
+        return []
+    rank = int(np.sum(s > s[0] * SVD_TOLERANCE))
+    return [(u[:, i] * np.sqrt(s[i]), vt[i] * np.sqrt(s[i])) for i in range(rank)]
+
+
+def get_filter_plan(kernel):
+    """
+    func: 选择滤波的方式，结果按滤波器的内容缓存
+    ret: ('separable', [(列向量, 行向量), ...]) 或者 ('dense', kernel)
+    """
+    kernel = np.ascontiguousarray(kernel, dtype=np.float64)
+    key = (kernel.shape, kernel.tobytes())
+    with _decompose_cache_lock:
+        if (key in _decompose_cache):
+            _decompose_cache.move_to_end(key)
+            return _decompose_cache[key]
+    terms = decompose_kernel(kernel)
+    kh, kw = kernel.shape
+    if (len(terms) > 0 and len(terms) * (kh + kw) <= kh * kw * SEPARABLE_RATIO):
+        plan = ('separable', terms)
+    else:
+        plan = ('dense', kernel)
+    with _decompose_cache_lock:
+        _decompose_cache[key] = plan
+        while len(_decompose_cache) > _DECOMPOSE_CACHE_SIZE:
+            _decompose_cache.popitem(last=False)
+    return plan
+
+
+def filter2d(src, kernel, border=cv2.BORDER_REFLECT_101, dst=None):
+    """
+    func: 二维相关滤波，和cv2.filter2D(src, -1, kernel, borderType=border)的结果相同(误差在浮点精度以内)
+    input: src是二维图像，多通道图像每个通道分别滤波；dst不为None时结果写到dst中
+    ret: 和src类型相同的图像，src的类型opencv不支持时为float64
+    """
+    src = np.asarray(src)
+    if (src.dtype.type not in CV_FILTER_DTYPES):
+        src = src.astype(np.float64)
+    method, value = get_filter_plan(kernel)
+    if (method == 'dense'):
+        if (dst is None):
+            return cv2.filter2D(src, -1, value, borderType=border)
+        return cv2.filter2D(src, -1, value, dst=dst, borderType=border)
+    ret = None
+    for col, row in value:
+        filtered = cv2.sepFilter2D(src, cv2.CV_32F if src.dtype != np.float64 else cv2.CV_64F,
+                                   row, col, borderType=border)
+        if (ret is None):
+            ret = filtered
+        else:
+            ret += filtered
+    if (ret.dtype != src.dtype):
+        if (np.issubdtype(src.dtype, np.integer)):
+            info = np.iinfo(src.dtype)
+            ret = np.clip(np.rint(ret), info.min, info.max)
+        ret = ret.astype(src.dtype)
+    if (dst is not None):
+        dst[...] = ret
+        return dst
+    return ret
+
+
+def convolve2d(src, kernel, border=cv2.BORDER_REFLECT_101, dst=None):
+    """
+    func: 二维卷积，滤波器旋转180度后进行相关滤波
+    brief: scipy.signal.convolve2d(src, kernel, mode="same", boundary="symm")对应border=cv2.BORDER_REFLECT
+    """
+    return filter2d(src, np.asarray(kernel)[::-1, ::-1], border, dst)
+
+
+# =============================================================
+# 双边网格
+#   Chen, Paris, Durand 2007的双边网格，按(行, 列, 边缘图的值)把像素累加(splat)到三维网格中，
+#   网格上做三个方向的可分离高斯模糊，再按每个像素的位置和值三线性插值(slice)得到结果，
+#   网格的采样间隔等于sigma，在网格上的高斯核只有3个点，
+#   网格的大小是(高/sigma_spatial)x(宽/sigma_spatial)x(值域/sigma_range)，sigma越大网格越小，
+#   累加的值和像素个数分别插值之后再相除，空的格子不会把结果拉向0，
+#   值域的层数多的时候按层分段处理，每段只处理落在这几层的像素，没有像素的段直接跳过
+# =============================================================
+
+# 每一段网格最多的格子数，float32的网格和权重一共128MB
+BILATERAL_GRID_MAX_CELLS = 1 << 24
+# 值域方向最多的层数，只有值域和sigma_range的比值超过时才增大值域的采样间隔
+BILATERAL_GRID_MAX_DEPTH = 1 << 16
+
+
+def get_grid_kernel(derived_sigma):
+    """
+    func: 网格上的3点高斯核，derived_sigma是sigma和采样间隔的比值(不大于1)
+    """
+    if (derived_sigma <= 0):
+        return np.array([0., 1., 0.], dtype=np.float32)
+    side = np.exp(-0.5 / (derived_sigma * derived_sigma))
+    return np.array([side, 1., side], dtype=np.float32)
+
+
+def bilateral_grid(data, edge=None, sigma_spatial=None, sigma_range=None, value_range=None, origin=(0, 0)):
+    """
+    func: 用双边网格实现的双边滤波
+    input: data是二维图像，data或者edge为NaN的像素不参与滤波，输出NaN
+           edge是计算值域权重的二维图像，None时使用data(普通的双边滤波)，否则是联合(交叉)双边滤波
+           sigma_spatial默认是短边的1/16，sigma_range默认是edge值域的0.1倍
+           value_range是固定的值域(最小值, 最大值)，超出的值按边界处理，None时使用edge的值域
+           origin是data[0, 0]在整帧中的坐标(行, 列)
+    brief: 给定value_range和sigma时，网格按整帧坐标对齐，值域的采样也和图像内容无关，
+           分块的结果距离分块边界2.5*sigma_spatial以外和整帧的结果完全一致
+    ret: float32的滤波结果
+    """
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    edge = data if edge is None else np.ascontiguousarray(edge, dtype=np.float32)
+    height, width = data.shape
+    if (value_range is None):
+        edge_min = float(np.nanmin(edge))
+        edge_delta = float(np.nanmax(edge)) - edge_min
+    else:
+        edge_min = float(value_range[0])
+        edge_delta = float(value_range[1]) - edge_min
+    if (sigma_spatial is None):
+        sigma_spatial = min(height, width) / 16.
+    if (sigma_range is None):
+        sigma_range = 0.1 * edge_delta
+    if (sigma_spatial <= 0 or (sigma_range <= 0 and edge_delta > 0)):
+        return data.copy()
+
+    # 网格的采样间隔，四周各留1格，模糊和插值都不需要再判断边界
+    # 网格的第1格对应整帧坐标中origin所在的格子
+    sampling_spatial = max(sigma_spatial, 1.)
+    inv_spatial = 1 / sampling_spatial
+    base_i = int(np.rint(origin[0] * inv_spatial))
+    base_j = int(np.rint(origin[1] * inv_spatial))
+    grid_height = int(np.floor((origin[0] + height - 1) * inv_spatial)) - base_i + 3
+    grid_width = int(np.floor((origin[1] + width - 1) * inv_spatial)) - base_j + 3
+    sampling_range = max(sigma_range, edge_delta / (BILATERAL_GRID_MAX_DEPTH - 3), np.finfo(np.float32).tiny)
+    inv_range = 1 / sampling_range
+    grid_depth = int(np.floor(edge_delta / sampling_range)) + 3
+    offset = np.array([origin[0], origin[1], base_i, base_j], dtype=np.int64)
+    sides = (get_grid_kernel(sigma_spatial / sampling_spatial)[0], get_grid_kernel(sigma_range / sampling_range)[0])
+
+    # 每个像素插值时的下一层，分段时只处理这一段的像素，没有像素的段直接跳过
+    layers = np.empty((height, width), dtype=np.int32)
+    bilateral_grid_layers(data, edge, np.float32(edge_min), inv_range, grid_depth, layers)
+    starts = np.concatenate(([0], np.cumsum(np.bincount(layers.reshape(-1) + 1, minlength=grid_depth + 1)[1:])))
+
+    output = np.full((height, width), np.nan, dtype=np.float32)
+    # 插值第z层的像素需要模糊后的第z和z+1层，也就需要累加后的第z-1到z+2层
+    segment = max(1, BILATERAL_GRID_MAX_CELLS // (grid_height * grid_width) - 3)
+    for z0 in range(1, grid_depth - 1, segment):
+        z1 = min(z0 + segment, grid_depth - 1)
+        if (starts[z1] == starts[z0]):
+            continue
+        # 网格的最后一维是[累加的值, 像素个数]，第0层对应整体的第z0-1层
+        grid = np.zeros((grid_height, grid_width, z1 - z0 + 3, 2), dtype=np.float32)
+        bilateral_grid_splat(data, edge, layers, max(z0 - 2, 0), z1 + 2, offset, np.float32(edge_min), inv_spatial,
+                             inv_range, z0 - 1, grid_depth, grid)
+        # 三个方向分别模糊，网格四周是空的格子
+        bilateral_grid_blur(grid, sides[0], sides[1])
+        bilateral_grid_slice(data, edge, layers, z0, z1, offset, np.float32(edge_min), inv_spatial, inv_range,
+                             z0 - 1, grid_depth, grid, output)
+    return output
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def bilateral_grid_layers(data, edge, edge_min, inv_range, grid_depth, layers):
+    """
+    func: 每个像素三线性插值时值域方向的下一层，data或者edge为NaN的像素是-1
+    """
+    for i in range(data.shape[0]):
+        for j in range(data.shape[1]):
+            if (np.isnan(data[i, j]) or np.isnan(edge[i, j])):
+                layers[i, j] = -1
+                continue
+            fz = min(max((edge[i, j] - edge_min) * inv_range + 1, 1.), grid_depth - 2.)
+            layers[i, j] = min(int(fz), grid_depth - 2)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def bilateral_grid_splat(data, edge, layers, z_begin, z_end, offset, edge_min, inv_spatial, inv_range, z_base,
+                         grid_depth, grid):
+    """
+    func: layers在[z_begin, z_end)中的像素累加到(行, 列, 边缘值)最近的格子中，只累加落在这一段网格中的
+    input: offset是[origin行, origin列, 网格起始行, 网格起始列]，z_base是这一段网格第0层的层数，
+           超出值域的边缘值累加到边界的格子
+    """
+    for i in range(data.shape[0]):
+        gi = int(np.rint((i + offset[0]) * inv_spatial)) - offset[2] + 1
+        for j in range(data.shape[1]):
+            if (layers[i, j] < z_begin or layers[i, j] >= z_end):
+                continue
+            gz = int(np.rint((edge[i, j] - edge_min) * inv_range)) + 1
+            gz = min(max(gz, 1), grid_depth - 2) - z_base
+            if (gz < 0 or gz >= grid.shape[2]):
+                continue
+            gj = int(np.rint((j + offset[1]) * inv_spatial)) - offset[3] + 1
+            grid[gi, gj, gz, 0] += data[i, j]
+            grid[gi, gj, gz, 1] += 1
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def bilateral_grid_blur(grid, spatial_side, range_side):
+    """
+    func: 网格的行、列和值域三个方向依次做3点的高斯模糊[side, 1, side]，原地修改，网格外是0
+    """
+    height, width, depth = grid.shape[:3]
+    zero = np.float32(0)
+    prev = np.zeros(grid.shape[1:], dtype=np.float32)
+    for i in range(height):
+        for j in range(width):
+            for z in range(depth):
+                for k in range(2):
+                    cur = grid[i, j, z, k]
+                    after = grid[i + 1, j, z, k] if i + 1 < height else zero
+                    grid[i, j, z, k] = cur + spatial_side * (prev[j, z, k] + after)
+                    prev[j, z, k] = cur
+    for i in range(height):
+        prev[0] = 0
+        for j in range(width):
+            for z in range(depth):
+                for k in range(2):
+                    cur = grid[i, j, z, k]
+                    after = grid[i, j + 1, z, k] if j + 1 < width else zero
+                    grid[i, j, z, k] = cur + spatial_side * (prev[0, z, k] + after)
+                    prev[0, z, k] = cur
+        for j in range(width):
+            for k in range(2):
+                before = zero
+                for z in range(depth):
+                    cur = grid[i, j, z, k]
+                    after = grid[i, j, z + 1, k] if z + 1 < depth else zero
+                    grid[i, j, z, k] = cur + range_side * (before + after)
+                    before = cur
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def bilateral_grid_slice(data, edge, layers, z_begin, z_end, offset, edge_min, inv_spatial, inv_range, z_base,
+                         grid_depth, grid, dst):
+    """
+    func: 对layers在[z_begin, z_end)中的像素，在模糊后的网格中按(行, 列, 边缘值)分别三线性插值累加的值和像素个数，再相除
+    brief: 插值的8个格子都是空的时候(正常的输入不会出现)输出原来的值
+    """
+    for i in range(data.shape[0]):
+        fi = (i + offset[0]) * inv_spatial - offset[2] + 1
+        i0 = min(int(fi), grid.shape[0] - 2)
+        wi = fi - i0
+        for j in range(data.shape[1]):
+            z0 = layers[i, j]
+            if (z0 < z_begin or z0 >= z_end):
+                continue
+            fj = (j + offset[1]) * inv_spatial - offset[3] + 1
+            j0 = min(int(fj), grid.shape[1] - 2)
+            wj = fj - j0
+            fz = min(max((edge[i, j] - edge_min) * inv_range + 1, 1.), grid_depth - 2.)
+            wz = fz - z0
+            z0 -= z_base
+            value = 0.
+            weight = 0.
+            for di in range(2):
+                for dj in range(2):
+                    w = (wi if di == 1 else 1 - wi) * (wj if dj == 1 else 1 - wj)
+                    lower = grid[i0 + di, j0 + dj, z0]
+                    upper = grid[i0 + di, j0 + dj, z0 + 1]
+                    value += w * (lower[0] + wz * (upper[0] - lower[0]))
+                    weight += w * (lower[1] + wz * (upper[1] - lower[1]))
+            dst[i, j] = value / weight if weight > 0 else data[i, j]
+
+
+# =============================================================
+# 引导滤波
+#   He Kaiming的引导滤波，局部均值和方差都用归一化的盒式滤波(cv2.boxFilter)计算，
+#   盒式滤波用积分的方式实现，耗时和半径无关
+# =============================================================
+
+def guided_filter_coefficients(guide, src, radius, eps):
+    """
+    func: 计算引导滤波的线性系数，滤波结果 = mean_a * guide + mean_b
+    input: guide和src是float32的二维图像，radius是盒式滤波的半径，eps是正则项，局部方差远大于eps的边缘会保留
+    ret: (mean_a, mean_b)，系数是平滑的，可以在小图上计算后上采样到大图(fast guided filter)
+    """
+    ksize = (2 * radius + 1, 2 * radius + 1)
+
+    def box(x):
+        return cv2.boxFilter(x, -1, ksize, borderType=cv2.BORDER_REFLECT)
+    mean_i = box(guide)
+    mean_p = mean_i if src is guide else box(src)
+    cov_ip = box(guide * src) - mean_i * mean_p
+    var_i = cov_ip if src is guide else box(guide * guide) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return box(a), box(b)
+
+
+def guided_filter(src, guide=None, radius=8, eps=0.01):
+    """
+    func: 引导滤波
+    input: guide为None时用src自身作为引导图
+    ret: float32的滤波结果
+    """
+    src = np.asarray(src, dtype=np.float32)
+    guide = src if guide is None else np.asarray(guide, dtype=np.float32)
+    mean_a, mean_b = guided_filter_coefficients(guide, src, radius, eps)
+    return mean_a * guide + mean_b
+
+
+def warmup_jit():
+    """
+    function: 预先编译双边网格的numba函数
+    """
+    bilateral_grid(np.zeros((8, 8), dtype=np.float32), sigma_spatial=2, sigma_range=1, value_range=(0, 1))
@@ -2,20 +2,97 @@ import tools.rawimageeditor.isp as isp
 import tools.rawimageeditor.debayer as debayer
 
 # pipeline名称全部小写
+# 定点模式下，还没有定点实现的算法用float_compatible包装，先转换为float处理再转换回定点
 pipeline_dict = {
     "original raw":                 isp.get_src_raw_data,
     "black level":                  isp.black_level_correction,
     "digital gain":                 isp.apply_digital_gain,
     "blc":                          isp.black_level_correction,
-    "rolloff":                      isp.rolloff_correction,
-    "bad pixel correction":         isp.bad_pixel_correction,
+    "rolloff":                      isp.float_compatible(isp.rolloff_correction),
+    "bad pixel correction":         isp.float_compatible(isp.bad_pixel_correction),
     "bayer denoise":                None,
-    "demosaic":                     debayer.demosaic,
+    "demosaic":                     isp.float_compatible(debayer.demosaic),
     "awb":                          isp.channel_gain_white_balance,
     "ccm":                          isp.color_correction,
     "gamma":                        isp.gamma_correction,
-    "ltm":                          isp.ltm_correction,
+    "ltm":                          isp.float_compatible(isp.ltm_correction),
+    "guided ltm":                   isp.float_compatible(isp.guided_ltm),
     "csc":                          isp.color_space_conversion,
-    "yuv denoise":                  isp.wavelet_denoise,
-    "yuv sharpen":                  isp.sharpen
-}
\ No newline at end of file
+    "yuv denoise":                  isp.float_compatible(isp.wavelet_denoise),
+    "yuv sharpen":                  isp.float_compatible(isp.sharpen)
+}
+
+# 分块(tile)处理时每个节点需要的边界像素数(halo)，保证分块结果与整帧结果完全一致
+# None表示该节点只能整帧处理，halo也可以是输入params的函数
+pipeline_halo_dict = {
+    "original raw":                 None,
+    "black level":                  0,
+    "digital gain":                 0,
+    "blc":                          0,
+    "rolloff":                      0,
+    # 坏点矫正是按光栅顺序原地修改的，结果依赖前面已经矫正过的像素，只能整帧处理
+    "bad pixel correction":         None,
+    "bayer denoise":                0,
+    # menon算法的多次方向滤波叠加起来需要8个像素，malvar需要2个，双线性需要1个
+    "demosaic":                     8,
+    "awb":                          0,
+    "ccm":                          0,
+    "gamma":                        0,
+    # 双边网格的mask，网格的支撑范围是2.5倍的空间sigma
+    "ltm":                          96,
+    # 按半径下采样依赖整帧的大小，只能整帧处理
+    "guided ltm":                   None,
+    "csc":                          0,
+    # sym4小波的两层分解和重建，加上每层的双边滤波，色度的双边网格需要5个像素
+    "yuv denoise":                  64,
+    # 3x3的中值滤波加上7x7的滤波器
+    "yuv sharpen":                  4
+}
+
+# 每个节点使用的参数在RawImageParams中的名称，用于计算节点缓存的key
+pipeline_params_dict = {
+    "original raw":                 "rawformat",
+    "black level":                  "blc",
+    "digital gain":                 "gain",
+    "blc":                          "blc",
+    "rolloff":                      "rolloff",
+    "bad pixel correction":         "bpc",
+    "bayer denoise":                None,
+    "demosaic":                     "demosaic",
+    "awb":                          "awb",
+    "ccm":                          "ccm",
+    "gamma":                        "gamma",
+    "ltm":                          "ltm",
+    "guided ltm":                   "ltm",
+    "csc":                          "csc",
+    "yuv denoise":                  "denoise",
+    "yuv sharpen":                  "sharpen"
+}
+
+
+def group_pipeline(pipeline):
+    """
+    func: 把pipeline中连续的逐点raw域节点(黑电平、数字增益、暗影矫正、白平衡)分为一组，可以合并成一次遍历
+    ret: 节点列表的列表，例如[["original raw"], ["black level", "awb"], ["demosaic"]]
+    """
+    groups = []
+    for node in pipeline:
+        if (len(groups) > 0 and node in isp.FUSED_RAW_NODES and groups[-1][-1] in isp.FUSED_RAW_NODES):
+            groups[-1].append(node)
+        else:
+            groups.append([node])
+    return groups
+
+
+def run_nodes(nodes, raw, params):
+    """
+    func: 运行一组节点，只返回最后的图像，能合并的节点只遍历一次图像
+    ret: 出错时返回None，错误信息保存在params中
+    """
+    if (len(nodes) > 1 and isp.can_fuse_raw_stage(raw, params, nodes)):
+        return isp.fused_raw_stage(raw, params, nodes)
+    for node in nodes:
+        raw = pipeline_dict[node](raw, params)
+        if (raw is None):
+            return None
+    return raw
@@ -1,11 +1,16 @@
 from tools.rawimageeditor.RawImageParams import RawImageParams
 from tools.rawimageeditor.RawImageInfo import RawImageInfo
 import tools.rawimageeditor.ispfunction as ispfunc
+import tools.rawimageeditor.isptile as isptile
+import tools.rawimageeditor.ispcache as ispcache
+import tools.rawimageeditor.ispproxy as ispproxy
+import tools.rawimageeditor.ispprofile as ispprofile
+import tools.rawimageeditor.ispstore as ispstore
 from imp import reload
 import time
 from PySide2.QtCore import Signal, QThread
 from PySide2.QtWidgets import QMessageBox
-from threading import Lock
+from threading import Lock, Condition
 
 class IspPipeline():
     def __init__(self, parmas, process_bar=None):
@@ -22,14 +27,92 @@ class IspPipeline():
     def reload_isp(self):
         """
         func: 热更新 重载ISP算法模块
+        brief: 按依赖的顺序重载，RawImageInfo和RawImageParams的对象还在使用中，不重载
         """
+        reload(ispfunc.isp.rawunpack)
+        reload(ispfunc.isp.ispfilter)
+        reload(ispfunc.isp.utility)
         reload(ispfunc.debayer)
         reload(ispfunc.isp)
         reload(ispfunc)
+        reload(isptile)
+        # 算法修改后，之前缓存的结果就失效了，磁盘缓存的版本包含所有重载的模块
+        self.ispProcthread.node_cache.clear()
+        if (self.ispProcthread.disk_cache is not None):
+            self.ispProcthread.disk_cache.update_version()
         self.params.need_flush = True
         if (self.process_bar is not None):
             self.process_bar.setValue(0)
 
+    def warmup_jit(self):
+        """
+        func: 在后台线程中预先编译ISP算法里的numba函数，避免第一次处理时进度条卡住
+        """
+        self.warmupthread = JitWarmup()
+        self.warmupthread.start()
+
+    def set_tile_size(self, tile_size):
+        """
+        func: 设置分块处理的大小，0表示整帧处理
+        分块处理时内存占用只和分块大小有关，但是不保存中间过程的图像
+        """
+        self.ispProcthread.tile_size = tile_size
+
+    def set_threads(self, threads):
+        """
+        func: 设置节点并行处理的线程数，1表示单线程，None表示使用CPU核数
+        """
+        self.ispProcthread.threads = threads
+
+    def set_preview(self, enable):
+        """
+        func: 是否先在缩小的图像上运行pipeline，显示低分辨率的预览
+        """
+        self.ispProcthread.preview = enable
+
+    def get_preview_image(self):
+        """
+        func: 获取最近一次的预览图像
+        ret: (图像, 缩小的倍数)，没有预览时图像为None
+        """
+        return self.ispProcthread.preview_img, self.ispProcthread.preview_factor
+
+    def get_profile(self):
+        """
+        func: 获取最近一次处理的每个节点的性能记录，格式见ispprofile.PROFILE_FIELDS
+        已经缓存的节点不会重新运行，记录的是查找缓存的时间
+        """
+        return self.ispProcthread.profile
+
+    def set_trace_memory(self, enable):
+        """
+        func: 是否用tracemalloc统计每个节点的峰值内存，统计时python的内存申请会变慢一些
+        """
+        self.ispProcthread.trace_memory = enable
+
+    def set_memory_budget(self, max_bytes, mode=None):
+        """
+        func: 设置img_list中间图像的内存预算(字节)，None表示不限制
+        mode是超过预算时换出图像的方式，'disk'(默认)写到临时目录的memmap中，'compress'压缩后保存在内存中
+        """
+        self.ispProcthread.store.set_budget(max_bytes, mode)
+
+    def set_cache_size(self, max_bytes):
+        """
+        func: 设置节点结果缓存的内存上限(字节)，0表示不缓存
+        """
+        self.ispProcthread.node_cache.set_max_bytes(max_bytes)
+
+    def set_disk_cache(self, cache_dir, max_bytes=4 << 30):
+        """
+        func: 设置磁盘缓存的目录和大小上限(字节)，cache_dir为None表示不使用磁盘缓存
+        最终结果和demosaic的结果会保存到磁盘，下次打开同样的raw图和参数时直接读取
+        """
+        if (cache_dir is None):
+            self.ispProcthread.disk_cache = None
+        else:
+            self.ispProcthread.disk_cache = ispcache.DiskCache(cache_dir, max_bytes)
+
     def set_pipeline(self, pipeline):
         self.old_pipeline = self.pipeline
         self.pipeline = pipeline
@@ -43,8 +126,11 @@ class IspPipeline():
         func: 重新开始一个pipeline，把以前的图像清除
         """
         if(len(self.img_list) > 1):
+            # 正在运行的任务不能再保存图像，img_list和处理线程共用，需要原地清空
+            self.ispProcthread.supersede()
             self.imglist_mutex.acquire()
-            self.img_list = [RawImageInfo()]
+            del self.img_list[1:]
+            self.img_list[0] = RawImageInfo()
             self.imglist_mutex.release()
             self.old_pipeline = []
             self.pipeline = []
@@ -117,11 +203,36 @@ class IspPipeline():
     def run_pipeline(self):
         """
         func: 运行pipeline，process_bar是用于显示进度的process bar, callback是运行完的回调函数
+        brief: 不等待上一次的处理结束，提交一个新的任务后马上返回，上一次的任务在节点或者分块之间停止
         """
+        # 先让正在运行的任务失效，之后它的结果不会再保存到img_list中，再修改img_list就不会冲突了
+        generation = self.ispProcthread.supersede()
         pipeline = self.check_pipeline()
+        self.imglist_mutex.acquire()
+        if (pipeline is not None):
+            # 分块处理时没有保存中间过程的图像，需要从最近一幅保存的图像开始处理
+            while len(self.img_list) > 1 and self.img_list[-1] is None:
+                self.img_list.pop()
+        if (pipeline is not None or len(self.img_list) < len(self.pipeline) + 1):
+            # 被取消的处理只保存了前面的图像，从保存的最后一幅图像继续
+            pipeline = self.pipeline[len(self.img_list) - 1:]
+        self.imglist_mutex.release()
+        # 从最后一幅图像继续运行，如果它已经被换出了，先恢复到内存中
+        self.ispProcthread.store.restore_tail(self.img_list, self.imglist_mutex)
         print(pipeline)
-        self.ispProcthread.set_pipeline(pipeline)
-        self.ispProcthread.start()
+        self.ispProcthread.submit(generation, pipeline)
+
+    def cancel_pipeline(self):
+        """
+        func: 取消正在运行和等待运行的pipeline，不等待当前的节点运行完成
+        """
+        self.ispProcthread.supersede()
+
+    def stop(self):
+        """
+        func: 关闭窗口时停止处理线程
+        """
+        self.ispProcthread.stop()
 
     def remove_img_node_tail(self, index):
         """
@@ -137,69 +248,431 @@ class IspPipeline():
         """
         func: 获取pipeline中的一幅图像
         如果输入-1，则返回最后一幅图像
+        合并处理或者分块处理时没有保存的中间图像，会从前面最近的一幅图像开始重新计算
         """
         ret_img = None
         self.imglist_mutex.acquire()
+        if (index < 0):
+            index = len(self.pipeline)+1 + index
         if (index < len(self.img_list) and index >= 0):
             ret_img = self.img_list[index]
-        elif (index < 0 and len(self.pipeline)+1 + index < len(self.img_list)):
-            ret_img = self.img_list[len(self.pipeline)+1 + index]
         self.imglist_mutex.release()
+        # 超过内存预算被换出的图像，恢复出来
+        ret_img = ispstore.load_image(ret_img)
+        if(ret_img is None and index > 0 and index < len(self.img_list)):
+            ret_img = self.materialize_image(index)
         if(ret_img is not None):
             return ret_img
         else:
             return RawImageInfo()
 
+    def materialize_image(self, index):
+        """
+        func: 重新计算img_list中用None占位的图像，并保存到img_list中
+        """
+        self.imglist_mutex.acquire()
+        start = index - 1
+        while start > 0 and self.img_list[start] is None:
+            start -= 1
+        img = self.img_list[start]
+        self.imglist_mutex.release()
+        img = ispstore.load_image(img)
+        images = []
+        for node in self.pipeline[start:index]:
+            img = self.ispProcthread.run_node(node, img)
+            if (img is None):
+                return None
+            images.append(img)
+        self.imglist_mutex.acquire()
+        # 计算过程中pipeline可能已经重新运行了，只有占位的图像还在的时候才保存
+        for i, img in enumerate(images):
+            if (start + 1 + i < len(self.img_list) and self.img_list[start + 1 + i] is None):
+                self.img_list[start + 1 + i] = img
+        self.imglist_mutex.release()
+        return images[-1]
+
+class JitWarmup(QThread):
+    """
+    func: 预先编译numba函数的后台线程，编译结果会缓存到磁盘，之后打开只需要加载
+    """
+    def run(self):
+        try:
+            ispfunc.isp.warmup_jit()
+            ispfunc.debayer.warmup_jit()
+        except Exception as e:
+            # 预编译失败不影响使用，真正处理的时候会再编译
+            print("jit warmup failed: {}".format(e))
+
+
 class ISPProc(QThread):
+    """
+    func: ISP后台处理线程，按任务队列的方式运行
+    brief: 每次提交任务时generation加1，正在运行的旧任务在节点之间(或者分块/条带之间)检查到generation变化后放弃，
+    等待运行的任务只保留最新的一个，拖动滑条时连续的修改不会排队运行多次全分辨率的pipeline，
+    只有最新的任务会保存图像和发送信号
+    """
     doneCB = Signal() # 自定义信号，其中 object 为信号承载数据的类型
     processRateCB = Signal(int)
     costTimeCB = Signal(str)
     errorCB = Signal(str)
+    previewCB = Signal()
+    profileCB = Signal()
 
     def __init__(self, params, img_list, mutex:Lock, parent=None):
         super(ISPProc, self).__init__(parent)		
         self.params = params
         self.img_list = img_list
-        self.pipeline = None
         self.mutex = mutex
+        self.tile_size = 0
+        # 声明了halo的节点按行切分后多线程处理，None表示使用CPU核数
+        self.threads = None
+        self.node_cache = ispcache.NodeCache()
+        # img_list中间图像的内存预算，超过的时候换出最早的图像
+        self.store = ispstore.IntermediateStore()
+        # 磁盘缓存，None表示不使用，关闭程序后再打开同样的raw图和参数时直接读取结果
+        self.disk_cache = None
+        # 先在缩小的图像上运行，显示预览
+        self.preview = True
+        self.preview_img = None
+        self.preview_factor = 1
+        # 每个节点的性能记录，只保存最近一次完成的任务，trace_memory为False时不统计峰值内存
+        # tracemalloc会拖慢python的内存申请，默认关闭，打开节点耗时表格时才统计
+        self.profile = []
+        self.job_profile = []
+        self.trace_memory = False
+        # 最新任务的编号，在mutex中修改，保存图像的时候也在mutex中检查
+        self.generation = 0
+        # 等待运行的任务(generation, pipeline)，新的任务直接替换旧的任务
+        self.job = None
+        self.job_cond = Condition()
+        self.stopped = False
+
+    def supersede(self):
+        """
+        func: 让正在运行和等待运行的任务失效，返回新任务的编号
+        """
+        self.mutex.acquire()
+        self.generation += 1
+        generation = self.generation
+        self.mutex.release()
+        return generation
+
+    def is_superseded(self, generation):
+        """
+        func: 任务是否已经被新的任务取代
+        """
+        return generation != self.generation
+
+    def submit(self, generation, pipeline):
+        """
+        func: 提交一个任务，generation是supersede()返回的编号，已经被取代的任务直接丢掉
+        """
+        with self.job_cond:
+            if (self.is_superseded(generation) or self.stopped is True):
+                return
+            self.job = (generation, pipeline)
+            self.job_cond.notify()
+        if (self.isRunning() is False):
+            self.start()
+
+    def stop(self):
+        """
+        func: 停止处理线程，正在运行的任务在下一个节点之前退出
+        """
+        self.supersede()
+        with self.job_cond:
+            self.stopped = True
+            self.job = None
+            self.job_cond.notify()
+        self.wait()
+
+    def publish(self, generation, images):
+        """
+        func: 把任务的结果保存到img_list中，任务已经被取代时不保存
+        ret: 是否保存成功
+        """
+        self.mutex.acquire()
+        ret = not self.is_superseded(generation)
+        if (ret is True):
+            self.img_list.extend(images)
+        self.mutex.release()
+        return ret
     
-    def run_node(self, node, data):
+    def run_node(self, node, data, cancelled=None):
         # 这里进行检查之后，后续就不需要检查了
         if(data is not None and self.params is not None):
-            return ispfunc.pipeline_dict[node](data, self.params)
+            # 先查找缓存，输入图像和参数都没有变化的话，直接使用之前的结果
+            key = ispcache.node_key(data.cache_key, node, self.params)
+            ret_img = self.node_cache.get(key)
+            if (ret_img is None):
+                ret_img = isptile.run_node_parallel(node, data, self.params, self.threads, cancelled)
+                if (ret_img is not None):
+                    if (key is None):
+                        key = ispcache.image_hash(ret_img)
+                    ret_img.cache_key = key
+                    self.node_cache.put(key, ret_img)
+            return ret_img
         elif(self.params is None):
             self.params.set_error_str("输入的参数为空")
             return None
     
-    def set_pipeline(self, pipeline):
-        self.pipeline = pipeline
-    
+    def run_nodes(self, nodes, data, cancelled=None):
+        """
+        func: 运行一组节点，多个节点时合并成一次遍历，只缓存最后的结果
+        """
+        if (len(nodes) == 1):
+            return self.run_node(nodes[0], data, cancelled)
+        key = data.cache_key
+        for node in nodes:
+            key = ispcache.node_key(key, node, self.params)
+        ret_img = self.node_cache.get(key)
+        if (ret_img is None):
+            ret_img = ispfunc.run_nodes(nodes, data, self.params)
+            if (ret_img is not None and key is not None):
+                ret_img.cache_key = key
+                self.node_cache.put(key, ret_img)
+        return ret_img
+
+    def profile_nodes(self, nodes, data, cancelled=None):
+        """
+        func: 运行一组节点，同时记录耗时和内存，合并处理的节点记录成一条
+        """
+        ret_img, record = ispprofile.profile_call(
+            '+'.join(nodes), lambda img: self.run_nodes(nodes, img, cancelled), data, self.trace_memory)
+        if (ret_img is not None):
+            self.job_profile.append(record)
+        return ret_img
+
+    def publish_profile(self):
+        """
+        func: 任务完成后更新性能记录，发送profileCB
+        """
+        self.profile = self.job_profile
+        self.profileCB.emit()
+
     def run(self):
+        """
+        func: 处理线程的主循环，每次取出最新的任务运行
+        """
+        while True:
+            with self.job_cond:
+                while self.job is None and self.stopped is False:
+                    self.job_cond.wait()
+                if (self.stopped is True):
+                    return
+                generation, pipeline = self.job
+                self.job = None
+            self.process(pipeline, generation)
+
+    def process(self, pipeline, generation=None):
+        """
+        func: 运行一个任务，从img_list的最后一幅图像开始运行pipeline
+        input: generation是任务的编号，None表示当前的编号
+        """
+        if (generation is None):
+            generation = self.generation
+        cancelled = lambda: self.is_superseded(generation)
+        self.job_profile = []
         self.processRateCB.emit(0)
-        if (self.pipeline is not None):
-            length = len(self.pipeline)
+        if (pipeline is not None):
+            length = len(pipeline)
             i = 1
             params = self.params
             start_time = time.time()
-            for node in self.pipeline:
+            cached = self.run_disk_cache(pipeline, generation)
+            if (cached is None):
+                return
+            i += cached
+            if (self.tile_size > 0 and cached < length):
+                self.run_tiled(pipeline, generation, cached)
+                return
+            done = self.run_preview(pipeline[cached:], generation)
+            if (done is None):
+                return
+            i += done
+            done += cached
+            # 连续的逐点raw域节点合并成一次遍历，中间的图像用None占位，需要的时候再计算
+            groups = ispfunc.group_pipeline(pipeline[done:])
+            while len(groups) > 0:
+                if (cancelled()):
+                    return
+                nodes = groups.pop(0)
                 data = self.img_list[-1]
+                if (len(nodes) > 1 and not ispfunc.isp.can_fuse_raw_stage(data, params, nodes)):
+                    # 不能合并的时候逐个节点运行
+                    groups = [[node] for node in nodes] + groups
+                    continue
                 try:
-                    ret_img = self.run_node(node, data)
+                    ret_img = self.profile_nodes(nodes, data, cancelled)
                 except Exception as e:
-                    self.errorCB.emit("ISP算法[{}]运行错误:{}\r\n{}".format(node, params.get_error_str(),e))
+                    if (not cancelled()):
+                        self.errorCB.emit("ISP算法[{}]运行错误:{}\r\n{}".format('+'.join(nodes), params.get_error_str(),e))
                     return
 
                 if(ret_img is not None):
-                    self.mutex.acquire()
-                    self.img_list.append(ret_img)
-                    self.mutex.release()
+                    if (self.publish(generation, [None] * (len(nodes) - 1) + [ret_img]) is False):
+                        return
+                elif (cancelled()):
+                    return
                 else:
                     self.errorCB.emit(params.get_error_str())
                     break
-                self.processRateCB.emit(i / length * 100)
-                i += 1
+                i += len(nodes)
+                self.processRateCB.emit((i - 1) / length * 100)
+            if (cancelled()):
+                return
             stop_time = time.time()
             self.costTimeCB.emit('总耗时:{:.3f}s'.format(stop_time-start_time))
+            self.publish_profile()
             self.doneCB.emit()
+            self.save_disk_cache(pipeline, cancelled)
+            self.store.enforce(self.img_list, self.mutex, self.node_cache, cancelled)
+        elif (not cancelled()):
+            self.processRateCB.emit(100)
+
+    def run_disk_cache(self, pipeline, generation):
+        """
+        func: 从磁盘缓存中查找pipeline上最靠后的一个节点的结果，找到时直接保存到img_list中，前面的图像用None占位
+        brief: 从原始raw图开始时，需要先读取raw图计算hash，这个节点的结果也保存到img_list中
+        ret: 已经保存到img_list中的节点数，任务被取代或者出错时返回None
+        """
+        if (self.disk_cache is None or len(pipeline) == 0):
+            return 0
+        done = 0
+        data = self.img_list[-1]
+        if (data.cache_key is None):
+            try:
+                data = self.profile_nodes(pipeline[:1], data)
+            except Exception as e:
+                self.errorCB.emit("ISP算法[{}]运行错误:{}\r\n{}".format(pipeline[0], self.params.get_error_str(), e))
+                return None
+            if (data is None):
+                self.errorCB.emit(self.params.get_error_str())
+                return None
+            if (self.publish(generation, [data]) is False):
+                return None
+            done = 1
+        keys = []
+        key = data.cache_key
+        for node in pipeline[done:]:
+            key = ispcache.node_key(key, node, self.params)
+            keys.append(key)
+        for j in reversed(range(len(keys))):
+            if (self.disk_cache.contains(keys[j])):
+                ret_img, record = ispprofile.profile_call(
+                    'disk cache', lambda img: self.disk_cache.get(keys[j]), data, self.trace_memory)
+                if (ret_img is None):
+                    continue
+                self.job_profile.append(record)
+                self.node_cache.put(keys[j], ret_img)
+                if (self.publish(generation, [None] * j + [ret_img]) is False):
+                    return None
+                return done + j + 1
+        return done
+
+    def save_disk_cache(self, pipeline, cancelled):
+        """
+        func: 把任务的最终结果以及DISK_CACHE_NODES节点的结果保存到磁盘缓存
+        """
+        if (self.disk_cache is None or len(pipeline) == 0):
+            return
+        images = []
+        self.mutex.acquire()
+        offset = len(self.img_list) - len(pipeline)
+        for i, node in enumerate(pipeline):
+            img = self.img_list[offset + i]
+            if ((i == len(pipeline) - 1 or node in ispcache.DISK_CACHE_NODES) and isinstance(img, RawImageInfo)):
+                images.append(img)
+        self.mutex.release()
+        for img in images:
+            if (cancelled()):
+                return
+            self.disk_cache.put(img.cache_key, img)
+
+    def run_preview(self, pipeline, generation):
+        """
+        func: 在缩小的图像上运行pipeline，完成后发送previewCB
+        brief: 从原始raw图开始时，需要先读取全分辨率的raw图，这个节点的结果直接保存到img_list中
+        ret: 已经保存到img_list中的节点数，任务被取代或者读取raw图出错时返回None
+        """
+        self.preview_img = None
+        if (self.preview is False or len(pipeline) == 0):
+            return 0
+        cancelled = lambda: self.is_superseded(generation)
+        done = 0
+        nodes = pipeline
+        data = self.img_list[-1]
+        if (data.get_raw_data() is None):
+            try:
+                data = self.profile_nodes(nodes[:1], data)
+            except Exception as e:
+                if (not cancelled()):
+                    self.errorCB.emit("ISP算法[{}]运行错误:{}\r\n{}".format(nodes[0], self.params.get_error_str(), e))
+                return None
+            if (data is None):
+                if (not cancelled()):
+                    self.errorCB.emit(self.params.get_error_str())
+                return None
+            if (self.publish(generation, [data]) is False):
+                return None
+            done = 1
+            nodes = nodes[1:]
+        factor = ispproxy.get_proxy_factor(data)
+        if (factor <= 1 or len(nodes) == 0):
+            return done
+        try:
+            img = ispproxy.run_proxy(nodes, data, self.params, factor, self.threads, cancelled)
+        except Exception:
+            # 预览出错不影响全分辨率的处理，错误在全分辨率运行时报告
+            img = None
+        if (img is not None and not cancelled()):
+            self.preview_img = img
+            self.preview_factor = factor
+            self.previewCB.emit()
+        return done
+
+    def run_tiled(self, pipeline, generation, done=0):
+        """
+        func: 分块运行pipeline，中间过程的图像不保存，用None占位
+        input: done是已经从磁盘缓存读取的节点数，从后面的节点开始运行
+        """
+        cancelled = lambda: self.is_superseded(generation)
+        start_time = time.time()
+        job_pipeline = pipeline
+        pipeline = pipeline[done:]
+        data = self.img_list[-1]
+        key = data.cache_key
+        for node in pipeline:
+            key = ispcache.node_key(key, node, self.params)
+        ret_img = self.node_cache.get(key)
+        if (ret_img is None):
+            try:
+                ret_img, record = ispprofile.profile_call(
+                    'tiled', lambda img: isptile.run_tiled(pipeline, img, self.params, self.tile_size,
+                                                           progress=lambda rate: self.processRateCB.emit(rate * 100),
+                                                           cancelled=cancelled),
+                    data, self.trace_memory)
+                self.job_profile.append(record)
+            except Exception as e:
+                if (not cancelled()):
+                    self.errorCB.emit("ISP算法分块运行错误:{}\r\n{}".format(self.params.get_error_str(), e))
+                return
+            if (ret_img is not None):
+                if (key is None):
+                    key = ispcache.image_hash(ret_img)
+                ret_img.cache_key = key
+                self.node_cache.put(key, ret_img)
+
+        if(ret_img is not None):
+            if (self.publish(generation, [None] * (len(pipeline) - 1) + [ret_img]) is False):
+                return
         else:
-            self.processRateCB.emit(100)
\ No newline at end of file
+            if (not cancelled()):
+                self.errorCB.emit(self.params.get_error_str())
+            return
+        stop_time = time.time()
+        self.costTimeCB.emit('总耗时:{:.3f}s'.format(stop_time-start_time))
+        self.publish_profile()
+        self.doneCB.emit()
+        self.save_disk_cache(job_pipeline, cancelled)
+        self.store.enforce(self.img_list, self.mutex, self.node_cache, cancelled)
@@ -0,0 +1,111 @@
+import csv
+import json
+import time
+import tracemalloc
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+
+# =============================================================
+# ISP节点的性能记录
+
+#   每个节点运行一次生成一条记录(dict)，包括墙上时间、CPU时间、峰值内存以及输入输出的大小和类型，
+#   界面上用表格显示，批处理可以保存成json或者csv
+#   CPU时间是整个进程的CPU时间，节点按条带多线程处理时会大于墙上时间
+#   峰值内存用tracemalloc统计，是节点运行期间新申请内存的峰值，numpy和opencv创建的数组都会统计到，
+#   numba函数内部申请的临时数组不会统计到
+# =============================================================
+
+PROFILE_FIELDS = ['node', 'wall_time', 'cpu_time', 'peak_bytes',
+                  'input_shape', 'input_dtype', 'output_shape', 'output_dtype']
+
+
+def get_image_info(img: RawImageInfo):
+    """
+    func: 获取图像数据的大小和类型，没有数据时返回((), '')
+    brief: 内存映射加载还没有转换的raw图，返回原始数据的大小和类型，不触发转换
+    """
+    if (img is None):
+        return (), ''
+    raw_map = img.get_raw_map()
+    if (raw_map is not None):
+        return tuple(img.get_size()), str(raw_map.dtype)
+    data = img.get_raw_data()
+    if (data is None):
+        return (), ''
+    return tuple(data.shape), str(data.dtype)
+
+
+def profile_call(name, func, raw: RawImageInfo, trace_memory=True):
+    """
+    func: 运行func(raw)，记录耗时和内存
+    input: name是记录中的节点名，trace_memory为False时不统计内存，peak_bytes为None
+    ret: (func的返回值, 记录)
+    brief: tracemalloc是全局的，多个线程同时统计的时候峰值内存会互相影响
+    """
+    started = False
+    if (trace_memory is True):
+        if (not tracemalloc.is_tracing()):
+            tracemalloc.start()
+            started = True
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+    peak_bytes = None
+    wall_time = time.perf_counter()
+    cpu_time = time.process_time()
+    try:
+        ret = func(raw)
+    finally:
+        wall_time = time.perf_counter() - wall_time
+        cpu_time = time.process_time() - cpu_time
+        if (trace_memory is True):
+            peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - base)
+            if (started is True):
+                tracemalloc.stop()
+    input_shape, input_dtype = get_image_info(raw)
+    output_shape, output_dtype = get_image_info(ret)
+    record = {'node': name, 'wall_time': wall_time, 'cpu_time': cpu_time, 'peak_bytes': peak_bytes,
+              'input_shape': input_shape, 'input_dtype': input_dtype,
+              'output_shape': output_shape, 'output_dtype': output_dtype}
+    return ret, record
+
+
+def format_shape(shape):
+    return 'x'.join(str(size) for size in shape)
+
+
+def write_profile(records, filename):
+    """
+    func: 保存性能记录，后缀是.csv时保存成csv，否则保存成json
+    记录中的其他字段(比如批处理的文件名)也会保存，csv中放在PROFILE_FIELDS的前面
+    """
+    if (filename.lower().endswith('.csv')):
+        extra = []
+        for record in records:
+            extra.extend(key for key in record if key not in PROFILE_FIELDS and key not in extra)
+        with open(filename, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=extra + PROFILE_FIELDS)
+            writer.writeheader()
+            for record in records:
+                row = dict(record)
+                row['input_shape'] = format_shape(record['input_shape'])
+                row['output_shape'] = format_shape(record['output_shape'])
+                writer.writerow(row)
+    else:
+        with open(filename, 'w') as fp:
+            json.dump(records, fp, indent=2)
+
+
+def format_record(record):
+    """
+    func: 把一条记录转换成界面表格中显示的字符串
+    ret: [节点, 耗时, CPU时间, 峰值内存, 输入, 输出]
+    """
+    if (record['peak_bytes'] is None):
+        peak = '-'
+    else:
+        peak = '{:.1f}MB'.format(record['peak_bytes'] / (1 << 20))
+    return [record['node'],
+            '{:.3f}s'.format(record['wall_time']),
+            '{:.3f}s'.format(record['cpu_time']),
+            peak,
+            '{} {}'.format(format_shape(record['input_shape']), record['input_dtype']).strip(),
+            '{} {}'.format(format_shape(record['output_shape']), record['output_dtype']).strip()]
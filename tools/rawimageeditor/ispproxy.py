@@ -0,0 +1,117 @@
+import copy
+import numpy as np
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.isptile as isptile
+
+# =============================================================
+# 低分辨率预览(proxy)
+
+#   调参数的时候先用缩小后的图像跑一遍pipeline，马上显示预览，再在后台运行全分辨率的pipeline
+#   raw图用保持bayer pattern的binning缩小: 同一个颜色通道里factor x factor个点取平均，
+#   RGB和YCrCb图每个通道直接取平均
+# =============================================================
+
+# 预览图像的最大像素数，超过的时候继续增大binning的倍数
+PROXY_MAX_PIXELS = 1 << 20
+# 支持的binning倍数
+PROXY_FACTORS = (2, 4)
+
+
+def get_proxy_factor(raw: RawImageInfo, max_pixels=None):
+    """
+    func: 根据图像大小选择binning的倍数，图像本身就很小的时候返回1，不需要预览
+    input: max_pixels是预览图像的最大像素数，None表示PROXY_MAX_PIXELS
+    """
+    if (max_pixels is None):
+        max_pixels = PROXY_MAX_PIXELS
+    height, width = raw.get_height(), raw.get_width()
+    if (height * width <= max_pixels):
+        return 1
+    for factor in PROXY_FACTORS:
+        if (height * width <= max_pixels * factor * factor):
+            return factor
+    return PROXY_FACTORS[-1]
+
+
+def bin_data(data, factor, bayer):
+    """
+    func: 对数据进行factor倍的binning，多出来不够一组的行和列直接丢掉
+    input: bayer为True时，同一个颜色通道里的点取平均，输出仍然是同样pattern的bayer图
+    brief: 行号y = (Y * factor + a) * unit + p，p是bayer单元中的行(非bayer图unit为1)，
+    先把factor行相加，再把factor列相加，每次都是连续内存的相加，比reshape之后求平均快很多
+    """
+    unit = 2 if bayer else 1
+    block = factor * unit
+    height = data.shape[0] // block * block
+    width = data.shape[1] // block * block
+    rest = data.shape[2:]
+    integer = np.issubdtype(data.dtype, np.integer)
+
+    rows = data[:height, :width].reshape((height // block, factor, unit, width) + rest)
+    acc = rows[:, 0].astype(np.int32 if integer else np.float32)
+    for a in range(1, factor):
+        acc += rows[:, a]
+    cols = acc.reshape((height // factor, width // block, factor, unit) + rest)
+    ret = cols[:, :, 0].copy()
+    for b in range(1, factor):
+        ret += cols[:, :, b]
+
+    count = factor * factor
+    if (integer):
+        # 定点数据四舍五入
+        ret = (ret + count // 2) // count
+    else:
+        ret *= np.float32(1 / count)
+    return ret.astype(data.dtype, copy=False).reshape((height // factor, width // factor) + rest)
+
+
+def bin_image(raw: RawImageInfo, factor):
+    """
+    func: 生成缩小factor倍的图像，raw图保持bayer pattern不变
+    """
+    ret_img = RawImageInfo()
+    ret_img.create_image(raw.get_name(), raw, init_value=False)
+    ret_img.data = bin_data(raw.get_raw_data(), factor, raw.get_color_space() == "raw")
+    ret_img.set_color_space(raw.get_color_space())
+    ret_img.max_data = raw.max_data
+    return ret_img
+
+
+def get_proxy_params(params: RawImageParams, factor):
+    """
+    func: 预览使用的参数，和图像坐标相关的参数需要同样缩小
+    平场图和图像一样binning，坏点表的坐标换算到缩小后的图像上，LTM的半径除以factor，
+    节点中其他以像素为单位的空间常数按pixel_scale缩小
+    """
+    proxy_params = copy.copy(params)
+    proxy_params.pixel_scale = params.pixel_scale * factor
+    proxy_params.ltm = copy.copy(params.ltm)
+    proxy_params.ltm.set_radius(max(1, int(round(params.ltm.get_radius() / factor))))
+    if (isinstance(params.rolloff.flatphoto, np.ndarray)):
+        proxy_params.rolloff = copy.copy(params.rolloff)
+        proxy_params.rolloff.flatphoto = bin_data(params.rolloff.flatphoto, factor, True)
+    defect_table = params.bpc.get_defect_table()
+    if (defect_table is not None):
+        proxy_params.bpc = copy.copy(params.bpc)
+        proxy_params.bpc.set_defect_table(
+            [(x // 2 // factor * 2 + x % 2, y // 2 // factor * 2 + y % 2) for x, y in defect_table])
+    return proxy_params
+
+
+def run_proxy(nodes, raw: RawImageInfo, params: RawImageParams, factor, threads=None, cancelled=None):
+    """
+    func: 在缩小后的图像上运行nodes
+    input: cancelled()返回True的时候停止运行
+    ret: 预览图像，出错或者被取消时返回None，预览的错误不会写到params中，全分辨率运行的时候再报告
+    """
+    proxy = bin_image(raw, factor)
+    proxy_params = get_proxy_params(params, factor)
+    proxy_params.error_str = ""
+    for node in nodes:
+        if (cancelled is not None and cancelled()):
+            return None
+        proxy = isptile.run_node_parallel(node, proxy, proxy_params, threads)
+        if (proxy is None):
+            return None
+    return proxy
@@ -0,0 +1,211 @@
+import copy
+import os
+import tempfile
+import weakref
+import zlib
+import numpy as np
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispcache as ispcache
+
+# =============================================================
+# pipeline中间图像的存储
+
+#   img_list保存了pipeline每个节点的输出，12MP的图像每一幅就有上百MB，
+#   超过内存预算时，从最早的图像开始换出: 压缩后保存在内存中(compress)，或者写到磁盘的memmap中(disk)，
+#   用到的时候(比如双击pipeline中的节点)再恢复出来，最后一幅图像一直保存在内存中
+#   默认写到磁盘，12MP的图像只需要零点几秒，zlib压缩要一到三秒，会推迟下一次处理的开始
+#   只透传部分通道的节点(比如锐化只处理Y，Cr和Cb直接拷贝)，换出时和前一幅图像相同的通道只保存一个引用
+# =============================================================
+
+STORE_MODES = ['compress', 'disk']
+# zlib的压缩级别，1最快，中间图像主要是为了省内存，不追求压缩率
+COMPRESS_LEVEL = 1
+# 试压缩的字节数，压缩后大于COMPRESS_MIN_RATIO的字节位置不压缩
+COMPRESS_SAMPLE = 1 << 16
+COMPRESS_MIN_RATIO = 0.9
+
+
+def resident_bytes(img):
+    """
+    func: 图像占用的内存，内存映射的数据不计算在内
+    """
+    if (not isinstance(img, RawImageInfo) or img.get_raw_map() is not None):
+        return 0
+    data = img.get_raw_data()
+    if (data is None or isinstance(data, np.memmap)):
+        return 0
+    return data.nbytes
+
+
+def compress_data(data):
+    """
+    func: 压缩数组，先把每个数的字节按位置分开(byte shuffle)，高位字节变化很小，压缩率会高很多
+    brief: 噪声占满的低位字节基本压缩不了，先用一小段试一下，压缩不了的字节直接保存，节省大部分压缩时间
+    ret: 每个字节位置的数据，(是否压缩, bytes)
+    """
+    data = np.ascontiguousarray(data)
+    shuffled = data.view(np.uint8).reshape(-1, data.itemsize).T.copy()
+    planes = []
+    for plane in shuffled:
+        sample = plane[:COMPRESS_SAMPLE].tobytes()
+        if (len(zlib.compress(sample, COMPRESS_LEVEL)) > len(sample) * COMPRESS_MIN_RATIO):
+            planes.append((False, plane.tobytes()))
+        else:
+            planes.append((True, zlib.compress(plane.data, COMPRESS_LEVEL)))
+    return planes
+
+
+def decompress_data(planes, shape, dtype):
+    dtype = np.dtype(dtype)
+    shuffled = np.empty((dtype.itemsize, int(np.prod(shape))), dtype=np.uint8)
+    for plane, (compressed, block) in zip(shuffled, planes):
+        plane[:] = np.frombuffer(zlib.decompress(block) if compressed else block, dtype=np.uint8)
+    return shuffled.T.copy().view(dtype).reshape(shape)
+
+
+def _remove_file(holder, filename):
+    # 先关闭memmap再删除文件
+    holder.clear()
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+class SpilledImage():
+    """
+    img_list中被换出的图像，图像的属性保存在没有数据的RawImageInfo中，数据按通道保存
+    每个通道是('zlib', 压缩数据)、('disk', memmap)或者('shared', 前一幅换出的图像, 通道)
+    """
+
+    def __init__(self, img: RawImageInfo, mode='compress', scratch_dir=None, prev=None):
+        data = img.get_raw_data()
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.meta = copy.copy(img)
+        self.meta.data = None
+        self.meta.show_data = None
+        self.nbytes = data.nbytes
+        self.__holder = []
+        channels = [data] if data.ndim == 2 else [data[:, :, c] for c in range(data.shape[2])]
+        self.channel_hash = [ispcache.array_hash(channel) for channel in channels]
+        if (not isinstance(prev, SpilledImage) or prev.shape != self.shape or prev.dtype != self.dtype):
+            prev = None
+
+        self.blocks = []
+        disk_channels = []
+        for c, channel in enumerate(channels):
+            if (prev is not None and prev.channel_hash[c] == self.channel_hash[c]):
+                self.blocks.append(('shared', prev, c))
+            elif (mode == 'disk'):
+                self.blocks.append(('disk', len(disk_channels)))
+                disk_channels.append(channel)
+            else:
+                self.blocks.append(('zlib', compress_data(channel)))
+        if (len(disk_channels) > 0):
+            fd, filename = tempfile.mkstemp(suffix='.dat', dir=scratch_dir)
+            os.close(fd)
+            mmap = np.memmap(filename, dtype=self.dtype, mode='w+', shape=(len(disk_channels),) + channels[0].shape)
+            for i, channel in enumerate(disk_channels):
+                mmap[i] = channel
+            mmap.flush()
+            self.__holder.append(mmap)
+            weakref.finalize(self, _remove_file, self.__holder, filename)
+
+    def stored_bytes(self):
+        """
+        func: 换出后占用的内存，磁盘上的数据和共享的通道不计算在内
+        """
+        return sum(len(plane[1]) for block in self.blocks if block[0] == 'zlib' for plane in block[1])
+
+    def restore_channel(self, c):
+        block = self.blocks[c]
+        shape = self.shape[:2]
+        if (block[0] == 'shared'):
+            return block[1].restore_channel(block[2])
+        elif (block[0] == 'disk'):
+            return np.array(self.__holder[0][block[1]])
+        return decompress_data(block[1], shape, self.dtype)
+
+    def restore(self):
+        """
+        func: 恢复成RawImageInfo，每次都返回一幅新的图像
+        """
+        if (len(self.shape) == 2):
+            data = self.restore_channel(0)
+        else:
+            data = np.empty(self.shape, dtype=self.dtype)
+            for c in range(self.shape[2]):
+                data[:, :, c] = self.restore_channel(c)
+        ret_img = copy.copy(self.meta)
+        ret_img.data = data
+        return ret_img
+
+
+def load_image(entry):
+    """
+    func: 获取img_list中的一幅图像，换出的图像会被恢复
+    """
+    if (isinstance(entry, SpilledImage)):
+        return entry.restore()
+    return entry
+
+
+class IntermediateStore():
+    """
+    img_list的内存预算，max_bytes为None表示不限制
+    换出是在处理线程中一幅一幅进行的，有新的任务时在两幅图像之间停止
+    """
+
+    def __init__(self, max_bytes=1 << 30, mode='disk'):
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.scratch_dir = None
+
+    def set_budget(self, max_bytes, mode=None):
+        if (mode is not None):
+            if (mode not in STORE_MODES):
+                raise ValueError("不支持的存储方式: {}".format(mode))
+            self.mode = mode
+        self.max_bytes = max_bytes
+
+    def get_scratch_dir(self):
+        if (self.scratch_dir is None):
+            self.scratch_dir = tempfile.TemporaryDirectory(prefix='imagetools_')
+        return self.scratch_dir.name
+
+    def enforce(self, img_list, mutex, node_cache=None, cancelled=None):
+        """
+        func: 超过内存预算时，从最早的图像开始换出，最后一幅图像不换出
+        input: node_cache中同一幅图像的引用也会删除，否则内存不会释放；cancelled()返回True时停止
+        brief: 压缩的时候不持有mutex，替换之前检查img_list中还是同一幅图像
+        """
+        if (self.max_bytes is None):
+            return
+        while cancelled is None or not cancelled():
+            mutex.acquire()
+            used = sum(resident_bytes(img) for img in img_list[:-1])
+            index = -1
+            if (used > self.max_bytes):
+                index = next(i for i, img in enumerate(img_list[:-1]) if resident_bytes(img) > 0)
+                img = img_list[index]
+                prev = img_list[index - 1]
+            mutex.release()
+            if (index == -1):
+                return
+            spilled = SpilledImage(img, self.mode, self.get_scratch_dir() if self.mode == 'disk' else None, prev)
+            mutex.acquire()
+            if (index < len(img_list) and img_list[index] is img):
+                img_list[index] = spilled
+                if (node_cache is not None):
+                    node_cache.discard(img.cache_key)
+            mutex.release()
+
+    def restore_tail(self, img_list, mutex):
+        """
+        func: 保证img_list的最后一幅图像在内存中，pipeline从这幅图像继续运行
+        """
+        mutex.acquire()
+        if (isinstance(img_list[-1], SpilledImage)):
+            img_list[-1] = img_list[-1].restore()
+        mutex.release()
@@ -0,0 +1,211 @@
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import numpy as np
+from tools.rawimageeditor.RawImageParams import RawImageParams
+from tools.rawimageeditor.RawImageInfo import RawImageInfo
+import tools.rawimageeditor.ispfunction as ispfunc
+
+# =============================================================
+# 分块(tile)执行引擎
+
+#   把整帧图像切分成带边界(halo)的小块，每一块依次跑完整个pipeline后再拼接起来，
+#   中间结果的内存只和分块大小有关，而与sensor分辨率无关。
+#   每个节点需要的halo在ispfunction.pipeline_halo_dict中声明，
+#   只要halo足够，分块的结果与整帧处理的结果完全一致
+#   多核并行: 把一个节点按行切分成带halo的水平条带(band)，在线程池中同时处理，
+#   numba(nogil)和opencv的函数运行时会释放GIL，所以多个线程可以同时计算
+#   取消: cancelled()在每个分块/条带开始前检查，返回True时放弃这个节点，返回None，
+#   和出错不同，这时params里没有错误信息
+# =============================================================
+
+# 分块的起点需要对齐到8个像素，保证bayer pattern不变，同时满足两层小波变换的下采样对齐
+TILE_ALIGN = 8
+# 每个条带去掉halo之后最少的行数，图像太小的时候并行的开销比计算还大
+MIN_BAND_HEIGHT = 64
+
+
+def get_node_halo(node, params: RawImageParams):
+    """
+    func: 获取节点分块处理时需要的halo，返回None表示该节点只能整帧处理
+    """
+    halo = ispfunc.pipeline_halo_dict.get(node)
+    if callable(halo):
+        halo = halo(params)
+    return halo
+
+
+def split_pipeline(pipeline, params: RawImageParams):
+    """
+    func: 把pipeline切分成若干段
+    ret: [(halo, nodes)], halo为None的段是单个整帧处理的节点，否则是可以分块处理的连续节点，halo是这些节点halo的总和
+    """
+    segments = []
+    for node in pipeline:
+        halo = get_node_halo(node, params)
+        if (halo is None):
+            segments.append((None, [node]))
+        elif (len(segments) > 0 and segments[-1][0] is not None):
+            segments[-1] = (segments[-1][0] + halo, segments[-1][1] + [node])
+        else:
+            segments.append((halo, [node]))
+    return segments
+
+
+def run_tiled(pipeline, raw: RawImageInfo, params: RawImageParams, tile_size, progress=None, cancelled=None):
+    """
+    func: 以分块的方式运行pipeline，只返回最后的图像
+    input: tile_size是输出分块的边长，progress(rate)是进度回调，rate范围为[0, 1]
+    cancelled()是取消检查，None表示不能取消
+    ret: 出错或者被取消时返回None，出错的信息保存在params中
+    """
+    segments = split_pipeline(pipeline, params)
+    for i, (halo, nodes) in enumerate(segments):
+        if (cancelled is not None and cancelled()):
+            return None
+        if (halo is None):
+            raw = ispfunc.pipeline_dict[nodes[0]](raw, params)
+        else:
+            raw = run_segment_tiled(nodes, raw, params, tile_size, halo, cancelled)
+        if (raw is None):
+            return None
+        if (progress is not None):
+            progress((i + 1) / len(segments))
+    return raw
+
+
+def run_segment_tiled(nodes, raw: RawImageInfo, params: RawImageParams, tile_size, halo, cancelled=None):
+    """
+    func: 对一段可以分块处理的节点，逐块运行并拼接结果
+    """
+    tile_size = align_up(max(tile_size, TILE_ALIGN))
+    height, width = raw.get_height(), raw.get_width()
+    ret_img = None
+    for y0 in range(0, height, tile_size):
+        y1 = min(y0 + tile_size, height)
+        for x0 in range(0, width, tile_size):
+            if (cancelled is not None and cancelled()):
+                return None
+            x1 = min(x0 + tile_size, width)
+            # 输入的区域需要在输出区域的基础上扩展halo，起点对齐
+            in_y0 = max(0, align_down(y0 - halo))
+            in_y1 = min(height, align_up(y1 + halo))
+            in_x0 = max(0, align_down(x0 - halo))
+            in_x1 = min(width, align_up(x1 + halo))
+
+            tile = raw.crop_image(in_y0, in_y1, in_x0, in_x1)
+            tile_params = get_tile_params(params, in_y0, in_y1, in_x0, in_x1)
+            for group in ispfunc.group_pipeline(nodes):
+                tile = ispfunc.run_nodes(group, tile, tile_params)
+                if (tile is None):
+                    params.set_error_str(tile_params.get_error_str())
+                    return None
+
+            if (ret_img is None):
+                ret_img = create_tiled_output(tile, height, width)
+            ret_img.data[y0:y1, x0:x1] = tile.data[y0 - in_y0:y1 - in_y0, x0 - in_x0:x1 - in_x0]
+    return ret_img
+
+
+def get_band_count(node, raw: RawImageInfo, params: RawImageParams, threads):
+    """
+    func: 节点按行并行处理时的条带数，返回1表示整帧处理
+    brief: 只有在pipeline_halo_dict中声明了halo的节点才会并行处理
+    """
+    halo = get_node_halo(node, params)
+    if (threads <= 1 or halo is None or raw is None or raw.get_raw_data() is None):
+        return 1
+    return max(1, min(threads, raw.get_height() // (MIN_BAND_HEIGHT + 2 * halo)))
+
+
+def run_node_parallel(node, raw: RawImageInfo, params: RawImageParams, threads=None, cancelled=None):
+    """
+    func: 运行一个节点，声明了halo的节点按行切分成条带，用多个线程同时处理
+    input: threads是线程数，None表示CPU核数，cancelled()是取消检查，整帧处理的节点只能等它运行完
+    ret: 与整帧处理的结果完全一致，出错或者被取消时返回None，出错的信息保存在params中
+    """
+    if (threads is None):
+        threads = os.cpu_count()
+    bands = get_band_count(node, raw, params, threads)
+    if (bands <= 1):
+        return ispfunc.pipeline_dict[node](raw, params)
+    return run_banded([node], raw, params, get_node_halo(node, params), bands, cancelled)
+
+
+def run_banded(nodes, raw: RawImageInfo, params: RawImageParams, halo, bands, cancelled=None):
+    """
+    func: 把图像按行切分成bands个带halo的条带，在线程池中运行nodes，再拼接结果
+    brief: 条带的起点对齐到TILE_ALIGN，和分块处理一样，只要halo足够，结果与整帧处理完全一致
+    """
+    height, width = raw.get_height(), raw.get_width()
+    band_height = align_up(-(-height // bands))
+    ret = {'img': None, 'error': None, 'cancelled': False}
+    mutex = Lock()
+
+    def run_band(y0):
+        # 线程池里排队的条带在开始前检查，已经开始的条带会运行完
+        if (ret['error'] is not None or ret['cancelled'] is True):
+            return
+        if (cancelled is not None and cancelled()):
+            ret['cancelled'] = True
+            return
+        y1 = min(y0 + band_height, height)
+        in_y0 = max(0, align_down(y0 - halo))
+        in_y1 = min(height, align_up(y1 + halo))
+        band = raw.crop_image(in_y0, in_y1, 0, width)
+        band_params = get_tile_params(params, in_y0, in_y1, 0, width)
+        for group in ispfunc.group_pipeline(nodes):
+            band = ispfunc.run_nodes(group, band, band_params)
+            if (band is None):
+                ret['error'] = band_params.get_error_str()
+                return
+        with mutex:
+            if (ret['img'] is None):
+                ret['img'] = create_tiled_output(band, height, width)
+        ret['img'].data[y0:y1] = band.data[y0 - in_y0:y1 - in_y0]
+
+    with ThreadPoolExecutor(max_workers=bands) as executor:
+        futures = [executor.submit(run_band, y0) for y0 in range(0, height, band_height)]
+        for future in futures:
+            future.result()
+    if (ret['error'] is not None):
+        params.set_error_str(ret['error'])
+        return None
+    if (ret['cancelled'] is True):
+        return None
+    return ret['img']
+
+
+def create_tiled_output(tile: RawImageInfo, height, width):
+    """
+    func: 根据第一块的处理结果，创建整帧的输出图像
+    """
+    ret_img = RawImageInfo()
+    ret_img.create_image(tile.get_name(), tile, init_value=False)
+    ret_img.data = np.empty((height, width) + tile.data.shape[2:], dtype=tile.data.dtype)
+    ret_img.set_color_space(tile.get_color_space())
+    ret_img.max_data = tile.max_data
+    return ret_img
+
+
+def get_tile_params(params: RawImageParams, y0, y1, x0, x1):
+    """
+    func: 获取分块使用的参数
+    有些参数是和图像一样大小的(比如rolloff的平场图)，需要截取对应的区域，
+    分块在整帧中的坐标记录在tile_origin中，其他的参数直接共用
+    """
+    tile_params = copy.copy(params)
+    tile_params.tile_origin = (y0, x0)
+    if (isinstance(params.rolloff.flatphoto, np.ndarray)):
+        tile_params.rolloff = copy.copy(params.rolloff)
+        tile_params.rolloff.flatphoto = params.rolloff.flatphoto[y0:y1, x0:x1]
+    return tile_params
+
+
+def align_down(value):
+    return value // TILE_ALIGN * TILE_ALIGN
+
+
+def align_up(value):
+    return -(-value // TILE_ALIGN) * TILE_ALIGN
@@ -0,0 +1,193 @@
+import os
+import numpy as np
+from numba import jit, prange
+
+# =============================================================
+# RAW图解包
+
+#   UNPACKED: 每个像素占16bit，小端，数据在低位(海思的raw图格式)
+#   UNPACKED_BE: 每个像素占16bit，大端，数据在低位
+#   UNPACKED_MSB: 每个像素占16bit，小端，数据在高位
+#   MIPI: MIPI CSI-2 packed格式，RAW10每4个像素占5个字节，RAW12每2个像素占3个字节，
+#         RAW14每4个像素占7个字节，前面的字节是每个像素的高8bit，最后的字节是低位拼接
+#   PACKED: 连续的bit流，每个像素按照小端顺序紧密排列
+#   先用内存映射打开文件，只映射需要的帧，packed格式用numba按行并行解包
+# =============================================================
+
+RAW_FORMATS = ("UNPACKED", "UNPACKED_BE", "UNPACKED_MSB", "MIPI", "PACKED")
+
+# packed格式每一组的像素个数和字节数
+PACKED_GROUP = {
+    8: (1, 1),
+    10: (4, 5),
+    12: (2, 3),
+    14: (4, 7),
+}
+
+def is_packed(raw_format):
+    return raw_format in ("MIPI", "PACKED")
+
+
+def check_format(raw_format, bit_depth):
+    """
+    func: 检查raw图格式，不支持的时候返回错误信息，支持返回None
+    """
+    if (raw_format not in RAW_FORMATS):
+        return "不支持的raw图格式: {}".format(raw_format)
+    if (is_packed(raw_format) and bit_depth not in PACKED_GROUP):
+        return "{}格式不支持{}bit".format(raw_format, bit_depth)
+    if (not is_packed(raw_format) and bit_depth > 16):
+        return "{}格式不支持{}bit".format(raw_format, bit_depth)
+    return None
+
+
+def get_row_bytes(width, bit_depth, raw_format):
+    """
+    func: 每一行有效数据的字节数
+    """
+    if (is_packed(raw_format)):
+        group_pixels, group_bytes = PACKED_GROUP[bit_depth]
+        return -(-width // group_pixels) * group_bytes
+    return width * 2
+
+
+def get_frame_bytes(height, width, bit_depth, raw_format, stride=0):
+    """
+    func: 一帧的字节数，stride是每一行的字节数，0表示行与行之间没有填充
+    """
+    if (stride == 0):
+        stride = get_row_bytes(width, bit_depth, raw_format)
+    return height * stride
+
+
+def is_unpacked_size(size, height, width, bit_depth, raw_format, stride=0):
+    """
+    func: 选择了packed格式，但是文件大小正好是一帧16bit非压缩的raw图，并且不是整数帧packed数据
+    brief: 旧版本中MIPI表示16bit非压缩的格式，用来发现按packed格式错误解包的文件
+    """
+    if (not is_packed(raw_format) or stride != 0):
+        return False
+    unpacked_bytes = get_frame_bytes(height, width, bit_depth, "UNPACKED")
+    return size == unpacked_bytes and size % get_frame_bytes(height, width, bit_depth, raw_format) != 0
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def unpack_mipi(rows, width, bit_depth, out):
+    """
+    func: MIPI CSI-2 packed格式解包
+    input: rows是(h, row_bytes)的uint8数据，out是(h, width)的uint16输出
+    brief: 每一组先存放每个像素的高8bit，后面的字节依次存放每个像素的低位，
+    最后一组不完整的时候，多出来的像素不输出
+    """
+    if (bit_depth == 8):
+        for y in prange(rows.shape[0]):
+            for x in range(width):
+                out[y, x] = rows[y, x]
+        return
+    group_pixels = 2 if bit_depth == 12 else 4
+    group_bytes = group_pixels * bit_depth // 8
+    groups = (width + group_pixels - 1) // group_pixels
+    for y in prange(rows.shape[0]):
+        row = rows[y]
+        for g in range(groups):
+            b = g * group_bytes
+            x = g * group_pixels
+            if (bit_depth == 12):
+                lsb = np.uint16(row[b + 2])
+                out[y, x] = (np.uint16(row[b]) << 4) | (lsb & 0xf)
+                if (x + 1 < width):
+                    out[y, x + 1] = (np.uint16(row[b + 1]) << 4) | (lsb >> 4)
+                continue
+            if (bit_depth == 10):
+                lsb = np.uint32(row[b + 4])
+            else:
+                lsb = np.uint32(row[b + 4]) | (np.uint32(row[b + 5]) << 8) | (np.uint32(row[b + 6]) << 16)
+            lsb_bits = bit_depth - 8
+            lsb_mask = (1 << lsb_bits) - 1
+            for i in range(min(4, width - x)):
+                out[y, x + i] = (np.uint16(row[b + i]) << lsb_bits) | np.uint16((lsb >> (i * lsb_bits)) & lsb_mask)
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def unpack_bitstream(rows, width, bit_depth, out):
+    """
+    func: 连续bit流解包，每个像素按照小端顺序紧密排列
+    input: rows是(h, row_bytes)的uint8数据，out是(h, width)的uint16输出
+    """
+    mask = (1 << bit_depth) - 1
+    row_bytes = rows.shape[1]
+    for y in prange(rows.shape[0]):
+        for x in range(width):
+            bit_pos = x * bit_depth
+            pos = bit_pos // 8
+            value = np.uint32(rows[y, pos])
+            if (pos + 1 < row_bytes):
+                value |= np.uint32(rows[y, pos + 1]) << 8
+            if (pos + 2 < row_bytes):
+                value |= np.uint32(rows[y, pos + 2]) << 16
+            out[y, x] = (value >> (bit_pos % 8)) & mask
+
+
+def unpack_frame(buf, height, width, bit_depth, raw_format, stride=0):
+    """
+    func: 从一段字节数据中解出一帧raw图
+    input: buf是一维的uint8数据(可以是np.memmap), stride是每一行的字节数
+    ret: (height, width)的uint16数据，UNPACKED和UNPACKED_BE直接返回buf上的视图，不进行拷贝
+    """
+    row_bytes = get_row_bytes(width, bit_depth, raw_format)
+    if (stride == 0):
+        stride = row_bytes
+    if (raw_format in ("UNPACKED", "UNPACKED_BE")):
+        dtype = "<u2" if raw_format == "UNPACKED" else ">u2"
+        return np.ndarray((height, width), dtype=dtype, buffer=buf, strides=(stride, 2))
+
+    rows = np.ndarray((height, row_bytes), dtype=np.uint8, buffer=buf, strides=(stride, 1))
+    out = np.empty((height, width), dtype=np.uint16)
+    if (raw_format == "UNPACKED_MSB"):
+        data = np.ndarray((height, width), dtype="<u2", buffer=buf, strides=(stride, 2))
+        np.right_shift(data, 16 - bit_depth, out=out)
+        return out
+    if (raw_format == "MIPI"):
+        unpack_mipi(rows, width, bit_depth, out)
+    else:
+        unpack_bitstream(rows, width, bit_depth, out)
+    return out
+
+
+def map_frame(filename, height, width, bit_depth, raw_format, offset=0, stride=0):
+    """
+    func: 用内存映射的方式打开文件，只映射一帧需要的数据并解包
+    """
+    frame_bytes = get_frame_bytes(height, width, bit_depth, raw_format, stride)
+    buf = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset, shape=(frame_bytes,))
+    return unpack_frame(buf, height, width, bit_depth, raw_format, stride)
+
+
+def get_frame_count(filename, height, width, bit_depth, raw_format, offset=0, stride=0):
+    """
+    func: 文件中包含的完整帧数
+    """
+    frame_bytes = get_frame_bytes(height, width, bit_depth, raw_format, stride)
+    return max(0, os.path.getsize(filename) - offset) // frame_bytes
+
+
+def iter_frames(filename, height, width, bit_depth, raw_format, offset=0, stride=0):
+    """
+    func: 逐帧读取多帧的raw文件，每次只解包一帧，不需要把整个文件读入内存
+    """
+    frame_bytes = get_frame_bytes(height, width, bit_depth, raw_format, stride)
+    count = get_frame_count(filename, height, width, bit_depth, raw_format, offset, stride)
+    if (count == 0):
+        return
+    buf = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset, shape=(count * frame_bytes,))
+    for i in range(count):
+        yield unpack_frame(buf[i * frame_bytes:(i + 1) * frame_bytes], height, width, bit_depth, raw_format, stride)
+
+
+def warmup_jit():
+    """
+    func: 预先编译解包的numba函数，编译结果会缓存到磁盘
+    """
+    buf = np.zeros(get_frame_bytes(2, 4, 10, "MIPI"), dtype=np.uint8)
+    for raw_format in ("MIPI", "PACKED"):
+        unpack_frame(buf, 2, 4, 10, raw_format)
@@ -87,6 +87,8 @@ class Ui_ImageEditor(object):
         self.raw_format.addItem("")
         self.raw_format.addItem("")
         self.raw_format.addItem("")
+        self.raw_format.addItem("")
+        self.raw_format.addItem("")
         self.raw_format.setObjectName(u"raw_format")
 
         self.gridLayout_4.addWidget(self.raw_format, 5, 1, 1, 1)
@@ -204,15 +206,18 @@ class Ui_ImageEditor(object):
         __qlistwidgetitem9.setBackground(brush2);
         __qlistwidgetitem10 = QListWidgetItem(self.pipeline)
         __qlistwidgetitem10.setCheckState(Qt.Unchecked);
-        __qlistwidgetitem10.setBackground(brush1);
-        brush3 = QBrush(QColor(170, 255, 255, 255))
-        brush3.setStyle(Qt.SolidPattern)
+        __qlistwidgetitem10.setBackground(brush2);
         __qlistwidgetitem11 = QListWidgetItem(self.pipeline)
         __qlistwidgetitem11.setCheckState(Qt.Unchecked);
-        __qlistwidgetitem11.setBackground(brush3);
+        __qlistwidgetitem11.setBackground(brush1);
+        brush3 = QBrush(QColor(170, 255, 255, 255))
+        brush3.setStyle(Qt.SolidPattern)
         __qlistwidgetitem12 = QListWidgetItem(self.pipeline)
         __qlistwidgetitem12.setCheckState(Qt.Unchecked);
         __qlistwidgetitem12.setBackground(brush3);
+        __qlistwidgetitem13 = QListWidgetItem(self.pipeline)
+        __qlistwidgetitem13.setCheckState(Qt.Unchecked);
+        __qlistwidgetitem13.setBackground(brush3);
         self.pipeline.setObjectName(u"pipeline")
         font = QFont()
         font.setPointSize(12)
@@ -716,6 +721,37 @@ class Ui_ImageEditor(object):
 
         self.gridLayout_11.addWidget(self.bright_suppress, 1, 1, 1, 1)
 
+        self.label_43 = QLabel(self.groupBox_12)
+        self.label_43.setObjectName(u"label_43")
+
+        self.gridLayout_11.addWidget(self.label_43, 2, 0, 1, 1)
+
+        self.ltm_radius = QSlider(self.groupBox_12)
+        self.ltm_radius.setObjectName(u"ltm_radius")
+        self.ltm_radius.setMinimum(1)
+        self.ltm_radius.setMaximum(500)
+        self.ltm_radius.setSingleStep(8)
+        self.ltm_radius.setPageStep(64)
+        self.ltm_radius.setValue(64)
+        self.ltm_radius.setOrientation(Qt.Horizontal)
+
+        self.gridLayout_11.addWidget(self.ltm_radius, 2, 1, 1, 1)
+
+        self.label_44 = QLabel(self.groupBox_12)
+        self.label_44.setObjectName(u"label_44")
+
+        self.gridLayout_11.addWidget(self.label_44, 3, 0, 1, 1)
+
+        self.ltm_strength = QSlider(self.groupBox_12)
+        self.ltm_strength.setObjectName(u"ltm_strength")
+        self.ltm_strength.setMaximum(200)
+        self.ltm_strength.setSingleStep(10)
+        self.ltm_strength.setPageStep(50)
+        self.ltm_strength.setValue(100)
+        self.ltm_strength.setOrientation(Qt.Horizontal)
+
+        self.gridLayout_11.addWidget(self.ltm_strength, 3, 1, 1, 1)
+
 
         self.gridLayout_7.addWidget(self.groupBox_12, 9, 0, 1, 1)
 
@@ -950,7 +986,9 @@ class Ui_ImageEditor(object):
         QWidget.setTabOrder(self.ccm_bb, self.gamma_ratio)
         QWidget.setTabOrder(self.gamma_ratio, self.dark_boost)
         QWidget.setTabOrder(self.dark_boost, self.bright_suppress)
-        QWidget.setTabOrder(self.bright_suppress, self.limitrange)
+        QWidget.setTabOrder(self.bright_suppress, self.ltm_radius)
+        QWidget.setTabOrder(self.ltm_radius, self.ltm_strength)
+        QWidget.setTabOrder(self.ltm_strength, self.limitrange)
         QWidget.setTabOrder(self.limitrange, self.color_space)
         QWidget.setTabOrder(self.color_space, self.luma)
         QWidget.setTabOrder(self.luma, self.contrast)
@@ -999,6 +1037,8 @@ class Ui_ImageEditor(object):
         self.raw_format.setItemText(0, QCoreApplication.translate("ImageEditor", u"MIPI", None))
         self.raw_format.setItemText(1, QCoreApplication.translate("ImageEditor", u"PACKED", None))
         self.raw_format.setItemText(2, QCoreApplication.translate("ImageEditor", u"UNPACKED", None))
+        self.raw_format.setItemText(3, QCoreApplication.translate("ImageEditor", u"UNPACKED_BE", None))
+        self.raw_format.setItemText(4, QCoreApplication.translate("ImageEditor", u"UNPACKED_MSB", None))
 
         self.label_7.setText(QCoreApplication.translate("ImageEditor", u"\u5bbd", None))
         self.label_8.setText(QCoreApplication.translate("ImageEditor", u"\u50cf\u7d20\u70b9\u4f4d\u6570", None))
@@ -1031,11 +1071,13 @@ class Ui_ImageEditor(object):
         ___qlistwidgetitem9 = self.pipeline.item(9)
         ___qlistwidgetitem9.setText(QCoreApplication.translate("ImageEditor", u"LTM", None));
         ___qlistwidgetitem10 = self.pipeline.item(10)
-        ___qlistwidgetitem10.setText(QCoreApplication.translate("ImageEditor", u"CSC", None));
+        ___qlistwidgetitem10.setText(QCoreApplication.translate("ImageEditor", u"guided LTM", None));
         ___qlistwidgetitem11 = self.pipeline.item(11)
-        ___qlistwidgetitem11.setText(QCoreApplication.translate("ImageEditor", u"yuv denoise", None));
+        ___qlistwidgetitem11.setText(QCoreApplication.translate("ImageEditor", u"CSC", None));
         ___qlistwidgetitem12 = self.pipeline.item(12)
-        ___qlistwidgetitem12.setText(QCoreApplication.translate("ImageEditor", u"yuv sharpen", None));
+        ___qlistwidgetitem12.setText(QCoreApplication.translate("ImageEditor", u"yuv denoise", None));
+        ___qlistwidgetitem13 = self.pipeline.item(13)
+        ___qlistwidgetitem13.setText(QCoreApplication.translate("ImageEditor", u"yuv sharpen", None));
         self.pipeline.setSortingEnabled(__sortingEnabled)
 
         self.reload.setText(QCoreApplication.translate("ImageEditor", u"\u7b97\u6cd5\u70ed\u66f4\u65b0", None))
@@ -1081,6 +1123,8 @@ class Ui_ImageEditor(object):
         self.groupBox_12.setTitle(QCoreApplication.translate("ImageEditor", u"LTM", None))
         self.label_14.setText(QCoreApplication.translate("ImageEditor", u"\u6697\u533a\u63d0\u5347    ", None))
         self.label_15.setText(QCoreApplication.translate("ImageEditor", u"\u4eae\u533a\u6291\u5236", None))
+        self.label_43.setText(QCoreApplication.translate("ImageEditor", u"\u534a\u5f84", None))
+        self.label_44.setText(QCoreApplication.translate("ImageEditor", u"\u5f3a\u5ea6", None))
         self.groupBox_6.setTitle(QCoreApplication.translate("ImageEditor", u"bad pixel correction", None))
         self.label_21.setText(QCoreApplication.translate("ImageEditor", u"\u68c0\u6d4b\u533a\u57df     ", None))
         self.groupBox_4.setTitle(QCoreApplication.translate("ImageEditor", u"black level", None))